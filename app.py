@@ -3,52 +3,199 @@ My Intelligent Library Web Application
 A Flask-based web app for managing and reading digital books with AI-powered search.
 """
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, abort, session, jsonify, send_from_directory
+import time
+import threading
+import mimetypes
+from flask import Flask, render_template, request, redirect, url_for, flash, abort, session, jsonify, current_app, Response, send_from_directory
 import sqlite3
 from werkzeug.utils import secure_filename
+from werkzeug.http import http_date
 from datetime import datetime
-from openai import OpenAI
 from dotenv import load_dotenv
-from functools import wraps
+from functools import wraps, lru_cache
 import json
 from flask_cors import CORS
+import click
+from flask.cli import with_appcontext
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required as flask_login_required, current_user
-from authlib.integrations.flask_client import OAuth
-try:
-    from PIL import Image  # type: ignore
-    PIL_AVAILABLE = True
-except Exception:
-    Image = None  # type: ignore
-    PIL_AVAILABLE = False
-try:
-    import imghdr  # type: ignore
-except Exception:
-    imghdr = None  # type: ignore
+from db import Database
+import tracing
+from repositories import BookRepository, BOOK_ORDERINGS
+from collation import SORT_KEY_COLUMNS, SORT_LANGUAGES, rebuild_sort_keys
+from counters import UsageCounters
+from jobs import submit_job, get_job, STALE_JOB_SECONDS
+from ratelimit import RateLimiter, LimitExceeded
+from typeahead import PrefixIndex
+from fuzzy import TrigramIndex
+from related import RelatedBooks, related_available
+from duplicates import DuplicateDetector
+from passages import PassageIndex, passages_available, QA_ANSWER_TOKENS, QA_MAX_QUESTION_CHARS
+from storage import create_storage, storage_config_from_env
+from previews import schedule_preview, delete_previews, backfill_previews, preview_filename, PREVIEW_FOLDER
+from pdf_optimize import schedule_optimization, backfill_optimization
+from reconcile import reconcile, start_reconciler
+from compression import compress_response, serve_static_file, precompress_static, encoded_etags
+from fragments import FragmentCache, make_book_card, enable_bytecode_cache, precompile_templates, stream_page
+from backup import (run_backup, schedule_backup, restore_backup, list_backups, list_failed_backups, backup_running,
+                    BackupInProgress, BACKUP_FOLDER)
+from opds import (CATALOGUE_VERSION_TRIGGERS, POSTGRES_CATALOGUE_VERSION_TRIGGERS, OPDS_PAGE_SIZE, ATOM_TYPE,
+                  NAVIGATION_TYPE, ACQUISITION_TYPE, OPDS2_TYPE, OPENSEARCH_TYPE, catalogue_version, feed_etag,
+                  encode_cursor, decode_cursor, book_entry, render_atom, render_opds2, opensearch_description, atom_date)
+from uploads import ResumableUploads, UploadError, parse_metadata, parse_checksum, TUS_VERSION, TUS_EXTENSIONS
+from changes import (CHANGE_LOG_TRIGGERS, POSTGRES_CHANGE_LOG_TRIGGERS, BACKFILL_CHANGE_LOG, POSTGRES_BACKFILL_CHANGE_LOG,
+                     CHANGES_PAGE_SIZE, parse_since, read_changes)
+from facets import FACET_COUNT_TRIGGERS, POSTGRES_FACET_COUNT_TRIGGERS, REBUILD_FACET_COUNTS, parse_facet_filters, filter_clause, facet_counts
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize Flask app
-app = Flask(__name__)
-app.secret_key = os.getenv('FLASK_SECRET_KEY', 'your-secret-key-change-in-production')
-CORS(app)
-
-# Initialize Flask-Login
+# Initialize Flask-Login (bound to each app in create_app)
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# Initialize OAuth
-oauth = OAuth(app)
-oauth.register(
-    name='google',
-    client_id=os.getenv('GOOGLE_CLIENT_ID', 'your-google-client-id'),
-    client_secret=os.getenv('GOOGLE_CLIENT_SECRET', 'your-google-client-secret'),
-    server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-    client_kwargs={'scope': 'openid email profile'},
-)
+# Views are collected here and registered on every app built by create_app()
+_ROUTES = []
+
+def route(rule, **options):
+    """Record a view function so create_app() can register it on the app."""
+    def decorator(f):
+        _ROUTES.append((rule, f, options))
+        return f
+    return decorator
+
+# OpenAI, Authlib and Pillow are imported on first use rather than at module
+# import, so worker boots and tests only pay for what they actually touch.
+_openai_client = None
+_openai_client_pid = None
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '30'))  # seconds per attempt
+
+def get_openai_client():
+    """Return the OpenAI client for this process, creating it on first use."""
+    global _openai_client, _openai_client_pid
+    # The client owns an HTTP connection pool, which must not cross a fork()
+    if _openai_client is None or _openai_client_pid != os.getpid():
+        from openai import OpenAI
+        # Bounded so a stuck call cannot outlive its rate-limiter lease (see ratelimit.py)
+        _openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), timeout=OPENAI_TIMEOUT, max_retries=2)
+        _openai_client_pid = os.getpid()
+    return _openai_client
+
+def create_chat_completion(messages, max_tokens, model="gpt-3.5-turbo", temperature=0.7):
+    """Call the chat completions API, traced with the prompt size and token usage."""
+    with tracing.chat_completion_span(model, messages, max_tokens) as span:
+        response = get_openai_client().chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        tracing.record_usage(span, response)
+        return response
+
+GOOGLE_METADATA_URL = 'https://accounts.google.com/.well-known/openid-configuration'
+GOOGLE_METADATA_CACHE = os.path.join('instance', 'google_openid_configuration.json')
+GOOGLE_METADATA_TTL = 24 * 60 * 60  # Google rotates this document rarely
+_google_metadata = None
+_oauth_lock = threading.Lock()
+
+def load_google_metadata():
+    """Return Google's OpenID discovery document.
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    The document is cached in memory and on disk so that only one process per
+    day goes to the network for it, instead of every worker on first login.
+    """
+    global _google_metadata
+    now = time.time()
+    if _google_metadata and now - _google_metadata['_loaded_at'] < GOOGLE_METADATA_TTL:
+        return _google_metadata
+    try:
+        mtime = os.path.getmtime(GOOGLE_METADATA_CACHE)
+        if now - mtime < GOOGLE_METADATA_TTL:
+            with open(GOOGLE_METADATA_CACHE, encoding='utf-8') as fh:
+                metadata = json.load(fh)
+            metadata['_loaded_at'] = mtime
+            _google_metadata = metadata
+            return metadata
+    except (OSError, ValueError):
+        pass
+
+    import requests
+    response = requests.get(GOOGLE_METADATA_URL, timeout=10)
+    response.raise_for_status()
+    metadata = response.json()
+    try:
+        os.makedirs(os.path.dirname(GOOGLE_METADATA_CACHE), exist_ok=True)
+        tmp_path = f'{GOOGLE_METADATA_CACHE}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fh:
+            json.dump(metadata, fh)
+        os.replace(tmp_path, GOOGLE_METADATA_CACHE)
+    except OSError:
+        pass
+    metadata['_loaded_at'] = now
+    _google_metadata = metadata
+    return metadata
+
+def get_oauth():
+    """Return the current app's Authlib registry, registering Google on first use."""
+    oauth = current_app.extensions.get('authlib.integrations.flask_client')
+    if oauth is not None:
+        return oauth
+    with _oauth_lock:
+        oauth = current_app.extensions.get('authlib.integrations.flask_client')
+        if oauth is not None:
+            return oauth
+        from authlib.integrations.flask_client import OAuth
+        try:
+            # Pre-seeded metadata (with '_loaded_at') stops Authlib fetching it again
+            server_metadata = dict(load_google_metadata())
+        except Exception:
+            server_metadata = {}
+        oauth = OAuth()
+        oauth.register(
+            name='google',
+            client_id=os.getenv('GOOGLE_CLIENT_ID', 'your-google-client-id'),
+            client_secret=os.getenv('GOOGLE_CLIENT_SECRET', 'your-google-client-secret'),
+            server_metadata_url=GOOGLE_METADATA_URL,
+            client_kwargs={'scope': 'openid email profile'},
+            **server_metadata
+        )
+        oauth.init_app(current_app)
+    return oauth
+
+@lru_cache(maxsize=None)
+def get_pil_image():
+    """Return Pillow's Image module, or None if Pillow is not installed."""
+    try:
+        from PIL import Image  # type: ignore
+        return Image
+    except Exception:
+        return None
+
+@lru_cache(maxsize=None)
+def get_imghdr():
+    """Return the stdlib imghdr module, or None where it no longer exists."""
+    try:
+        import imghdr  # type: ignore
+        return imghdr
+    except Exception:
+        return None
+
+def warm_up():
+    """Import heavy dependencies and prime caches ahead of forking workers.
+
+    gunicorn.conf.py calls this in the master when the app is preloaded, so
+    workers inherit the imported modules copy-on-write. Clients holding
+    sockets are still created lazily in each worker.
+    """
+    import openai  # noqa: F401
+    import authlib.integrations.flask_client  # noqa: F401
+    get_pil_image()
+    try:
+        load_google_metadata()
+    except Exception:
+        pass
+    for index in BOOK_INDEXES:
+        index.sync(get_db_connection)
+    precompile_templates(app)
 
 # Language support
 LANGUAGES = {
@@ -67,6 +214,25 @@ LANGUAGES = {
 # Default language is Arabic
 DEFAULT_LANGUAGE = 'ar'
 
+# Per-worker in-memory indexes over book titles and authors
+typeahead_index = PrefixIndex()  # /autocomplete
+fuzzy_index = TrigramIndex()  # typo-tolerant /search
+BOOK_INDEXES = (typeahead_index, fuzzy_index)
+related_index = RelatedBooks()  # writes related_books for book_detail
+card_cache = FragmentCache()  # rendered book cards for the listing pages
+AUTOCOMPLETE_MAX_RESULTS = 20
+FUZZY_SEARCH_LIMIT = 20
+
+def index_book(book_id, title, author):
+    """Add a newly saved book to this worker's in-memory indexes."""
+    for index in BOOK_INDEXES:
+        index.add_book(book_id, title, author)
+
+def unindex_book(book_id):
+    """Remove a deleted book from this worker's in-memory indexes."""
+    for index in BOOK_INDEXES:
+        index.remove_book(book_id)
+
 def get_current_language():
     """Get the current language from session or return default."""
     return session.get('language', DEFAULT_LANGUAGE)
@@ -237,7 +403,29 @@ def get_translations():
             'view_list': 'استعراض القائمة',
             'no_books_in_category': 'لا توجد كتب في هذه القائمة بعد.',
             'category_fields_required': 'يرجى تعبئة جميع الحقول وإرفاق صورة الغلاف.',
-            'category_book_added_successfully': 'تمت إضافة الكتاب إلى القائمة بنجاح!'
+            'category_book_added_successfully': 'تمت إضافة الكتاب إلى القائمة بنجاح!',
+            'publication_year': 'سنة النشر',
+            'filter_results': 'تصفية النتائج',
+            'facet_discipline': 'التخصص',
+            'facet_author': 'أبرز المؤلفين',
+            'facet_decade': 'عقد النشر',
+            'clear_filters': 'إزالة عوامل التصفية',
+            'showing_similar_results': 'لم نجد تطابقاً تاماً، وهذه نتائج مشابهة',
+            'ai_busy': 'خدمة الذكاء الاصطناعي مشغولة حالياً، يرجى المحاولة بعد قليل',
+            'ai_quota_exceeded': 'لقد استهلكت حصتك من طلبات الذكاء الاصطناعي، يرجى المحاولة لاحقاً',
+            'sort_by': 'ترتيب حسب',
+            'sort_newest': 'الأحدث',
+            'sort_popular': 'الأكثر شعبية',
+            'sort_title': 'العنوان (أ-ي)',
+            'sort_author': 'المؤلف (أ-ي)',
+            'views': 'المشاهدات',
+            'downloads': 'التحميلات',
+            'title_author_required': 'يرجى إدخال عنوان الكتاب واسم المؤلف.',
+            'possible_duplicates': 'تمت إضافة الكتاب، لكنه يشبه كتبًا موجودة في المكتبة',
+            'enter_question': 'يرجى كتابة سؤال عن الكتاب',
+            'book_text_not_ready': 'ما زال نص هذا الكتاب قيد الفهرسة، يرجى المحاولة بعد قليل',
+            'book_text_unavailable': 'لا يحتوي ملف هذا الكتاب على نص يمكن البحث فيه',
+            'error_answering_question': 'خطأ في الإجابة عن السؤال'
         },
         'en': {
             'app_name': 'My Intelligent Library',
@@ -394,7 +582,29 @@ def get_translations():
             'view_list': 'View list',
             'no_books_in_category': 'No books have been added to this list yet.',
             'category_fields_required': 'Please fill in all fields and attach a cover image.',
-            'category_book_added_successfully': 'Book added to the list successfully!'
+            'category_book_added_successfully': 'Book added to the list successfully!',
+            'publication_year': 'Publication Year',
+            'filter_results': 'Filter Results',
+            'facet_discipline': 'Discipline',
+            'facet_author': 'Top Authors',
+            'facet_decade': 'Publication Decade',
+            'clear_filters': 'Clear filters',
+            'showing_similar_results': 'No exact matches; showing similar results',
+            'ai_busy': 'The AI service is busy right now, please try again shortly',
+            'ai_quota_exceeded': 'You have used up your AI request quota, please try again later',
+            'sort_by': 'Sort by',
+            'sort_newest': 'Newest',
+            'sort_popular': 'Most popular',
+            'sort_title': 'Title (A-Z)',
+            'sort_author': 'Author (A-Z)',
+            'views': 'Views',
+            'downloads': 'Downloads',
+            'title_author_required': 'Please enter the book title and author.',
+            'possible_duplicates': 'The book was added, but it looks like books already in the library',
+            'enter_question': 'Please enter a question about the book',
+            'book_text_not_ready': "This book's text is still being indexed, please try again shortly",
+            'book_text_unavailable': "This book's PDF has no searchable text",
+            'error_answering_question': 'Error Answering Question'
         }
     }
     
@@ -475,15 +685,22 @@ def can_add_books():
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
+COVERS_FOLDER = os.path.join('static', 'covers')
 ALLOWED_EXTENSIONS = {'pdf'}
 IMAGE_ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}  # Case-insensitive check in allowed_image()
-MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB max file size
+MAX_FILE_SIZE = 16 * 1024 * 1024  # 16MB max file size; larger PDFs use /resumable_uploads
 MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5MB max image size
 
-# Ensure upload directory exists
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-# Ensure static/covers directory exists
-os.makedirs('static/covers', exist_ok=True)
+# SQLite file by default, or a shared PostgreSQL server via DATABASE_URL (see db.py)
+database = Database()
+
+# Where uploads, covers and previews are kept: local folders by default, or an
+# S3-compatible bucket with STORAGE_BACKEND=s3 (see storage.py)
+storage = create_storage(storage_config_from_env({
+    'uploads': UPLOAD_FOLDER,
+    'covers': COVERS_FOLDER,
+    'previews': PREVIEW_FOLDER,
+}))
 
 # User model for Flask-Login
 class User(UserMixin):
@@ -515,6 +732,23 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def opds_login_required(f):
+    """login_required for e-reader apps: they may also send HTTP Basic credentials.
+
+    As with the login form, the username (an email address) identifies the
+    reader; no password is checked.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if current_user.is_authenticated or session.get('logged_in'):
+            return f(*args, **kwargs)
+        auth = request.authorization
+        if auth is not None and auth.type == 'basic' and '@' in (auth.username or ''):
+            return f(*args, **kwargs)
+        return Response('Sign in with your email address as the user name.', 401,
+                        {'WWW-Authenticate': 'Basic realm="Library", charset="UTF-8"'})
+    return decorated_function
+
 def allowed_file(filename):
     """Check if the uploaded file has an allowed extension."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -530,7 +764,8 @@ def validate_image_file(file_stream):
     """
     try:
         file_stream.seek(0)
-        if PIL_AVAILABLE and Image is not None:
+        Image = get_pil_image()
+        if Image is not None:
             try:
                 with Image.open(file_stream) as img:
                     # Verify the image
@@ -549,6 +784,7 @@ def validate_image_file(file_stream):
                 except Exception:
                     pass
         # Fallback: imghdr check
+        imghdr = get_imghdr()
         detected = imghdr.what(file_stream) if imghdr else None
         file_stream.seek(0)
         if detected in {'jpeg', 'png', 'gif', 'webp'}:
@@ -596,21 +832,25 @@ def save_cover_image(file_storage, translations, require_image=False):
         name, ext = safe_name.rsplit('.', 1)
         safe_name = f"{name}.{ext.lower()}"
     cover_filename = f"{timestamp}{safe_name}"
-    os.makedirs('static/covers', exist_ok=True)
-    cover_path = os.path.join('static/covers', cover_filename)
     
     try:
         file_storage.seek(0)
-        file_storage.save(cover_path)
+        storage.save('covers', cover_filename, file_storage)
     except Exception as exc:
         return None, f"Error saving cover image: {exc}"
     
     return cover_filename, None
 
 def init_database():
-    """Initialize the SQLite database with books table."""
-    conn = sqlite3.connect('library.db')
+    """Initialize the database with books table."""
+    if database.dialect == 'postgresql':
+        init_postgres_database()
+        return
+    conn = sqlite3.connect(database.sqlite_path)
     cursor = conn.cursor()
+
+    # Readers never block the writer (or online backups) and vice versa; persistent
+    cursor.execute('PRAGMA journal_mode=WAL')
     
     # Create books table if it doesn't exist
     cursor.execute('''
@@ -638,6 +878,36 @@ def init_database():
     # Migration: add discipline column if missing
     if 'discipline' not in columns:
         cursor.execute('ALTER TABLE books ADD COLUMN discipline TEXT')
+
+    # Migration: add rendered first-page preview columns if missing (see previews.py)
+    if 'preview_filename' not in columns:
+        cursor.execute('ALTER TABLE books ADD COLUMN preview_filename TEXT')
+    if 'preview_pages' not in columns:
+        cursor.execute('ALTER TABLE books ADD COLUMN preview_pages INTEGER')
+
+    # Migration: add PDF optimization bookkeeping columns if missing (see pdf_optimize.py)
+    if 'original_size' not in columns:
+        cursor.execute('ALTER TABLE books ADD COLUMN original_size INTEGER')
+    if 'stored_size' not in columns:
+        cursor.execute('ALTER TABLE books ADD COLUMN stored_size INTEGER')
+    if 'optimized' not in columns:
+        cursor.execute('ALTER TABLE books ADD COLUMN optimized INTEGER')
+
+    # Migration: add write-behind usage counters if missing (see counters.py)
+    if 'view_count' not in columns:
+        cursor.execute('ALTER TABLE books ADD COLUMN view_count INTEGER NOT NULL DEFAULT 0')
+    if 'download_count' not in columns:
+        cursor.execute('ALTER TABLE books ADD COLUMN download_count INTEGER NOT NULL DEFAULT 0')
+
+    # Migration: add the "Ask this book" passage bookkeeping column if missing (see passages.py)
+    if 'passage_count' not in columns:
+        cursor.execute('ALTER TABLE books ADD COLUMN passage_count INTEGER')
+
+    # Migration: add title and author collation keys if missing (see collation.py)
+    for column in SORT_KEY_COLUMNS:
+        if column not in columns:
+            cursor.execute(f'ALTER TABLE books ADD COLUMN {column} TEXT')
+    rebuild_sort_keys(cursor)
     
     # Create curated category books table
     cursor.execute('''
@@ -651,36 +921,658 @@ def init_database():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+
+    # Background AI generation jobs (see jobs.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ai_jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            language TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            result TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # At most one queued/running job per book, kind and language
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_ai_jobs_in_flight
+        ON ai_jobs (kind, book_id, language) WHERE status IN ('queued', 'running')
+    ''')
+
+    # Shared OpenAI admission state: token buckets, in-flight leases and per-user usage (see ratelimit.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ai_rate_limits (
+            name TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ai_leases (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            user_key TEXT NOT NULL,
+            window_start INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ai_usage (
+            name TEXT NOT NULL,
+            user_key TEXT NOT NULL,
+            window_start INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (name, user_key, window_start)
+        )
+    ''')
+
+    # Precomputed "related books" lists (see related.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS related_books (
+            book_id INTEGER NOT NULL,
+            related_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY (book_id, related_id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_related_books_related_id ON related_books (related_id)')
+
+    # File reconciler (see reconcile.py): referenced-name lookups and run bookkeeping
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_books_filename ON books (filename)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_books_image_filename ON books (image_filename)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_category_books_cover_filename ON category_books (cover_filename)')
+    # Resumable chunked uploads in progress (see uploads.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            user_key TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            upload_length INTEGER NOT NULL,
+            sha256 TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated_at ON upload_sessions (updated_at)')
+    # Near-duplicate fingerprints and their LSH buckets (see duplicates.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS book_signatures (
+            book_id INTEGER PRIMARY KEY,
+            metadata_minhash BLOB,
+            text_minhash BLOB,
+            cover_hash INTEGER
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS book_lsh_buckets (
+            bucket INTEGER NOT NULL,
+            book_id INTEGER NOT NULL,
+            PRIMARY KEY (bucket, book_id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_book_lsh_buckets_book_id ON book_lsh_buckets (book_id)')
+    # PDF text passages for "Ask this book", BM25-ranked through FTS5 (see passages.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS book_passages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL,
+            ordinal INTEGER NOT NULL,
+            page INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            tokens INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_book_passages_book_id ON book_passages (book_id, ordinal)')
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS book_passages_fts
+        USING fts5(book, body, tokenize = 'unicode61 remove_diacritics 2')
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_runs (
+            name TEXT PRIMARY KEY,
+            last_run REAL NOT NULL,
+            last_report TEXT
+        )
+    ''')
+
+    # Indexes backing the search facets (see facets.py)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_books_discipline ON books (discipline)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_books_author ON books (author)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_books_publication_year ON books (publication_year)')
+
+    # Index backing the "most popular" sort (see repositories.BOOK_ORDERINGS)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_books_popularity ON books (download_count DESC, view_count DESC)')
+
+    # Indexes backing the title and author sorts, one per interface language
+    for language in SORT_LANGUAGES:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_books_title_sort_{language} ON books (title_sort_{language}, id)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_books_author_sort_{language} '
+                       f'ON books (author_sort_{language}, title_sort_{language}, id)')
+
+    # Catalogue-wide facet counts, maintained by triggers
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS book_facet_counts (
+            facet TEXT NOT NULL,
+            value TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (facet, value)
+        )
+    ''')
+    # Serves the catalogue-wide top authors without reading every author (see facets.py)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_book_facet_counts_rank ON book_facet_counts (facet, count DESC, value)')
+    # Catalogue version for OPDS feed validators, bumped by triggers (see opds.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalogue_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            updated_at TIMESTAMP NOT NULL
+        )
+    ''')
+    for statement in CATALOGUE_VERSION_TRIGGERS:
+        cursor.execute(statement)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_books_upload_date_id ON books (upload_date, id)')
+
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_books_facets_insert'")
+    facet_triggers_exist = cursor.fetchone() is not None
+    for statement in FACET_COUNT_TRIGGERS:
+        cursor.execute(statement)
+    if not facet_triggers_exist:
+        # First run with facets: count the books that predate the triggers
+        for statement in REBUILD_FACET_COUNTS:
+            cursor.execute(statement)
+
+    # Change log for client-side sync, written by triggers (see changes.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalogue_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            op TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_catalogue_changes_entity ON catalogue_changes (entity, entity_id)')
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_books_changes_insert'")
+    change_triggers_exist = cursor.fetchone() is not None
+    for statement in CHANGE_LOG_TRIGGERS:
+        cursor.execute(statement)
+    if not change_triggers_exist:
+        # First run with the change log: log the rows that predate the triggers
+        for statement in BACKFILL_CHANGE_LOG:
+            cursor.execute(statement)
     
     conn.commit()
     conn.close()
 
+def init_postgres_database():
+    """Initialize a PostgreSQL database with the same schema as init_database()."""
+    conn = database.connect()
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS books (
+                id SERIAL PRIMARY KEY,
+                title TEXT NOT NULL,
+                author TEXT NOT NULL,
+                description TEXT,
+                filename TEXT NOT NULL,
+                image_filename TEXT,
+                upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Columns added by later migrations, in the order SQLite gained them
+        for column, column_type in [
+            ('publication_year', 'INTEGER'),
+            ('discipline', 'TEXT'),
+            ('preview_filename', 'TEXT'),
+            ('preview_pages', 'INTEGER'),
+            ('original_size', 'BIGINT'),
+            ('stored_size', 'BIGINT'),
+            ('optimized', 'INTEGER'),
+            ('view_count', 'INTEGER NOT NULL DEFAULT 0'),
+            ('download_count', 'INTEGER NOT NULL DEFAULT 0'),
+            ('passage_count', 'INTEGER'),
+        ] + [(column, 'TEXT COLLATE "C"') for column in SORT_KEY_COLUMNS]:
+            conn.execute(f'ALTER TABLE books ADD COLUMN IF NOT EXISTS {column} {column_type}')
+        rebuild_sort_keys(conn)
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS category_books (
+                id SERIAL PRIMARY KEY,
+                category_key TEXT NOT NULL,
+                title TEXT NOT NULL,
+                author TEXT NOT NULL,
+                source TEXT NOT NULL,
+                cover_filename TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Background AI generation jobs (see jobs.py)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ai_jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                book_id INTEGER NOT NULL,
+                language TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                result TEXT,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_ai_jobs_in_flight
+            ON ai_jobs (kind, book_id, language) WHERE status IN ('queued', 'running')
+        ''')
+
+        # Shared OpenAI admission state (see ratelimit.py)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ai_rate_limits (
+                name TEXT PRIMARY KEY,
+                tokens DOUBLE PRECISION NOT NULL,
+                updated_at DOUBLE PRECISION NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ai_leases (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                user_key TEXT NOT NULL,
+                window_start BIGINT NOT NULL,
+                expires_at DOUBLE PRECISION NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ai_usage (
+                name TEXT NOT NULL,
+                user_key TEXT NOT NULL,
+                window_start BIGINT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (name, user_key, window_start)
+            )
+        ''')
+
+        # Precomputed "related books" lists (see related.py)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS related_books (
+                book_id INTEGER NOT NULL,
+                related_id INTEGER NOT NULL,
+                score DOUBLE PRECISION NOT NULL,
+                PRIMARY KEY (book_id, related_id)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_related_books_related_id ON related_books (related_id)')
+
+        # File reconciler (see reconcile.py): referenced-name lookups and run bookkeeping
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_books_filename ON books (filename)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_books_image_filename ON books (image_filename)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_category_books_cover_filename ON category_books (cover_filename)')
+        # Resumable chunked uploads in progress (see uploads.py)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS upload_sessions (
+                id TEXT PRIMARY KEY,
+                user_key TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                upload_length BIGINT NOT NULL,
+                sha256 TEXT,
+                created_at DOUBLE PRECISION NOT NULL,
+                updated_at DOUBLE PRECISION NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated_at ON upload_sessions (updated_at)')
+        # Near-duplicate fingerprints and their LSH buckets (see duplicates.py)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS book_signatures (
+                book_id INTEGER PRIMARY KEY,
+                metadata_minhash BYTEA,
+                text_minhash BYTEA,
+                cover_hash BIGINT
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS book_lsh_buckets (
+                bucket BIGINT NOT NULL,
+                book_id INTEGER NOT NULL,
+                PRIMARY KEY (bucket, book_id)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_book_lsh_buckets_book_id ON book_lsh_buckets (book_id)')
+        # PDF text passages for "Ask this book", ranked through a tsvector index (see passages.py)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS book_passages (
+                id SERIAL PRIMARY KEY,
+                book_id INTEGER NOT NULL,
+                ordinal INTEGER NOT NULL,
+                page INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                search_text TEXT NOT NULL,
+                tokens INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_book_passages_book_id ON book_passages (book_id, ordinal)')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_book_passages_search ON book_passages "
+                     "USING GIN (to_tsvector('simple', search_text))")
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS maintenance_runs (
+                name TEXT PRIMARY KEY,
+                last_run DOUBLE PRECISION NOT NULL,
+                last_report TEXT
+            )
+        ''')
+
+        # Indexes backing the search facets (see facets.py)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_books_discipline ON books (discipline)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_books_author ON books (author)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_books_publication_year ON books (publication_year)')
+
+        # Index backing the "most popular" sort (see repositories.BOOK_ORDERINGS)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_books_popularity ON books (download_count DESC, view_count DESC)')
+
+        # Indexes backing the title and author sorts, one per interface language
+        for language in SORT_LANGUAGES:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_books_title_sort_{language} ON books (title_sort_{language}, id)')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_books_author_sort_{language} '
+                         f'ON books (author_sort_{language}, title_sort_{language}, id)')
+
+        # Full-text index for search (see BookRepository.match_clause)
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_books_fts
+            ON books USING GIN (to_tsvector('simple', title || ' ' || author))
+        ''')
+        conn.commit()
+
+        # Trigram indexes make ILIKE '%term%' an index scan; pg_trgm is an
+        # optional contrib extension and may not be installed or permitted
+        try:
+            conn.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_books_title_trgm ON books USING GIN (title gin_trgm_ops)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_books_author_trgm ON books USING GIN (author gin_trgm_ops)')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+
+        # Catalogue-wide facet counts, maintained by a trigger
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS book_facet_counts (
+                facet TEXT NOT NULL,
+                value TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (facet, value)
+            )
+        ''')
+        # Serves the catalogue-wide top authors without reading every author (see facets.py)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_book_facet_counts_rank ON book_facet_counts (facet, count DESC, value)')
+        # Catalogue version for OPDS feed validators, bumped by a trigger (see opds.py)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS catalogue_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version BIGINT NOT NULL,
+                updated_at TIMESTAMP NOT NULL
+            )
+        ''')
+        for statement in POSTGRES_CATALOGUE_VERSION_TRIGGERS:
+            conn.execute(statement)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_books_upload_date_id ON books (upload_date, id)')
+
+        facet_triggers_exist = conn.execute(
+            "SELECT 1 FROM pg_trigger WHERE tgname = 'trg_books_facets'"
+        ).fetchone() is not None
+        for statement in POSTGRES_FACET_COUNT_TRIGGERS:
+            conn.execute(statement)
+        if not facet_triggers_exist:
+            for statement in REBUILD_FACET_COUNTS:
+                conn.execute(statement)
+
+        # Change log for client-side sync, numbered and written by a trigger (see changes.py)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS catalogue_changes (
+                seq BIGINT PRIMARY KEY,
+                entity TEXT NOT NULL,
+                entity_id INTEGER NOT NULL,
+                op TEXT NOT NULL
+            )
+        ''')
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_catalogue_changes_entity ON catalogue_changes (entity, entity_id)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS catalogue_change_counter (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                seq BIGINT NOT NULL
+            )
+        ''')
+        change_triggers_exist = conn.execute(
+            "SELECT 1 FROM pg_trigger WHERE tgname = 'trg_books_changes'"
+        ).fetchone() is not None
+        for statement in POSTGRES_CHANGE_LOG_TRIGGERS:
+            conn.execute(statement)
+        if not change_triggers_exist:
+            for statement in POSTGRES_BACKFILL_CHANGE_LOG:
+                conn.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+
 def get_db_connection():
-    """Get a database connection."""
-    conn = sqlite3.connect('library.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Get a pooled database connection; close() returns it to the pool."""
+    return database.connect()
+
+books_repository = BookRepository(get_db_connection, database.dialect)
+
+# Bounds concurrent OpenAI calls, their rate and each user's share, across all workers
+openai_limiter = RateLimiter(get_db_connection)
+
+# View and download counts, batched in memory and flushed periodically
+usage_counters = UsageCounters(get_db_connection)
+
+# Large PDFs arrive in chunks through /resumable_uploads
+resumable_uploads = ResumableUploads(get_db_connection)
+
+# Warns when an upload looks like a book already in the library
+duplicate_detector = DuplicateDetector(get_db_connection)
+passage_index = PassageIndex(get_db_connection)
+
+def book_sort_order():
+    """The listing order requested via ?sort=, defaulting to newest first."""
+    sort = request.args.get('sort', 'newest')
+    return sort if sort in BOOK_ORDERINGS else 'newest'
+
+def ai_user_key():
+    """Identify the caller for per-user AI quotas."""
+    if current_user.is_authenticated:
+        return f'user:{current_user.id}'
+    if session.get('email'):
+        return f"user:{session['email']}"
+    return f'ip:{request.remote_addr}'
+
+def ai_limit_headers(exc):
+    """Status code and Retry-After header for a shed AI request."""
+    # Quotas are per user (429); the other limits protect the whole site (503)
+    return (429 if exc.reason == 'quota' else 503), {'Retry-After': str(exc.retry_after)}
+
+def ai_limit_message(exc, translations):
+    """Translated explanation for a shed AI request."""
+    return translations['ai_quota_exceeded' if exc.reason == 'quota' else 'ai_busy']
+
+def book_cover_url(book):
+    """URL of a book's cover: the uploaded image, else its rendered first page."""
+    if book['image_filename']:
+        return url_for('serve_cover', filename=book['image_filename'])
+    if book['preview_filename']:
+        return url_for('serve_preview', filename=book['preview_filename'])
+    return None
+
+@click.command('render-previews')
+def render_previews_command():
+    """Render missing first-page previews for all books."""
+    queued = backfill_previews(get_db_connection, storage)
+    click.echo(f'Rendered previews for {queued} book(s).')
+
+@click.command('optimize-pdfs')
+def optimize_pdfs_command():
+    """Linearize and recompress uploaded PDFs that have not been optimized yet."""
+    queued, original_total, stored_total = backfill_optimization(get_db_connection, storage)
+    saved = original_total - stored_total
+    click.echo(f'Processed {queued} PDF(s). Library total: {original_total} -> {stored_total} bytes '
+               f'({saved} bytes saved).')
+
+@click.command('rebuild-related')
+def rebuild_related_command():
+    """Recompute every book's related-books list from scratch."""
+    if not related_available():
+        raise click.ClickException('NumPy is required to compute related books.')
+    count = related_index.rebuild(get_db_connection)
+    click.echo(f'Rebuilt related books for {count} book(s).')
+
+@click.command('find-duplicates')
+def find_duplicates_command():
+    """Fingerprint books uploaded before duplicate detection and list likely duplicates."""
+    count = 0
+    for book, duplicates in duplicate_detector.backfill(storage):
+        count += 1
+        for duplicate in duplicates:
+            click.echo(f"{book['id']} {book['title']!r} ~ {duplicate['id']} {duplicate['title']!r} "
+                       f"({', '.join(duplicate['reasons'])}, {duplicate['score']})")
+    click.echo(f'Fingerprinted {count} book(s).')
+
+@click.command('index-passages')
+def index_passages_command():
+    """Extract and index PDF text passages for books that have none yet."""
+    queued = passage_index.backfill(storage)
+    click.echo(f'Indexed passages of {queued} book(s).')
+
+@click.command('rebuild-sort-keys')
+def rebuild_sort_keys_command():
+    """Recompute every book's title and author collation keys."""
+    with get_db_connection() as conn:
+        count = rebuild_sort_keys(conn, missing_only=False)
+    click.echo(f'Rebuilt the sort keys of {count} book(s).')
+
+@click.command('reconcile-files')
+@click.option('--dry-run', is_flag=True, help='Report orphans without moving or deleting anything.')
+def reconcile_files_command(dry_run):
+    """Quarantine files no book refers to and delete expired quarantined files."""
+    report = reconcile(get_db_connection, storage, dry_run=dry_run)
+    for area, counts in report.items():
+        click.echo(f"{area}: scanned {counts['scanned']}, quarantined {counts['quarantined']} "
+                   f"({counts['quarantined_bytes']} bytes), restored {counts['restored']}, "
+                   f"deleted {counts['deleted']} ({counts['reclaimed_bytes']} bytes reclaimed)")
+    reclaimed = sum(counts['reclaimed_bytes'] for counts in report.values())
+    click.echo(f"{'Would reclaim' if dry_run else 'Reclaimed'} {reclaimed} bytes.")
+
+@click.command('compress-static')
+@with_appcontext
+def compress_static_command():
+    """Pre-compress static text assets (.gz, and .br when brotli is installed)."""
+    files, original_total, compressed_total = precompress_static(current_app.static_folder)
+    click.echo(f'Compressed {files} static file(s): {original_total} -> {compressed_total} bytes.')
 
-@app.route('/set_language/<language>')
+@click.command('backup')
+@click.option('--full', is_flag=True, help='Copy every file instead of only those changed since the last backup.')
+def backup_command(full):
+    """Back up the database, uploads and covers without stopping the app."""
+    try:
+        report = run_backup(database, storage, full=full)
+    except BackupInProgress as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(report, indent=2))
+
+@click.command('restore-backup')
+@click.argument('archive', type=click.Path(exists=True, dir_okay=False))
+@click.confirmation_option(prompt='Stop the app first: this replaces the database. Continue?')
+def restore_backup_command(archive):
+    """Restore the database and files from a backup archive (and the archives it builds on)."""
+    result = restore_backup(archive, database, storage)
+    click.echo(f"Database {'restored' if result['database'] else 'not in archive'}; "
+               f"{result['restored']} file(s) restored, {result['skipped']} already present.")
+
+def start_background_maintenance():
+    """Start per-worker background maintenance; called after each gunicorn fork."""
+    start_reconciler(get_db_connection, storage)
+
+def create_app():
+    """Application factory: build a configured Flask app with all views registered."""
+    app = Flask(__name__)
+    app.secret_key = os.getenv('FLASK_SECRET_KEY', 'your-secret-key-change-in-production')
+    CORS(app)
+    login_manager.init_app(app)
+    for rule, view_func, options in _ROUTES:
+        app.add_url_rule(rule, view_func=view_func, **options)
+    app.add_template_global(book_cover_url)
+    app.add_template_global(make_book_card(card_cache, book_cover_url), 'book_card')
+    enable_bytecode_cache(app)
+    # Static files come from their pre-compressed siblings when available
+    app.view_functions['static'] = serve_static_file
+    app.after_request(compress_response)
+    tracing.init_app(app)
+    app.cli.add_command(render_previews_command)
+    app.cli.add_command(optimize_pdfs_command)
+    app.cli.add_command(rebuild_related_command)
+    app.cli.add_command(find_duplicates_command)
+    app.cli.add_command(index_passages_command)
+    app.cli.add_command(rebuild_sort_keys_command)
+    app.cli.add_command(reconcile_files_command)
+    app.cli.add_command(compress_static_command)
+    app.cli.add_command(backup_command)
+    app.cli.add_command(restore_backup_command)
+    return app
+
+@route('/set_language/<language>')
 def set_language(language):
     """Set the language for the session."""
     if language in LANGUAGES:
         session['language'] = language
     return redirect(request.referrer or url_for('index'))
 
-@app.route('/')
+@route('/')
 @login_required
 def index():
     """Homepage displaying search bar, recent books, and all books."""
-    conn = get_db_connection()
     # Get recent books (last 6 books)
-    recent_books = conn.execute('SELECT * FROM books ORDER BY upload_date DESC LIMIT 6').fetchall()
-    # Get all books
-    all_books = conn.execute('SELECT * FROM books ORDER BY upload_date DESC').fetchall()
-    conn.close()
-    return render_template('index.html', recent_books=recent_books, all_books=all_books, t=get_translations(), lang_data=get_language_data(), can_add_book=can_add_books())
+    recent_books = books_repository.latest(6)
+    # All books are read while the page renders, so it streams in constant memory
+    sort = book_sort_order()
+    all_books = books_repository.stream_ordered(sort, language=get_current_language())
+    return stream_page('index.html', recent_books=recent_books, all_books=all_books, sort=sort, sort_options=list(BOOK_ORDERINGS), t=get_translations(), lang_data=get_language_data(), can_add_book=can_add_books())
+
+def fingerprint_upload(title, author, pdf, cover):
+    """(fingerprint to store, likely duplicates) of an upload about to be added.
+
+    A PDF or cover that breaks the fingerprinting does not stop the upload:
+    duplicates are then looked up by title and author only, and no
+    fingerprint is stored, so `flask find-duplicates` computes the full one
+    later.
+    """
+    try:
+        fingerprint = duplicate_detector.fingerprint(title, author, pdf, cover)
+        stored = fingerprint
+    except Exception:
+        fingerprint = duplicate_detector.metadata_fingerprint(title, author)
+        stored = None
+    try:
+        duplicates = duplicate_detector.find(fingerprint)
+    except Exception:
+        duplicates = []
+    return stored, duplicates
 
-@app.route('/add_book', methods=['GET', 'POST'])
+def register_book(title, author, description, filename, cover_filename, discipline, publication_year,
+                  fingerprint=None):
+    """Insert a stored PDF as a book and start its background processing."""
+    book_id = books_repository.create(title, author, description, filename,
+                                      cover_filename, discipline, publication_year)
+    index_book(book_id, title, author)
+    if fingerprint is not None:
+        duplicate_detector.store(book_id, fingerprint)
+    related_index.schedule_add(get_db_connection, book_id)
+    passage_index.schedule(storage, book_id, filename)
+    schedule_optimization(get_db_connection, storage, book_id, filename)
+    schedule_preview(get_db_connection, storage, book_id, filename)
+    return book_id
+
+@route('/add_book', methods=['GET', 'POST'])
 @login_required
 def add_book():
     """Add a new book to the library."""
@@ -697,6 +1589,7 @@ def add_book():
         author = request.form['author']
         description = request.form['description']
         discipline = request.form.get('discipline', '').strip()
+        publication_year = request.form.get('publication_year', type=int)
 
         if discipline not in valid_disciplines:
             flash(t['invalid_discipline_selected'], 'error')
@@ -732,103 +1625,512 @@ def add_book():
             # Add timestamp to filename to avoid conflicts
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
             filename = timestamp + filename
+
+            # Fingerprint while the upload is still in memory; only LSH bucket matches are compared
+            pdf_data = file.read()
+            file.seek(0)
+            cover_data = None
+            if cover_file and cover_file.filename:
+                cover_data = cover_file.read()
+                cover_file.seek(0)
+            fingerprint, duplicates = fingerprint_upload(title, author, pdf_data, cover_data)
             
             # Save file
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            file.save(file_path)
+            storage.save('uploads', filename, file)
             
             if cover_file and cover_file.filename:
                 cover_filename_to_save, image_error = save_cover_image(cover_file, t)
                 if image_error:
+                    storage.delete('uploads', filename)
                     flash(image_error, 'error')
                     return redirect(request.url)
 
             # Save book info to database (with cover image)
-            conn = get_db_connection()
-            conn.execute(
-                'INSERT INTO books (title, author, description, filename, image_filename, discipline) VALUES (?, ?, ?, ?, ?, ?)',
-                (title, author, description, filename, cover_filename_to_save, discipline)
-            )
-            conn.commit()
-            conn.close()
+            register_book(title, author, description, filename,
+                          cover_filename_to_save, discipline, publication_year, fingerprint)
             
             flash(t['book_added_successfully'], 'success')
+            if duplicates:
+                flash(describe_duplicates(duplicates, t), 'warning')
             return redirect(url_for('index'))
         else:
             flash(t['invalid_file_type'], 'error')
     
     return render_template('add_book.html', t=t, lang_data=lang_data, discipline_options=discipline_options)
 
-@app.route('/book/<int:book_id>')
+def describe_duplicates(duplicates, translations):
+    """Flash-message text naming an upload's likely duplicates."""
+    books = '; '.join(f"{duplicate['title']} ({duplicate['author']})" for duplicate in duplicates)
+    return f"{translations['possible_duplicates']}: {books}"
+
+def tus_response(status=204, headers=None):
+    """Empty response carrying the tus protocol version."""
+    response = Response(status=status)
+    response.headers['Tus-Resumable'] = TUS_VERSION
+    response.headers['Cache-Control'] = 'no-store'
+    for name, value in (headers or {}).items():
+        response.headers[name] = str(value)
+    return response
+
+def upload_error_response(exc):
+    response = jsonify({'error': exc.message})
+    response.status_code = exc.status
+    response.headers['Tus-Resumable'] = TUS_VERSION
+    return response
+
+@route('/resumable_uploads', methods=['POST', 'OPTIONS'])
+@login_required
+def create_resumable_upload():
+    """Start a chunked upload (tus creation); the PDF follows in PATCH requests."""
+    if request.method == 'OPTIONS':
+        return tus_response(headers={'Tus-Version': TUS_VERSION, 'Tus-Extension': TUS_EXTENSIONS,
+                                     'Tus-Max-Size': resumable_uploads.max_size,
+                                     'Tus-Checksum-Algorithm': 'sha256'})
+    if not can_add_books():
+        return jsonify({'error': get_translations()['please_log_in']}), 403
+    try:
+        length = request.headers.get('Upload-Length', type=int)
+        if length is None:
+            raise UploadError(400, 'Upload-Length is required')
+        metadata = parse_metadata(request.headers.get('Upload-Metadata'))
+        if not allowed_file(metadata.get('filename', '')):
+            raise UploadError(400, get_translations()['invalid_file_type'])
+        upload_id = resumable_uploads.create(ai_user_key(), metadata['filename'], length, metadata.get('sha256'))
+    except UploadError as e:
+        return upload_error_response(e)
+    return tus_response(201, {'Location': url_for('resumable_upload', upload_id=upload_id),
+                              'Upload-Offset': 0})
+
+@route('/resumable_uploads/<upload_id>', methods=['HEAD', 'PATCH', 'DELETE'])
+@login_required
+def resumable_upload(upload_id):
+    """Report (HEAD), extend (PATCH) or abandon (DELETE) a chunked upload."""
+    if not can_add_books():
+        return jsonify({'error': get_translations()['please_log_in']}), 403
+    try:
+        if request.method == 'DELETE':
+            resumable_uploads.get(upload_id, ai_user_key())
+            resumable_uploads.discard(upload_id)
+            return tus_response()
+        if request.method == 'HEAD':
+            upload, offset = resumable_uploads.get(upload_id, ai_user_key())
+            return tus_response(200, {'Upload-Offset': offset, 'Upload-Length': upload['upload_length'],
+                                      'Upload-Expires': http_date(resumable_uploads.expires_at(upload))})
+        if request.mimetype != 'application/offset+octet-stream':
+            raise UploadError(415, 'Content-Type must be application/offset+octet-stream')
+        offset = request.headers.get('Upload-Offset', type=int)
+        if offset is None:
+            raise UploadError(400, 'Upload-Offset is required')
+        new_offset = resumable_uploads.append(upload_id, ai_user_key(), offset, request.stream,
+                                              parse_checksum(request.headers.get('Upload-Checksum')))
+        upload, _ = resumable_uploads.get(upload_id, ai_user_key())
+    except UploadError as e:
+        return upload_error_response(e)
+    return tus_response(headers={'Upload-Offset': new_offset,
+                                 'Upload-Expires': http_date(resumable_uploads.expires_at(upload))})
+
+@route('/resumable_uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_resumable_upload(upload_id):
+    """Verify a finished chunked upload and add it as a book (same fields as add_book)."""
+    t = get_translations()
+    if not can_add_books():
+        return jsonify({'error': t['please_log_in']}), 403
+    title = request.form.get('title', '').strip()
+    author = request.form.get('author', '').strip()
+    description = request.form.get('description', '')
+    discipline = request.form.get('discipline', '').strip()
+    publication_year = request.form.get('publication_year', type=int)
+    if not title or not author:
+        return jsonify({'error': t['title_author_required']}), 400
+    if discipline not in {option['key'] for option in build_discipline_options(t)}:
+        return jsonify({'error': t['invalid_discipline_selected']}), 400
+
+    cover_filename = cover_data = None
+    cover_file = request.files.get('cover')
+    if cover_file and cover_file.filename:
+        cover_data = cover_file.read()
+        cover_file.seek(0)
+        cover_filename, image_error = save_cover_image(cover_file, t)
+        if image_error:
+            return jsonify({'error': image_error}), 400
+    try:
+        upload, staging_path = resumable_uploads.finish(upload_id, ai_user_key())
+    except UploadError as e:
+        if cover_filename:
+            storage.delete('covers', cover_filename)
+        return upload_error_response(e)
+
+    filename = datetime.now().strftime('%Y%m%d_%H%M%S_') + secure_filename(upload['filename'])
+    try:
+        fingerprint, duplicates = fingerprint_upload(title, author, staging_path, cover_data)
+        storage.put_file('uploads', filename, staging_path)
+    except Exception:
+        if cover_filename:
+            storage.delete('covers', cover_filename)
+        raise
+    finally:
+        resumable_uploads.discard(upload_id)
+    book_id = register_book(title, author, description, filename, cover_filename, discipline, publication_year,
+                            fingerprint)
+    return jsonify({
+        'book_id': book_id,
+        'url': url_for('book_detail', book_id=book_id),
+        'possible_duplicates': [dict(duplicate, url=url_for('book_detail', book_id=duplicate['id']))
+                                for duplicate in duplicates],
+    }), 201
+
+@route('/book/<int:book_id>')
 @login_required
 def book_detail(book_id):
     """Display book details and provide download option."""
-    conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    conn.close()
+    book = books_repository.get(book_id)
     
     if book is None:
         abort(404)
     
-    return render_template('book_detail.html', book=book, t=get_translations(), lang_data=get_language_data(), can_add_book=can_add_books())
+    if book['preview_pages'] is None:
+        # Uploads that predate previews get them rendered in the background
+        schedule_preview(get_db_connection, storage, book_id, book['filename'])
+    preview_urls = [
+        url_for('serve_preview', filename=preview_filename(book_id, page))
+        for page in range(1, (book['preview_pages'] or 0) + 1)
+    ]
+    
+    # One indexed lookup; the lists are maintained when books are added or deleted
+    related_books = books_repository.related(book_id)
+    
+    usage_counters.record(book_id, 'views')
+    # Include this worker's hits that have not been flushed yet
+    pending_views, pending_downloads = usage_counters.pending(book_id)
+    view_count = book['view_count'] + pending_views
+    download_count = book['download_count'] + pending_downloads
+    
+    return render_template('book_detail.html', book=book, cover_url=book_cover_url(book), preview_urls=preview_urls, related_books=related_books, view_count=view_count, download_count=download_count, t=get_translations(), lang_data=get_language_data(), can_add_book=can_add_books())
 
-@app.route('/download/<int:book_id>')
+@route('/download/<int:book_id>')
 @login_required
 def download_book(book_id):
     """Download a book PDF file."""
-    conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    conn.close()
+    book = books_repository.get(book_id)
     
     if book is None:
         abort(404)
     
-    file_path = os.path.join(UPLOAD_FOLDER, book['filename'])
-    
-    if not os.path.exists(file_path):
+    response = send_book_pdf(book)
+    if response is None:
         flash(get_translations()['file_not_found'], 'error')
         return redirect(url_for('index'))
-    
-    return send_file(file_path, as_attachment=True, download_name=f"{book['title']}.pdf")
+    return response
+
+def send_book_pdf(book):
+    """Count a download and send the book's PDF, or return None if the file is missing."""
+    if not storage.exists('uploads', book['filename']):
+        return None
+    usage_counters.record(book['id'], 'downloads')
+    # Local storage streams the file; object storage redirects to a pre-signed URL
+    return storage.send('uploads', book['filename'], as_attachment=True, download_name=f"{book['title']}.pdf")
+
+def opds_feed_response(build_feed):
+    """Serve build_feed() as OPDS, answering 304 from the catalogue version alone."""
+    conn = get_db_connection()
+    try:
+        version, last_modified = catalogue_version(conn)
+    finally:
+        conn.close()
+    as_json = request.accept_mimetypes.best_match([ATOM_TYPE, OPDS2_TYPE]) == OPDS2_TYPE
+    etag = feed_etag(version, request.full_path, get_current_language(), as_json)
+
+    # The compression middleware suffixes the ETag per encoding; accept any variant back
+    matched = next((tag for tag in encoded_etags(etag) if request.if_none_match.contains(tag)), None)
+    if matched or (not request.if_none_match and request.if_modified_since
+                   and last_modified <= request.if_modified_since):
+        response = Response(status=304)
+        response.set_etag(matched or etag)
+    else:
+        feed = build_feed()
+        feed['updated'] = last_modified
+        if as_json:
+            response = Response(json.dumps(render_opds2(feed), ensure_ascii=False), mimetype=OPDS2_TYPE)
+        else:
+            feed_type = NAVIGATION_TYPE if feed['kind'] == 'navigation' else ACQUISITION_TYPE
+            # Entries are built up front; only rendering is streamed, so no request context is needed
+            response = Response(render_atom(feed), content_type=f'{feed_type};charset=utf-8')
+        response.set_etag(etag)
+    response.last_modified = last_modified
+    response.vary.add('Accept')
+    response.vary.add('Cookie')
+    # Readers revalidate on every poll; that costs a 304
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def opds_links(self_href, feed_type):
+    return [
+        {'rel': 'self', 'href': self_href, 'type': feed_type},
+        {'rel': 'start', 'href': url_for('opds_root'), 'type': NAVIGATION_TYPE},
+        {'rel': 'search', 'href': url_for('opds_search_description'), 'type': OPENSEARCH_TYPE},
+    ]
+
+def opds_acquisition_feed(feed_id, title, endpoint, endpoint_args, where_sql='1 = 1', params=()):
+    """One keyset-paginated page of books for an acquisition feed."""
+    t = get_translations()
+    category_titles = {section['key']: section['title'] for section in build_category_sections(t)}
+    after = decode_cursor(request.args.get('after'))
+    rows = books_repository.page(where_sql, params, after, OPDS_PAGE_SIZE + 1)
+    books, more = rows[:OPDS_PAGE_SIZE], len(rows) > OPDS_PAGE_SIZE
+    links = opds_links(url_for(endpoint, **endpoint_args, after=request.args.get('after')), ACQUISITION_TYPE)
+    if more:
+        links.append({'rel': 'next', 'href': url_for(endpoint, **endpoint_args, after=encode_cursor(books[-1])),
+                      'type': ACQUISITION_TYPE})
+    entries = []
+    for book in books:
+        cover_href = book_cover_url(book)
+        discipline = book['discipline'] or ''
+        entries.append(book_entry(
+            book,
+            detail_href=url_for('book_detail', book_id=book['id']),
+            download_href=url_for('opds_download', book_id=book['id']),
+            cover_href=cover_href,
+            cover_type=mimetypes.guess_type(cover_href)[0] if cover_href else None,
+            category=(discipline, category_titles[discipline]) if discipline in category_titles else None,
+        ))
+    return {'id': feed_id, 'title': title, 'kind': 'acquisition', 'links': links, 'entries': entries}
+
+@route('/opds')
+@opds_login_required
+def opds_root():
+    """OPDS navigation feed: recent books and one feed per discipline."""
+    def build():
+        t = get_translations()
+        entries = [{'id': 'urn:library:opds:new', 'title': t['recently_added_books'], 'summary': '',
+                    'href': url_for('opds_new')}]
+        for section in build_category_sections(t):
+            entries.append({'id': f"urn:library:opds:discipline:{section['key']}", 'title': section['title'],
+                            'summary': section['description'],
+                            'href': url_for('opds_discipline', discipline=section['key'])})
+        return {'id': 'urn:library:opds', 'title': t['app_name'], 'kind': 'navigation',
+                'links': opds_links(url_for('opds_root'), NAVIGATION_TYPE), 'entries': entries}
+    return opds_feed_response(build)
+
+@route('/opds/new')
+@opds_login_required
+def opds_new():
+    """OPDS acquisition feed of all books, newest first."""
+    return opds_feed_response(lambda: opds_acquisition_feed(
+        'urn:library:opds:new', get_translations()['recently_added_books'], 'opds_new', {}))
+
+@route('/opds/disciplines/<discipline>')
+@opds_login_required
+def opds_discipline(discipline):
+    """OPDS acquisition feed of one discipline's books, newest first."""
+    sections = {section['key']: section for section in build_category_sections(get_translations())}
+    if discipline not in sections:
+        abort(404)
+    return opds_feed_response(lambda: opds_acquisition_feed(
+        f'urn:library:opds:discipline:{discipline}', sections[discipline]['title'],
+        'opds_discipline', {'discipline': discipline}, 'discipline = ?', [discipline]))
 
-@app.route('/uploads/<path:filename>')
+@route('/opds/search')
+@opds_login_required
+def opds_search():
+    """OPDS acquisition feed of books whose title or author matches ?q=."""
+    query = request.args.get('q', '').strip()
+    if not query:
+        abort(400)
+    match_sql, match_params = books_repository.match_clause(query)
+    return opds_feed_response(lambda: opds_acquisition_feed(
+        f'urn:library:opds:search:{query}', f"{get_translations()['search_results']}: {query}",
+        'opds_search', {'q': query}, match_sql, match_params))
+
+@route('/opds/search.xml')
+def opds_search_description():
+    """OpenSearch description telling e-readers how to search the catalogue."""
+    template = url_for('opds_search', q='SEARCH_TERMS').replace('SEARCH_TERMS', '{searchTerms}')
+    return Response(opensearch_description(get_translations()['app_name'], template), mimetype=OPENSEARCH_TYPE)
+
+@route('/opds/books/<int:book_id>/download')
+@opds_login_required
+def opds_download(book_id):
+    """Acquisition link for e-readers: the PDF, or 404 (no HTML redirects)."""
+    book = books_repository.get(book_id)
+    response = send_book_pdf(book) if book is not None else None
+    if response is None:
+        abort(404)
+    return response
+
+def describe_change(entity, row):
+    """The record /changes sends for the current row of a changed book or curated book."""
+    if entity == 'book':
+        return {
+            'title': row['title'],
+            'author': row['author'],
+            'description': row['description'],
+            'discipline': row['discipline'],
+            'publication_year': row['publication_year'],
+            'upload_date': atom_date(row['upload_date']),
+            'cover_url': book_cover_url(row),
+            'download_url': url_for('opds_download', book_id=row['id']),
+        }
+    return {
+        'category_key': row['category_key'],
+        'title': row['title'],
+        'author': row['author'],
+        'source': row['source'],
+        'cover_url': url_for('serve_cover', filename=row['cover_filename']),
+    }
+
+@route('/changes')
+@opds_login_required
+def catalogue_changes():
+    """Catalogue changes after a cursor, for clients that keep their own copy (see changes.py)."""
+    try:
+        since = parse_since(request.args.get('since'))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    limit = max(1, min(request.args.get('limit', CHANGES_PAGE_SIZE, type=int), CHANGES_PAGE_SIZE))
+    conn = get_db_connection()
+    try:
+        body = read_changes(conn, since, describe_change, limit)
+    finally:
+        conn.close()
+    response = jsonify(body)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@route('/uploads/<path:filename>')
 @login_required
 def serve_upload(filename):
     """Serve uploaded files (images)."""
     safe_name = secure_filename(filename)
-    return send_from_directory(UPLOAD_FOLDER, safe_name, conditional=True)
+    return storage.send('uploads', safe_name)
 
-@app.route('/covers/<path:filename>')
+@route('/covers/<path:filename>')
 def serve_cover(filename):
-    """Serve book cover images from static/covers directory.
+    """Serve book cover images from storage.
     No login required - covers should be publicly viewable.
     """
     safe_name = secure_filename(filename)
-    cover_path = os.path.join('static/covers', safe_name)
-    if os.path.exists(cover_path):
-        return send_from_directory('static/covers', safe_name, conditional=True)
-    else:
-        # Return a placeholder or 404
-        abort(404)
+    # Missing files are a 404 locally, and from the bucket behind the redirect
+    return storage.send('covers', safe_name)
+
+@route('/previews/<path:filename>')
+def serve_preview(filename):
+    """Serve rendered first-page previews; public like covers."""
+    return storage.send('previews', secure_filename(filename))
 
-@app.route('/search')
+def build_search_facets(counts, filters, query, mode, translations, sort='newest'):
+    """Attach labels, selection state and click-to-filter URLs to facet counts."""
+    discipline_labels = {option['key']: option['label'] for option in build_discipline_options(translations)}
+    facets = []
+    for name, values in counts.items():
+        entries = []
+        for value, count in values:
+            selected = filters.get(name) == value
+            # Clicking a selected value clears it; any other value replaces it
+            target = {key: val for key, val in filters.items() if key != name}
+            if not selected:
+                target[name] = value
+            if name == 'discipline':
+                label = discipline_labels.get(value, value)
+            elif name == 'decade':
+                label = f'{value}s'
+            else:
+                label = value
+            entries.append({
+                'value': value,
+                'label': label,
+                'count': count,
+                'selected': selected,
+                'url': url_for('search', q=query or None, mode=mode if mode != 'auto' else None,
+                               sort=sort if sort != 'newest' else None, **target)
+            })
+        facets.append({'name': name, 'title': translations[f'facet_{name}'], 'values': entries})
+    return facets
+
+@route('/search')
 def search():
-    """Search books by title or author."""
+    """Search books by title or author, with discipline/author/decade facets.
+
+    mode=auto (default) falls back to typo-tolerant matching when the exact
+    search finds nothing, mode=blend appends fuzzy matches to exact ones and
+    mode=exact disables fuzzy matching. Facet filters alone (no q) browse
+    the catalogue. sort= orders the exact matches as on the listings; fuzzy
+    matches follow in order of similarity.
+    """
+    t = get_translations()
     query = request.args.get('q', '').strip()
+    mode = request.args.get('mode', 'auto')
+    sort = book_sort_order()
+    filters = parse_facet_filters(request.args, {section['key'] for section in CATEGORY_SECTIONS})
     
-    if not query:
+    if not query and not filters:
         return redirect(url_for('index'))
     
+    filter_sql, filter_params = filter_clause(filters)
+    match_sql, match_params = None, []
+    if query:
+        match_sql, match_params = books_repository.match_clause(query)
+    
+    books = books_repository.search(match_sql, match_params, filter_sql, filter_params, sort, get_current_language())
+    
+    fuzzy_matches = False
+    if query and (mode == 'blend' or (mode == 'auto' and not books)):
+        fuzzy_index.sync(get_db_connection)
+        seen_ids = {book['id'] for book in books}
+        fuzzy_ids = [book_id for book_id in fuzzy_index.search(query, FUZZY_SEARCH_LIMIT) if book_id not in seen_ids]
+        if fuzzy_ids:
+            placeholders = ','.join('?' * len(fuzzy_ids))
+            rows = books_repository.by_ids(fuzzy_ids, filter_sql, filter_params)
+            rows_by_id = {row['id']: row for row in rows}
+            # Keep the similarity order from the index
+            books = books + [rows_by_id[book_id] for book_id in fuzzy_ids if book_id in rows_by_id]
+            fuzzy_matches = True
+            # Facets describe what is shown, so count over the fuzzy matches too
+            fuzzy_sql = f'id IN ({placeholders})'
+            if seen_ids:
+                match_sql, match_params = f'{match_sql} OR {fuzzy_sql}', match_params + fuzzy_ids
+            else:
+                match_sql, match_params = fuzzy_sql, fuzzy_ids
+    
     conn = get_db_connection()
-    books = conn.execute(
-        'SELECT * FROM books WHERE title LIKE ? OR author LIKE ? ORDER BY upload_date DESC',
-        (f'%{query}%', f'%{query}%')
-    ).fetchall()
+    counts = facet_counts(conn, match_sql, match_params, filters)
     conn.close()
     
-    return render_template('search_results.html', books=books, query=query, t=get_translations(), lang_data=get_language_data(), can_add_book=can_add_books())
+    return render_template(
+        'search_results.html',
+        books=books,
+        query=query,
+        fuzzy_matches=fuzzy_matches,
+        facets=build_search_facets(counts, filters, query, mode, t, sort),
+        active_filters=filters,
+        clear_filters_url=url_for('search', q=query) if query else url_for('index'),
+        sort=sort,
+        sort_options=list(BOOK_ORDERINGS),
+        t=t,
+        lang_data=get_language_data(),
+        can_add_book=can_add_books()
+    )
+
+@route('/healthz')
+def healthz():
+    """Liveness probe for load balancers and load tests: answers without touching the database."""
+    return Response('ok', mimetype='text/plain', headers={'Cache-Control': 'no-store'})
+
+@route('/autocomplete')
+def autocomplete():
+    """Suggest books whose title or author starts with the typed text."""
+    query = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', 8, type=int), AUTOCOMPLETE_MAX_RESULTS)
+    
+    typeahead_index.sync(get_db_connection)
+    suggestions = typeahead_index.suggest(query, limit)
+    for suggestion in suggestions:
+        suggestion['url'] = url_for('book_detail', book_id=suggestion['id'])
+    
+    return jsonify({'query': query, 'suggestions': suggestions})
 
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     """Login page for users to enter their name and email or sign in with Google."""
     t = get_translations()
@@ -866,18 +2168,18 @@ def login():
         flash(f'{t["welcome_back"]} {first_name} {last_name}!', 'success')
         return redirect(url_for('index'))
 
-@app.route('/login/google')
+@route('/login/google')
 def google_login():
     """Initiate Google OAuth login flow."""
     redirect_uri = url_for('google_auth', _external=True)
-    return oauth.google.authorize_redirect(redirect_uri)
+    return get_oauth().google.authorize_redirect(redirect_uri)
 
-@app.route('/auth/google')
+@route('/auth/google')
 def google_auth():
     """Handle Google OAuth callback."""
     t = get_translations()
     try:
-        token = oauth.google.authorize_access_token()
+        token = get_oauth().google.authorize_access_token()
         user_info = token.get('userinfo')
         
         if not user_info:
@@ -912,7 +2214,7 @@ def google_auth():
         flash(f'{t["login_failed"]}: {str(e)}', 'error')
         return redirect(url_for('login'))
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     """Logout user and clear session."""
     t = get_translations()
@@ -926,7 +2228,7 @@ def logout():
     
     return redirect(url_for('index'))
 
-@app.route('/delete/<int:book_id>', methods=['POST'])
+@route('/delete/<int:book_id>', methods=['POST'])
 @login_required
 def delete_book(book_id):
     """Delete a book from the library and remove its file."""
@@ -937,46 +2239,44 @@ def delete_book(book_id):
         flash(t['please_log_in'], 'error')
         return redirect(url_for('index'))
     
-    conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
+    book = books_repository.get(book_id)
     
     if book is None:
-        conn.close()
         abort(404)
     
     # Get the filename before deleting from database
     filename = book['filename']
-    file_path = os.path.join(UPLOAD_FOLDER, filename)
     
     # Delete from database
-    conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
-    conn.commit()
-    conn.close()
+    books_repository.delete(book_id)
+    unindex_book(book_id)
+    card_cache.invalidate(book_id)
+    duplicate_detector.remove(book_id)
+    passage_index.remove(book_id)
+    related_index.schedule_remove(get_db_connection, book_id)
     
     # Delete the file if it exists
-    if os.path.exists(file_path):
-        try:
-            os.remove(file_path)
+    try:
+        if storage.delete('uploads', filename):
             flash(t['book_deleted_successfully'], 'success')
-        except Exception as e:
-            flash(f'{t["error_deleting_file"]}: {str(e)}', 'error')
-    else:
-        flash(t['book_deleted_from_database'], 'warning')
+        else:
+            flash(t['book_deleted_from_database'], 'warning')
+    except Exception as e:
+        flash(f'{t["error_deleting_file"]}: {str(e)}', 'error')
+
+    delete_previews(storage, book_id)
 
     # Delete image file if it exists
     image_filename = book['image_filename'] if book['image_filename'] else None
     if image_filename:
-        # Covers are stored in static/covers, not UPLOAD_FOLDER
-        image_path = os.path.join('static/covers', image_filename)
-        if os.path.exists(image_path):
-            try:
-                os.remove(image_path)
-            except Exception:
-                pass
+        try:
+            storage.delete('covers', image_filename)
+        except Exception:
+            pass
     
     return redirect(url_for('index'))
 
-@app.route('/ai_search', methods=['GET', 'POST'])
+@route('/ai_search', methods=['GET', 'POST'])
 def ai_search():
     """AI-powered search page using OpenAI ChatGPT API."""
     t = get_translations()
@@ -1059,15 +2359,14 @@ def ai_search():
                     enhanced_query += "\n- Include full book descriptions in search"
             
             # Make API call to OpenAI
-            response = openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": enhanced_query}
-                ],
-                max_tokens=500,
-                temperature=0.7
-            )
+            with openai_limiter.slot(ai_user_key()):
+                response = create_chat_completion(
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": enhanced_query}
+                    ],
+                    max_tokens=500
+                )
             
             ai_response = response.choices[0].message.content
             
@@ -1082,6 +2381,10 @@ def ai_search():
                                  user_logged_in=session.get('logged_in', False),
                                  t=t, lang_data=get_language_data())
             
+        except LimitExceeded as e:
+            flash(ai_limit_message(e, t), 'error')
+            status, headers = ai_limit_headers(e)
+            return render_template('ai_search.html', query=query, t=t, lang_data=get_language_data()), status, headers
         except Exception as e:
             flash(f'{t["error_getting_ai_response"]}: {str(e)}', 'error')
             return render_template('ai_search.html', query=query, t=t, lang_data=get_language_data())
@@ -1090,7 +2393,7 @@ def ai_search():
                          user_logged_in=session.get('logged_in', False),
                          t=t, lang_data=get_language_data())
 
-@app.route('/ai_search_api', methods=['POST'])
+@route('/ai_search_api', methods=['POST'])
 def ai_search_api():
     """API endpoint for AJAX AI search requests."""
     try:
@@ -1126,15 +2429,14 @@ def ai_search_api():
         Keep responses concise but informative."""
         
         # Make API call to OpenAI
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": query}
-            ],
-            max_tokens=500,
-            temperature=0.7
-        )
+        with openai_limiter.slot(ai_user_key()):
+            response = create_chat_completion(
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": query}
+                ],
+                max_tokens=500
+            )
         
         ai_response = response.choices[0].message.content
         
@@ -1144,10 +2446,14 @@ def ai_search_api():
             'response': ai_response
         })
         
+    except LimitExceeded as e:
+        status, headers = ai_limit_headers(e)
+        return jsonify({'error': ai_limit_message(e, get_translations()), 'reason': e.reason,
+                        'retry_after': e.retry_after}), status, headers
     except Exception as e:
         return jsonify({'error': f'Error getting AI response: {str(e)}'}), 500
 
-@app.route('/books')
+@route('/books')
 @login_required
 def books():
     """Books page - displays all books and curated category lists."""
@@ -1155,161 +2461,309 @@ def books():
     lang_data = get_language_data()
     can_add = can_add_books()
     active_category = request.args.get('category', '').strip()
+    sort = book_sort_order()
+    language = get_current_language()
     
+    # Rows are read while the page renders (one query per section), so
+    # the page streams in constant memory
+    books = books_repository.stream_ordered(sort, language=language)
     conn = get_db_connection()
-    books = conn.execute('SELECT * FROM books ORDER BY upload_date DESC').fetchall()
+    # Catalogue-wide counts come from the trigger-maintained table, no scan needed
+    facets = build_search_facets(facet_counts(conn), {}, '', 'auto', t)
     conn.close()
     
     category_sections = build_category_sections(t)
-    category_books_map = {section['key']: [] for section in CATEGORY_SECTIONS}
-    for book in books:
-        discipline_key = (book['discipline'] or '').strip()
-        if discipline_key in category_books_map:
-            category_books_map[discipline_key].append(book)
+    category_books_map = {section['key']: books_repository.stream_ordered(sort, section['key'], language)
+                          for section in CATEGORY_SECTIONS}
 
     if active_category:
         display_sections = [section for section in category_sections if section['key'] == active_category]
     else:
         display_sections = category_sections
     
-    return render_template(
+    return stream_page(
         'books.html',
         books=books,
         category_sections=display_sections,
         category_books_map=category_books_map,
         active_category=active_category,
+        facets=facets,
+        sort=sort,
+        sort_options=list(BOOK_ORDERINGS),
         t=t,
         lang_data=lang_data,
         can_add_book=can_add
     )
 
-@app.route('/articles')
+@route('/articles')
 @login_required
 def articles():
     """Articles page - placeholder for articles functionality."""
     return render_template('articles.html', t=get_translations(), lang_data=get_language_data())
 
-@app.route('/digital_repositories')
+@route('/digital_repositories')
 @login_required
 def digital_repositories():
     """Digital Repositories page - placeholder for digital repositories functionality."""
     return render_template('digital_repositories.html', t=get_translations(), lang_data=get_language_data())
 
-@app.route('/open_access_websites')
+@route('/open_access_websites')
 @login_required
 def open_access_websites():
     """Open Access Websites page - placeholder for open access websites functionality."""
     return render_template('open_access_websites.html', t=get_translations(), lang_data=get_language_data())
 
-@app.route('/generate_abstract/<int:book_id>', methods=['POST'])
-@login_required
-def generate_abstract(book_id):
-    """Generate an abstract for a book using AI."""
+def build_abstract(book, language):
+    """Ask the model for an abstract of a book; runs on the job pool."""
+    language_instruction = "in Arabic" if language == 'ar' else "in English"
+    
+    system_prompt = f"""You are an AI assistant that creates concise, informative abstracts for books. 
+    Generate a well-structured abstract {language_instruction} that summarizes the main themes, key points, and value of the book.
+    The abstract should be professional, clear, and between 150-300 words.
+    Focus on the book's main content, themes, and significance."""
+    
+    user_prompt = f"""Please create an abstract for the following book:
+    
+    Title: {book['title']}
+    Author: {book['author']}
+    Description: {book['description'] if book['description'] else 'No description available'}
+    
+    Generate a comprehensive abstract that captures the essence of this book."""
+    
+    # Make API call to OpenAI
+    response = create_chat_completion(
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        max_tokens=400
+    )
+    
+    return {
+        'abstract': response.choices[0].message.content,
+        'book_title': book['title'],
+        'book_author': book['author']
+    }
+
+def build_annotation(book, language):
+    """Ask the model for annotations of a book; runs on the job pool."""
+    language_instruction = "in Arabic" if language == 'ar' else "in English"
+    
+    system_prompt = f"""You are an AI assistant that creates detailed annotations and marginal notes for books. 
+    Generate comprehensive annotations {language_instruction} that provide insights, explanations, and commentary on the book's content.
+    The annotations should be educational, insightful, and help readers understand key concepts, themes, and important details.
+    Focus on providing valuable context, explanations of complex ideas, and connections to broader themes.
+    Format the annotations as a structured list with clear headings and bullet points."""
+    
+    user_prompt = f"""Please create detailed annotations for the following book:
+    
+    Title: {book['title']}
+    Author: {book['author']}
+    Description: {book['description'] if book['description'] else 'No description available'}
+    
+    Generate comprehensive annotations that would help readers understand and appreciate this book better.
+    Include insights about themes, important concepts, historical context, and any other relevant information."""
+    
+    # Make API call to OpenAI
+    response = create_chat_completion(
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        max_tokens=600
+    )
+    
+    return {
+        'annotation': response.choices[0].message.content,
+        'book_title': book['title'],
+        'book_author': book['author']
+    }
+
+def build_question_prompt(book, passages, question, language):
+    """Messages asking the model to answer a question from passages of a book only."""
+    language_instruction = "in Arabic" if language == 'ar' else "in English"
+    excerpts = "\n\n".join(f"[Page {passage['page']}]\n{passage['content']}" for passage in passages)
+    
+    system_prompt = f"""You are an AI assistant that answers questions about the book "{book['title']}" by {book['author']}.
+    Answer {language_instruction}, using only the excerpts from the book that the user provides.
+    Cite the pages you rely on as (p. N).
+    If the excerpts do not contain the answer, say that the passages of the book you were given do not cover it instead of guessing."""
+    
+    user_prompt = f"""Excerpts from the book:
+
+{excerpts}
+
+Question: {question}"""
+    
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+# Generation kinds accepted by the job queue: builder and translated error key
+GENERATION_JOBS = {
+    'abstract': (build_abstract, 'error_generating_abstract'),
+    'annotation': (build_annotation, 'error_generating_annotation'),
+}
+
+def queue_generation(kind, book_id):
+    """Queue an AI generation for a book and answer 202 with the job id."""
     t = get_translations()
+    builder, error_key = GENERATION_JOBS[kind]
     try:
-        # Get book information
-        conn = get_db_connection()
-        book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-        conn.close()
+        book = books_repository.get(book_id)
         
         if book is None:
             return jsonify({'error': 'Book not found'}), 404
         
-        # Create prompt for abstract generation
-        current_lang = get_current_language()
-        language_instruction = "in Arabic" if current_lang == 'ar' else "in English"
-        
-        system_prompt = f"""You are an AI assistant that creates concise, informative abstracts for books. 
-        Generate a well-structured abstract {language_instruction} that summarizes the main themes, key points, and value of the book.
-        The abstract should be professional, clear, and between 150-300 words.
-        Focus on the book's main content, themes, and significance."""
-        
-        user_prompt = f"""Please create an abstract for the following book:
-        
-        Title: {book['title']}
-        Author: {book['author']}
-        Description: {book['description'] if book['description'] else 'No description available'}
-        
-        Generate a comprehensive abstract that captures the essence of this book."""
-        
-        # Make API call to OpenAI
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=400,
-            temperature=0.7
-        )
-        
-        abstract = response.choices[0].message.content
+        # Admit the call now, so an overloaded site says so instead of queueing;
+        # the slot is held until the job finishes (or the lease expires)
+        try:
+            lease_id = openai_limiter.acquire(ai_user_key(), lease_seconds=STALE_JOB_SECONDS)
+        except LimitExceeded as e:
+            status, headers = ai_limit_headers(e)
+            return jsonify({'error': ai_limit_message(e, t), 'reason': e.reason,
+                            'retry_after': e.retry_after}), status, headers
         
+        # The job runs outside the request, so capture everything it needs now
+        book = dict(book)
+        language = get_current_language()
+        trace_parent = tracing.current_span()
+        def run_generation():
+            try:
+                with tracing.start_span(f'job {kind}', attributes={'book.id': book_id}, parent=trace_parent):
+                    return builder(book, language)
+            finally:
+                openai_limiter.release(lease_id)
+        try:
+            job_id, created = submit_job(get_db_connection, kind, book_id, language, run_generation,
+                                         cancel=lambda: openai_limiter.release(lease_id, refund=True))
+        except Exception:
+            openai_limiter.release(lease_id, refund=True)
+            raise
+        if not created:
+            # Joined an identical job already in flight: nothing new to admit
+            openai_limiter.release(lease_id, refund=True)
+        status_url = url_for('job_status', job_id=job_id)
         return jsonify({
             'success': True,
-            'abstract': abstract,
-            'book_title': book['title'],
-            'book_author': book['author']
-        })
+            'job_id': job_id,
+            'status': 'queued',
+            'status_url': status_url
+        }), 202, {'Location': status_url}
         
     except Exception as e:
-        return jsonify({'error': f'{t["error_generating_abstract"]}: {str(e)}'}), 500
+        return jsonify({'error': f'{t[error_key]}: {str(e)}'}), 500
 
-@app.route('/generate_annotation/<int:book_id>', methods=['POST'])
+@route('/generate_abstract/<int:book_id>', methods=['POST'])
+@login_required
+def generate_abstract(book_id):
+    """Queue generation of an abstract for a book using AI."""
+    return queue_generation('abstract', book_id)
+
+@route('/generate_annotation/<int:book_id>', methods=['POST'])
 @login_required
 def generate_annotation(book_id):
-    """Generate annotations for a book using AI."""
+    """Queue generation of annotations for a book using AI."""
+    return queue_generation('annotation', book_id)
+
+@route('/ask_book/<int:book_id>', methods=['POST'])
+@login_required
+def ask_book(book_id):
+    """Answer a question about a book from the most relevant passages of its text."""
     t = get_translations()
+    data = request.get_json(silent=True) or request.form
+    question = (data.get('question') or '').strip()[:QA_MAX_QUESTION_CHARS]
+    if not question:
+        return jsonify({'error': t['enter_question']}), 400
     try:
-        # Get book information
-        conn = get_db_connection()
-        book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-        conn.close()
+        book = books_repository.get(book_id)
         
         if book is None:
             return jsonify({'error': 'Book not found'}), 404
         
-        # Create prompt for annotation generation
-        current_lang = get_current_language()
-        language_instruction = "in Arabic" if current_lang == 'ar' else "in English"
-        
-        system_prompt = f"""You are an AI assistant that creates detailed annotations and marginal notes for books. 
-        Generate comprehensive annotations {language_instruction} that provide insights, explanations, and commentary on the book's content.
-        The annotations should be educational, insightful, and help readers understand key concepts, themes, and important details.
-        Focus on providing valuable context, explanations of complex ideas, and connections to broader themes.
-        Format the annotations as a structured list with clear headings and bullet points."""
-        
-        user_prompt = f"""Please create detailed annotations for the following book:
+        if book['passage_count'] is None:
+            # Without PyMuPDF no book is ever indexed, so retrying cannot help
+            if not passages_available():
+                return jsonify({'error': t['book_text_unavailable']}), 422
+            # Books added before passages existed are indexed on first use;
+            # False here means this worker has it queued already
+            passage_index.schedule(storage, book_id, book['filename'])
+            return jsonify({'error': t['book_text_not_ready'], 'status': 'indexing'}), 503, {'Retry-After': '10'}
+        if not book['passage_count']:
+            return jsonify({'error': t['book_text_unavailable']}), 422
         
-        Title: {book['title']}
-        Author: {book['author']}
-        Description: {book['description'] if book['description'] else 'No description available'}
-        
-        Generate comprehensive annotations that would help readers understand and appreciate this book better.
-        Include insights about themes, important concepts, historical context, and any other relevant information."""
-        
-        # Make API call to OpenAI
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=600,
-            temperature=0.7
-        )
-        
-        annotation = response.choices[0].message.content
+        # A fixed token budget of the best passages, however long the book is
+        passages = passage_index.context(book_id, question)
+        with openai_limiter.slot(ai_user_key()):
+            response = create_chat_completion(
+                messages=build_question_prompt(book, passages, question, get_current_language()),
+                max_tokens=QA_ANSWER_TOKENS,
+                temperature=0.2
+            )
         
         return jsonify({
             'success': True,
-            'annotation': annotation,
-            'book_title': book['title'],
-            'book_author': book['author']
+            'question': question,
+            'answer': response.choices[0].message.content,
+            'pages': sorted({passage['page'] for passage in passages})
         })
         
+    except LimitExceeded as e:
+        status, headers = ai_limit_headers(e)
+        return jsonify({'error': ai_limit_message(e, t), 'reason': e.reason,
+                        'retry_after': e.retry_after}), status, headers
     except Exception as e:
-        return jsonify({'error': f'{t["error_generating_annotation"]}: {str(e)}'}), 500
+        return jsonify({'error': f"{t['error_answering_question']}: {str(e)}"}), 500
+
+@route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    """Report the status of a queued AI generation, with its result once done."""
+    job = get_job(get_db_connection, job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if job['status'] == 'done':
+        return jsonify({'success': True, 'job_id': job_id, 'status': 'done', **job['result']})
+    if job['status'] == 'failed':
+        t = get_translations()
+        error_key = GENERATION_JOBS.get(job['kind'], (None, 'error_getting_ai_response'))[1]
+        return jsonify({'success': False, 'job_id': job_id, 'status': 'failed',
+                        'error': f'{t[error_key]}: {job["error"]}'})
+    # Still queued or running: tell the client when to poll again
+    return jsonify({'success': True, 'job_id': job_id, 'status': job['status']}), 200, {'Retry-After': '2'}
+
+@route('/admin/backups', methods=['GET', 'POST'])
+@login_required
+def admin_backups():
+    """List finished backups, or start a new one in the background (POST)."""
+    if not can_add_books():
+        return jsonify({'error': get_translations()['please_log_in']}), 403
+    if request.method == 'POST':
+        try:
+            name = schedule_backup(database, storage, full=request.args.get('full') == '1')
+        except BackupInProgress:
+            return jsonify({'error': 'A backup is already running'}), 409
+        return jsonify({'archive': name, 'status': 'started',
+                        'url': url_for('download_backup', name=name)}), 202
+    return jsonify({'backups': [backup['report'] for backup in list_backups()],
+                    'failed': [failure['report'] for failure in list_failed_backups()],
+                    'running': backup_running()})
+
+@route('/admin/backups/<name>')
+@login_required
+def download_backup(name):
+    """Download a finished backup archive."""
+    if not can_add_books():
+        abort(403)
+    name = secure_filename(name)
+    if not name.endswith('.tar') or not os.path.exists(os.path.join(BACKUP_FOLDER, f'{name}.json')):
+        abort(404)
+    return send_from_directory(os.path.abspath(BACKUP_FOLDER), name, as_attachment=True)
+
+# Module-level instance for `gunicorn app:app` and `python app.py`
+app = create_app()
 
 if __name__ == '__main__':
     init_database()
@@ -0,0 +1,363 @@
+"""
+Online backups of the library: the database plus uploaded PDFs and covers.
+
+The SQLite database is copied with the online backup API, BACKUP_PAGES_PER_STEP
+pages at a time with a short pause between steps. Each step holds the read
+lock only briefly, so requests keep reading and writing while the copy runs,
+and the copy is a consistent snapshot (SQLite restarts it if a write lands
+mid-way). On PostgreSQL the database is left to pg_dump or the server's own
+backups; only the files are archived.
+
+Files are listed after the database snapshot and written to one tar archive:
+
+  manifest.json          every file at snapshot time: size, mtime, sha256 and
+                         the archive holding its bytes
+  library.db             the database snapshot (SQLite only)
+  files/<area>/<name>    only files that are new or changed since the base backup
+
+Backups are incremental: a file whose size and mtime match the previous
+manifest is not copied again, its entry points at the older archive. Restoring
+therefore needs the chosen archive plus the ones its manifest refers to, all in
+BACKUP_FOLDER. Each archive has a <name>.json sidecar with its manifest and a
+report (durations, bytes, and the longest single database step, which bounds
+how long a writer could have waited on the backup). A scheduled backup that
+fails leaves a <name>.failed.json sidecar with the error instead.
+"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import sqlite3
+import tarfile
+import hashlib
+import logging
+import tempfile
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+BACKUP_FOLDER = os.getenv('BACKUP_FOLDER', 'backups')
+BACKUP_AREAS = ('uploads', 'covers')   # previews are re-rendered, not backed up
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.005              # seconds given back to requests between steps
+BACKUP_MAX_RESTARTS = 3                # then finish in one step (see snapshot_sqlite)
+COPY_BUFFER_SIZE = 1024 * 1024
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+log = logging.getLogger(__name__)
+
+
+class BackupInProgress(Exception):
+    """Another backup holds the lock on BACKUP_FOLDER."""
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _get_executor():
+    """One thread per process; a second backup would only contend for the lock."""
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='backup')
+                _executor_pid = os.getpid()
+    return _executor
+
+
+class _HashingReader:
+    """File wrapper that hashes what tarfile reads, so each blob is read once."""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        block = self.handle.read(size)
+        self.digest.update(block)
+        return block
+
+
+def new_backup_name():
+    now = datetime.now(timezone.utc)
+    # Milliseconds keep back-to-back backups apart; names sort by time
+    return now.strftime('library-%Y%m%d-%H%M%S') + f'-{now.microsecond // 1000:03d}.tar'
+
+
+def list_backups(folder=BACKUP_FOLDER):
+    """Sidecars of the finished backups, newest first."""
+    try:
+        names = sorted((name for name in os.listdir(folder) if name.endswith('.tar.json')), reverse=True)
+    except FileNotFoundError:
+        return []
+    backups = []
+    for name in names:
+        with open(os.path.join(folder, name), encoding='utf-8') as handle:
+            backups.append(json.load(handle))
+    return backups
+
+
+def list_failed_backups(folder=BACKUP_FOLDER):
+    """Reports of the scheduled backups that failed, newest first."""
+    try:
+        names = sorted((name for name in os.listdir(folder) if name.endswith('.tar.failed.json')), reverse=True)
+    except FileNotFoundError:
+        return []
+    failures = []
+    for name in names:
+        with open(os.path.join(folder, name), encoding='utf-8') as handle:
+            failures.append(json.load(handle))
+    return failures
+
+
+def backup_running(folder=BACKUP_FOLDER):
+    """Return True if some process currently holds the backup lock."""
+    try:
+        lock = open(os.path.join(folder, '.lock'), 'r')
+    except FileNotFoundError:
+        return False
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        return False
+
+
+def snapshot_sqlite(source_path, target_path, pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE):
+    """Copy a live SQLite database in small steps; returns step statistics.
+
+    A write by another connection between steps makes SQLite start the copy
+    over. When that happens more than BACKUP_MAX_RESTARTS times the copy is
+    finished in a single step instead: one read transaction, which in WAL
+    mode (see init_database()) does not hold up writers either.
+    """
+    steps = []
+    step_started = [time.perf_counter()]
+    state = {'remaining': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        steps.append(time.perf_counter() - step_started[0])
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > BACKUP_MAX_RESTARTS:
+                raise _TooManyRestarts()
+        state['remaining'] = remaining
+        time.sleep(pause)
+        step_started[0] = time.perf_counter()
+
+    started = time.perf_counter()
+    source = sqlite3.connect(source_path, timeout=30)
+    target = sqlite3.connect(target_path)
+    mode = 'incremental'
+    try:
+        try:
+            source.backup(target, pages=pages, progress=progress)
+        except _TooManyRestarts:
+            mode = 'single-step'
+            step_started[0] = time.perf_counter()
+            source.backup(target, pages=-1)
+            steps.append(time.perf_counter() - step_started[0])
+        page_count = target.execute('PRAGMA page_count').fetchone()[0]
+    finally:
+        target.close()
+        source.close()
+    return {
+        'mode': mode,
+        'pages': page_count,
+        'steps': len(steps),
+        'restarts': state['restarts'],
+        'max_step_ms': round(max(steps, default=0) * 1000, 2),
+        'mean_step_ms': round(sum(steps) / len(steps) * 1000, 2) if steps else 0,
+        'duration_seconds': round(time.perf_counter() - started, 3),
+        'bytes': os.path.getsize(target_path),
+    }
+
+
+def _lock_backups(folder):
+    """Open and lock BACKUP_FOLDER's lock file; raises BackupInProgress if it is taken."""
+    os.makedirs(folder, exist_ok=True)
+    lock = open(os.path.join(folder, '.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        raise BackupInProgress('A backup is already running')
+    return lock
+
+
+def run_backup(database, storage, folder=BACKUP_FOLDER, name=None, full=False, areas=BACKUP_AREAS, lock=None):
+    """Write one backup archive and its sidecar; returns the report.
+
+    Raises BackupInProgress if another process is already backing up. lock
+    is a lock taken beforehand with _lock_backups(); it is released here.
+    """
+    with lock or _lock_backups(folder):
+        return _run_backup(database, storage, folder, name or new_backup_name(), full, areas)
+
+
+def _run_backup(database, storage, folder, name, full, areas):
+    started = time.perf_counter()
+    previous = [] if full else list_backups(folder)
+    base = previous[0] if previous else None
+    base_files = base['manifest']['files'] if base else {}
+    archive_path = os.path.join(folder, name)
+    workdir = tempfile.mkdtemp(prefix='library-backup-', dir=folder)
+    try:
+        database_report = None
+        if database.dialect == 'sqlite':
+            snapshot_path = os.path.join(workdir, 'library.db')
+            database_report = snapshot_sqlite(database.sqlite_path, snapshot_path)
+
+        files, included, included_bytes = {}, 0, 0
+        # Sequential tar: members are streamed straight to disk, never buffered
+        with tarfile.open(f'{archive_path}.tmp', 'w|') as tar:
+            if database_report is not None:
+                tar.add(snapshot_path, arcname='library.db')
+            for area in areas:
+                for filename, size, mtime in storage.list_files(area):
+                    key = f'{area}/{filename}'
+                    known = base_files.get(key)
+                    if known and known['size'] == size and known['mtime'] == mtime:
+                        files[key] = known
+                        continue
+                    try:
+                        with storage.local_copy(area, filename) as path, open(path, 'rb') as handle:
+                            # Describe the open file: a replacement written meanwhile is not mixed in
+                            info = tar.gettarinfo(arcname=f'files/{key}', fileobj=handle)
+                            reader = _HashingReader(handle)
+                            tar.addfile(info, reader)
+                    except FileNotFoundError:
+                        continue  # deleted since it was listed
+                    files[key] = {'size': info.size, 'mtime': mtime, 'sha256': reader.digest.hexdigest(),
+                                  'archive': name}
+                    included += 1
+                    included_bytes += info.size
+            manifest = {'archive': name, 'base': base and base['report']['archive'],
+                        'database': database_report is not None, 'files': files}
+            manifest_path = os.path.join(workdir, 'manifest.json')
+            with open(manifest_path, 'w', encoding='utf-8') as handle:
+                json.dump(manifest, handle)
+            tar.add(manifest_path, arcname='manifest.json')
+        os.replace(f'{archive_path}.tmp', archive_path)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if os.path.exists(f'{archive_path}.tmp'):
+            os.remove(f'{archive_path}.tmp')
+
+    report = {
+        'archive': name,
+        'base': manifest['base'],
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'duration_seconds': round(time.perf_counter() - started, 3),
+        'database': database_report,
+        'files': {'total': len(files), 'included': included, 'unchanged': len(files) - included,
+                  'bytes_included': included_bytes},
+        'archive_bytes': os.path.getsize(archive_path),
+    }
+    # The sidecar is written last: its presence marks the archive as complete
+    sidecar = os.path.join(folder, f'{name}.json')
+    with open(f'{sidecar}.tmp', 'w', encoding='utf-8') as handle:
+        json.dump({'report': report, 'manifest': manifest}, handle)
+    os.replace(f'{sidecar}.tmp', sidecar)
+    return report
+
+
+def schedule_backup(database, storage, folder=BACKUP_FOLDER, full=False):
+    """Start a backup off the request path and return the archive name it will have.
+
+    The lock is taken before returning, so a second request (in any worker)
+    gets BackupInProgress rather than a name that never appears.
+    """
+    lock = _lock_backups(folder)
+    name = new_backup_name()
+    try:
+        future = _get_executor().submit(run_backup, database, storage, folder, name, full, lock=lock)
+    except BaseException:
+        lock.close()
+        raise
+    future.add_done_callback(lambda done: _record_failure(folder, name, done))
+    return name
+
+
+def _record_failure(folder, name, future):
+    """Log a scheduled backup's error and leave a failed-status sidecar for it."""
+    error = future.exception()
+    if error is None:
+        return
+    log.error('Backup %s failed', name, exc_info=error)
+    report = {'archive': name, 'status': 'failed', 'error': f'{type(error).__name__}: {error}',
+              'failed_at': datetime.now(timezone.utc).isoformat(timespec='seconds')}
+    sidecar = os.path.join(folder, f'{name}.failed.json')
+    try:
+        with open(f'{sidecar}.tmp', 'w', encoding='utf-8') as handle:
+            json.dump({'report': report}, handle)
+        os.replace(f'{sidecar}.tmp', sidecar)
+    except OSError:
+        log.exception('Could not record the failure of backup %s', name)
+
+
+def restore_backup(archive_path, database, storage, areas=BACKUP_AREAS):
+    """Restore the database and files recorded in an archive.
+
+    The app must be stopped: the database file is replaced underneath it.
+    Files already present with the recorded size are left alone. Returns
+    {'database': bool, 'restored': n, 'skipped': n}.
+    """
+    folder = os.path.dirname(os.path.abspath(archive_path))
+    with tarfile.open(archive_path) as tar:
+        manifest = json.load(tar.extractfile('manifest.json'))
+        restored_database = False
+        if manifest['database']:
+            if database.dialect != 'sqlite':
+                raise ValueError('This archive holds a SQLite database; DATABASE_URL points elsewhere')
+            staging = f'{database.sqlite_path}.restore'
+            with tar.extractfile('library.db') as source, open(staging, 'wb') as target:
+                shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+            check = sqlite3.connect(staging)
+            try:
+                if check.execute('PRAGMA integrity_check').fetchone()[0] != 'ok':
+                    raise ValueError('The database in the archive failed its integrity check')
+            finally:
+                check.close()
+            for suffix in ('-wal', '-shm', '-journal'):
+                if os.path.exists(database.sqlite_path + suffix):
+                    os.remove(database.sqlite_path + suffix)
+            os.replace(staging, database.sqlite_path)
+            restored_database = True
+
+    by_archive = {}
+    for key, entry in manifest['files'].items():
+        area, filename = key.split('/', 1)
+        if area not in areas:
+            continue
+        if storage.exists(area, filename) and storage.size(area, filename) == entry['size']:
+            continue
+        by_archive.setdefault(entry['archive'], []).append((key, area, filename, entry))
+
+    restored = 0
+    for archive, entries in by_archive.items():
+        source_path = os.path.join(folder, archive)
+        if not os.path.exists(source_path):
+            raise FileNotFoundError(f'{archive} is needed for {len(entries)} file(s) but is not in {folder}')
+        with tarfile.open(source_path) as tar:
+            for key, area, filename, entry in entries:
+                handle, staging = tempfile.mkstemp(prefix='restore-')
+                digest = hashlib.sha256()
+                with os.fdopen(handle, 'wb') as target, tar.extractfile(f'files/{key}') as source:
+                    for block in iter(lambda: source.read(COPY_BUFFER_SIZE), b''):
+                        digest.update(block)
+                        target.write(block)
+                if digest.hexdigest() != entry['sha256']:
+                    os.remove(staging)
+                    raise ValueError(f'{key} in {archive} does not match its recorded checksum')
+                storage.put_file(area, filename, staging)
+                restored += 1
+    skipped = sum(1 for key in manifest['files'] if key.split('/', 1)[0] in areas) - restored
+    return {'database': restored_database, 'restored': restored, 'skipped': skipped}
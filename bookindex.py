@@ -0,0 +1,69 @@
+"""
+Base class for the per-worker in-memory indexes over the books table.
+
+Each gunicorn worker keeps its own copy of an index. The worker that adds or
+deletes a book updates its index directly; every other worker notices within
+SYNC_INTERVAL seconds by reading only the rows that changed.
+"""
+import time
+import threading
+from abc import ABC, abstractmethod
+
+
+class BookIndex(ABC):
+    """In-memory index over (id, title, author) rows kept in sync with the database."""
+
+    SYNC_INTERVAL = 5.0  # seconds between catch-up checks against the database
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._books = {}
+        self._max_id = 0
+        self._loaded = False
+        self._synced_at = 0.0
+
+    def __len__(self):
+        return len(self._books)
+
+    @abstractmethod
+    def load(self, rows):
+        """Rebuild the index from (id, title, author) rows."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_book(self, book_id, title, author):
+        """Index one book, replacing any previous entry for the same id."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_book(self, book_id):
+        """Drop one book from the index; unknown ids are ignored."""
+        raise NotImplementedError
+
+    def sync(self, connect):
+        """Load the index on first use, then periodically pick up other workers' changes."""
+        if self._loaded and time.monotonic() - self._synced_at < self.SYNC_INTERVAL:
+            return
+        with self._lock:
+            if self._loaded and time.monotonic() - self._synced_at < self.SYNC_INTERVAL:
+                return
+            conn = connect()
+            try:
+                if not self._loaded:
+                    self.load(conn.execute('SELECT id, title, author FROM books').fetchall())
+                else:
+                    for row in conn.execute('SELECT id, title, author FROM books WHERE id > ?', (self._max_id,)):
+                        self.add_book(row[0], row[1], row[2])
+                    count = conn.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+                    if count != len(self._books):
+                        # Rare: a delete happened elsewhere; diff ids only, not whole rows
+                        live_ids = {row[0] for row in conn.execute('SELECT id FROM books')}
+                        for book_id in set(self._books) - live_ids:
+                            self.remove_book(book_id)
+                        for book_id in live_ids - set(self._books):
+                            row = conn.execute('SELECT id, title, author FROM books WHERE id = ?', (book_id,)).fetchone()
+                            if row is not None:
+                                self.add_book(row[0], row[1], row[2])
+            finally:
+                conn.close()
+            self._synced_at = time.monotonic()
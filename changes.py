@@ -0,0 +1,148 @@
+"""
+Change feed for clients that keep a copy of the catalogue.
+
+Triggers on books and category_books record every insert, update and
+delete in catalogue_changes under an increasing sequence number. A row's
+earlier entry is replaced, so the log holds one entry per row: its latest
+change, or a tombstone ('delete') once it is gone. /changes?since=<cursor>
+returns the entries after the cursor in sequence order, CHANGES_PAGE_SIZE
+at a time, with the current data of changed rows. A client stores the
+cursor it was given and asks again later. since=0 lists the whole
+catalogue, so the first sync and later ones use the same loop.
+
+Sequence numbers must appear in commit order, or a client could move its
+cursor past a change that commits late. SQLite allows one writer at a time,
+so AUTOINCREMENT already gives that order. On PostgreSQL the trigger takes
+the next number from a counter row, whose lock is held until commit, so
+concurrent writers to the catalogue take turns.
+
+Only columns shown to readers are tracked; the counters and file
+bookkeeping columns change without a log entry.
+"""
+
+CHANGES_PAGE_SIZE = 500
+ENTITIES = {'book': 'books', 'category_book': 'category_books'}
+
+# Columns of books delivered to clients (see describe_change() in app.py)
+_SYNCED_COLUMNS = ('title, author, description, image_filename, discipline, publication_year, '
+                   'preview_filename')
+
+
+def _sqlite_triggers(entity, table, update_event):
+    return [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_changes_{name} AFTER {event} ON {table} BEGIN
+            DELETE FROM catalogue_changes WHERE entity = '{entity}' AND entity_id = {row}.id;
+            INSERT INTO catalogue_changes (entity, entity_id, op) VALUES ('{entity}', {row}.id, '{op}');
+        END
+        '''
+        for name, event, row, op in (('insert', 'INSERT', 'NEW', 'upsert'),
+                                     ('update', update_event, 'NEW', 'upsert'),
+                                     ('delete', 'DELETE', 'OLD', 'delete'))
+    ]
+
+
+# Kept in step with the two tables by triggers; see init_database()
+CHANGE_LOG_TRIGGERS = (_sqlite_triggers('book', 'books', f'UPDATE OF {_SYNCED_COLUMNS}')
+                       + _sqlite_triggers('category_book', 'category_books', 'UPDATE'))
+
+# The same as row-level triggers numbered from a counter, for PostgreSQL databases
+POSTGRES_CHANGE_LOG_TRIGGERS = [
+    "INSERT INTO catalogue_change_counter (id, seq) VALUES (1, 0) ON CONFLICT (id) DO NOTHING",
+    '''
+    CREATE OR REPLACE FUNCTION record_catalogue_change() RETURNS trigger AS $$
+    DECLARE
+        next_seq BIGINT;
+        row_id INTEGER;
+    BEGIN
+        UPDATE catalogue_change_counter SET seq = seq + 1 WHERE id = 1 RETURNING seq INTO next_seq;
+        IF TG_OP = 'DELETE' THEN
+            row_id := OLD.id;
+        ELSE
+            row_id := NEW.id;
+        END IF;
+        DELETE FROM catalogue_changes WHERE entity = TG_ARGV[0] AND entity_id = row_id;
+        INSERT INTO catalogue_changes (seq, entity, entity_id, op)
+        VALUES (next_seq, TG_ARGV[0], row_id, CASE WHEN TG_OP = 'DELETE' THEN 'delete' ELSE 'upsert' END);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS trg_books_changes ON books',
+    f'''
+    CREATE TRIGGER trg_books_changes
+    AFTER INSERT OR DELETE OR UPDATE OF {_SYNCED_COLUMNS} ON books
+    FOR EACH ROW EXECUTE FUNCTION record_catalogue_change('book')
+    ''',
+    'DROP TRIGGER IF EXISTS trg_category_books_changes ON category_books',
+    '''
+    CREATE TRIGGER trg_category_books_changes
+    AFTER INSERT OR DELETE OR UPDATE ON category_books
+    FOR EACH ROW EXECUTE FUNCTION record_catalogue_change('category_book')
+    ''',
+]
+
+# Run once, when the triggers are first created: log the rows that predate them
+BACKFILL_CHANGE_LOG = [
+    "INSERT INTO catalogue_changes (entity, entity_id, op) SELECT 'book', id, 'upsert' FROM books ORDER BY id",
+    "INSERT INTO catalogue_changes (entity, entity_id, op) "
+    "SELECT 'category_book', id, 'upsert' FROM category_books ORDER BY id",
+]
+POSTGRES_BACKFILL_CHANGE_LOG = [
+    "INSERT INTO catalogue_changes (seq, entity, entity_id, op) "
+    "SELECT ROW_NUMBER() OVER (ORDER BY logged.entity, logged.id), logged.entity, logged.id, 'upsert' FROM "
+    "(SELECT 'book' AS entity, id FROM books UNION ALL SELECT 'category_book', id FROM category_books) AS logged",
+    "UPDATE catalogue_change_counter SET seq = (SELECT COALESCE(MAX(seq), 0) FROM catalogue_changes) WHERE id = 1",
+]
+
+
+def parse_since(value):
+    """The sequence number in a since= cursor (0 for none); ValueError if malformed."""
+    since = int(value or 0)
+    if since < 0:
+        raise ValueError('cursor must not be negative')
+    return since
+
+
+def latest_seq(conn):
+    return conn.execute('SELECT COALESCE(MAX(seq), 0) FROM catalogue_changes').fetchone()[0]
+
+
+def read_changes(conn, since, describe, limit=CHANGES_PAGE_SIZE):
+    """The page of changes after since, as the /changes response body.
+
+    describe(entity, row) turns a current row into the client's record.
+    A cursor beyond the end of the log (the database was restored from an
+    older backup) asks the client to start over with reset=True.
+    """
+    latest = latest_seq(conn)
+    if since > latest:
+        return {'changes': [], 'cursor': '0', 'has_more': latest > 0, 'reset': True}
+    entries = conn.execute(
+        'SELECT seq, entity, entity_id, op FROM catalogue_changes WHERE seq > ? ORDER BY seq LIMIT ?',
+        (since, limit + 1)
+    ).fetchall()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    rows = {}
+    for entity, table in ENTITIES.items():
+        ids = [entry['entity_id'] for entry in entries if entry['entity'] == entity and entry['op'] == 'upsert']
+        if ids:
+            placeholders = ', '.join('?' for _ in ids)
+            for row in conn.execute(f'SELECT * FROM {table} WHERE id IN ({placeholders})', ids):
+                rows[entity, row['id']] = row
+
+    changes = []
+    for entry in entries:
+        row = rows.get((entry['entity'], entry['entity_id']))
+        change = {'seq': entry['seq'], 'type': entry['entity'], 'id': entry['entity_id']}
+        if row is None:
+            # Deleted, or deleted after this page's log was read
+            change['op'] = 'delete'
+        else:
+            change['op'] = 'upsert'
+            change['data'] = describe(entry['entity'], row)
+        changes.append(change)
+    cursor = entries[-1]['seq'] if entries else since
+    return {'changes': changes, 'cursor': str(cursor), 'has_more': has_more, 'reset': False}
@@ -0,0 +1,181 @@
+"""
+Response compression and pre-compressed static files.
+
+compress_response() runs after every request and gzip- or brotli-encodes
+text responses (HTML, JSON, CSS, JS, XML) of at least COMPRESS_MIN_SIZE
+bytes, picking the encoding from Accept-Encoding. Streamed responses are
+compressed chunk by chunk with a flush after each one, so the client still
+receives every chunk as soon as it is produced. File downloads (sent with
+direct passthrough) and responses that are already encoded are left alone.
+
+Static assets are compressed once, ahead of time, by `flask compress-static`,
+which writes .gz and .br siblings at maximum compression. serve_static_file()
+replaces Flask's static view and sends the best sibling the client accepts,
+so serving them costs no CPU.
+
+brotli is optional: without it only gzip is offered.
+"""
+import os
+import gzip
+import zlib
+import mimetypes
+import importlib.util
+
+from flask import request, current_app, send_from_directory
+from werkzeug.security import safe_join
+
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '500'))
+GZIP_LEVEL = 6        # dynamic responses: fast enough per request
+BROTLI_QUALITY = 5
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/javascript', 'application/xml',
+    'application/atom+xml', 'application/opds+json', 'image/svg+xml',
+}
+STATIC_EXTENSIONS = {'.css', '.js', '.mjs', '.json', '.svg', '.txt', '.html', '.xml', '.map', '.ico'}
+# Suffix of the pre-compressed sibling for each encoding
+STATIC_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def brotli_available():
+    """Return True if the brotli module is installed (without importing it here)."""
+    return importlib.util.find_spec('brotli') is not None
+
+
+def supported_encodings():
+    """Encodings this server can produce, most preferred first."""
+    return ['br', 'gzip'] if brotli_available() else ['gzip']
+
+
+def is_compressible(mimetype):
+    return bool(mimetype) and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES)
+
+
+def _compressor(encoding):
+    """A streaming compressor exposing compress(chunk) and flush()."""
+    if encoding == 'br':
+        import brotli
+
+        class _Brotli:
+            def __init__(self):
+                self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+            def compress(self, chunk):
+                return self._compressor.process(chunk)
+
+            def flush(self, mode=None):
+                if mode == zlib.Z_FINISH:
+                    return self._compressor.finish()
+                return self._compressor.flush()
+
+        return _Brotli()
+    # wbits 31 = gzip header and trailer around a deflate stream
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+def _compress_stream(chunks, encoding):
+    compressor = _compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                # Sync flush: the client can render this chunk before the next arrives
+                yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush(zlib.Z_FINISH)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    """after_request hook: encode the response body if the client accepts it."""
+    if not is_compressible(response.mimetype):
+        return response
+    response.vary.add('Accept-Encoding')
+    if (request.method == 'HEAD'
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or 'no-transform' in (response.headers.get('Cache-Control') or '')):
+        return response
+    encoding = request.accept_encodings.best_match(supported_encodings())
+    if encoding is None:
+        return response
+
+    etag, weak = response.get_etag()
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        compressor = _compressor(encoding)
+        response.set_data(compressor.compress(data) + compressor.flush(zlib.Z_FINISH))
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        # A different body needs a different validator
+        response.set_etag(f'{etag}-{encoding}', weak=weak)
+    return response
+
+
+def encoded_etags(etag):
+    """The ETags compress_response() may have sent for a response tagged etag."""
+    return [etag] + [f'{etag}-{encoding}' for encoding in ('br', 'gzip')]
+
+
+def serve_static_file(filename):
+    """Replacement for Flask's static view that prefers pre-compressed siblings."""
+    folder = current_app.static_folder
+    path = safe_join(folder, filename)
+    mimetype = mimetypes.guess_type(filename)[0]
+    if path is not None and os.path.isfile(path) and is_compressible(mimetype):
+        available = [encoding for encoding, suffix in STATIC_SUFFIXES.items()
+                     if os.path.isfile(path + suffix)]
+        encoding = request.accept_encodings.best_match(available) if available else None
+        if encoding is not None:
+            response = send_from_directory(folder, filename + STATIC_SUFFIXES[encoding], mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+    return current_app.send_static_file(filename)
+
+
+def precompress_static(folder):
+    """Write .gz (and .br) siblings for text assets under folder.
+
+    Siblings newer than their source are kept; ones that would not be smaller
+    are not written. Returns (files, original bytes, smallest encoded bytes).
+    """
+    files = original_total = compressed_total = 0
+    encodings = supported_encodings()
+    for root, _, names in os.walk(folder):
+        for name in names:
+            if os.path.splitext(name)[1].lower() not in STATIC_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            source_mtime = os.path.getmtime(path)
+            with open(path, 'rb') as handle:
+                data = handle.read()
+            smallest = len(data)
+            for encoding in encodings:
+                target = path + STATIC_SUFFIXES[encoding]
+                if os.path.exists(target) and os.path.getmtime(target) >= source_mtime:
+                    smallest = min(smallest, os.path.getsize(target))
+                    continue
+                if encoding == 'br':
+                    import brotli
+                    encoded = brotli.compress(data, quality=11)
+                else:
+                    encoded = gzip.compress(data, compresslevel=9, mtime=0)
+                if len(encoded) >= len(data):
+                    if os.path.exists(target):
+                        os.remove(target)
+                    continue
+                with open(target, 'wb') as handle:
+                    handle.write(encoded)
+                smallest = min(smallest, len(encoded))
+            files += 1
+            original_total += len(data)
+            compressed_total += smallest
+    return files, original_total, compressed_total
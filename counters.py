@@ -0,0 +1,91 @@
+"""
+Write-behind view and download counters for books.
+
+Counting every hit with its own UPDATE would put a write transaction on the
+two hottest read paths. Instead each worker adds hits to an in-memory
+Counter, and a background thread flushes them every COUNTER_FLUSH_SECONDS
+as one batched transaction incrementing books.view_count and
+books.download_count. A crashed worker loses at most one interval of hits;
+a clean shutdown flushes what is pending.
+"""
+import os
+import time
+import atexit
+import threading
+from collections import Counter
+
+COUNTER_FLUSH_SECONDS = float(os.getenv('COUNTER_FLUSH_SECONDS', '30'))
+KINDS = ('views', 'downloads')
+
+
+class UsageCounters:
+    """Per-process hit counters flushed to the books table in batches."""
+
+    def __init__(self, connect, flush_interval=COUNTER_FLUSH_SECONDS):
+        self.connect = connect
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = Counter()   # (book_id, kind) -> hits not yet written
+        self._thread = None
+        self._pid = None
+        atexit.register(self.flush)
+
+    def record(self, book_id, kind):
+        """Count one view or download; never touches the database."""
+        if kind not in KINDS:
+            raise ValueError(f'Unknown counter: {kind!r}')
+        self._ensure_thread()
+        with self._lock:
+            self._pending[book_id, kind] += 1
+
+    def pending(self, book_id):
+        """(views, downloads) recorded by this worker but not flushed yet."""
+        with self._lock:
+            return self._pending[book_id, 'views'], self._pending[book_id, 'downloads']
+
+    def _ensure_thread(self):
+        # Threads do not survive fork(), and a child must not re-flush the
+        # hits it inherited from its parent
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pending.clear()
+                    self._thread = threading.Thread(target=self._run, name='counters', daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                pass  # counts are kept and retried on the next flush
+
+    def flush(self):
+        """Write all pending hits in one transaction; returns the number of books updated."""
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, Counter()
+        per_book = {}
+        for (book_id, kind), hits in batch.items():
+            per_book.setdefault(book_id, {'views': 0, 'downloads': 0})[kind] += hits
+        try:
+            conn = self.connect()
+            try:
+                # Sorted ids take row locks in the same order in every worker
+                conn.executemany(
+                    'UPDATE books SET view_count = view_count + ?, download_count = download_count + ? '
+                    'WHERE id = ?',
+                    [(counts['views'], counts['downloads'], book_id)
+                     for book_id, counts in sorted(per_book.items())]
+                )
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception:
+            with self._lock:
+                self._pending.update(batch)
+            raise
+        return len(per_book)
@@ -0,0 +1,325 @@
+"""
+Near-duplicate detection for uploads, with MinHash signatures and LSH buckets.
+
+Each book gets up to three fingerprints:
+
+  metadata   MinHash over character 4-grams of its normalized title and author,
+             so "Introduction to Algorithms, 3rd Edition" finds "Introduction
+             to Algorithms"
+  text       MinHash over 3-word shingles of the first DUPLICATE_TEXT_PAGES
+             pages of the PDF's text layer, so different scans or editions of
+             the same text collide whatever they are called
+  cover      64-bit difference hash (dHash) of the cover image, or of the first
+             page when no cover was uploaded
+
+Signatures are split into bands (MINHASH_BANDS x MINHASH_ROWS for the MinHash
+ones, COVER_BANDS for the cover hash) and every band is hashed to one bucket
+key in book_lsh_buckets. Books sharing any bucket with a new upload are the
+only candidates; their stored signatures are then compared exactly. Finding
+duplicates therefore costs one indexed IN query plus a handful of
+comparisons, however large the catalogue is.
+
+With 16 bands of 4 rows, two books whose shingle sets have Jaccard
+similarity 0.6 share a bucket 88% of the time (0.8: 99.9%); below 0.3 they
+rarely do. Cover hashes within COVER_MAX_DISTANCE bits always share one of
+their four 16-bit bands.
+
+PyMuPDF (text and first page), Pillow (cover hash) and NumPy (faster
+signatures) are optional; without them the fingerprints they provide are
+skipped.
+"""
+import io
+import struct
+import random
+import hashlib
+import importlib.util
+
+from textnorm import normalize_text
+
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+MINHASH_ROWS = MINHASH_PERMUTATIONS // MINHASH_BANDS
+MINHASH_SEED = 20240501             # fixed: stored signatures must stay comparable
+METADATA_SHINGLE_SIZE = 4           # characters
+TEXT_SHINGLE_SIZE = 3               # words
+DUPLICATE_TEXT_PAGES = 5
+MAX_TEXT_WORDS = 5000
+MIN_TEXT_SHINGLES = 20              # fewer means no usable text layer (e.g. a bare scan)
+METADATA_THRESHOLD = 0.6            # estimated Jaccard similarity
+TEXT_THRESHOLD = 0.5
+COVER_BANDS = 4
+COVER_MAX_DISTANCE = COVER_BANDS - 1  # differing bits; guarantees a shared band
+COVER_MIN_BITS = 6                  # near-blank images hash to almost all zeros (or ones)
+MAX_DUPLICATES = 5
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MASK32 = (1 << 32) - 1
+_MASK64 = (1 << 64) - 1
+_rng = random.Random(MINHASH_SEED)
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+                 for _ in range(MINHASH_PERMUTATIONS)]
+
+
+def numpy_available():
+    return importlib.util.find_spec('numpy') is not None
+
+
+def pdf_text_available():
+    return importlib.util.find_spec('pymupdf') is not None
+
+
+def image_hash_available():
+    return importlib.util.find_spec('PIL') is not None
+
+
+def _hash32(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=4).digest(), 'little')
+
+
+def minhash(shingles):
+    """MINHASH_PERMUTATIONS minimum hashes of a set of strings, or None for an empty set.
+
+    Uses NumPy when installed; the pure Python path computes the same values.
+    """
+    if not shingles:
+        return None
+    hashes = [_hash32(shingle) for shingle in shingles]
+    if numpy_available():
+        import numpy as np
+
+        values = np.array(hashes, dtype=np.uint64)
+        a = np.array([p[0] for p in _PERMUTATIONS], dtype=np.uint64)[:, None]
+        b = np.array([p[1] for p in _PERMUTATIONS], dtype=np.uint64)[:, None]
+        with np.errstate(over='ignore'):
+            # Wraps modulo 2**64 exactly like the masked Python arithmetic below
+            permuted = (a * values + b) % np.uint64(_MERSENNE_PRIME) & np.uint64(_MASK32)
+        return [int(value) for value in permuted.min(axis=1)]
+    return [min(((a * value + b) & _MASK64) % _MERSENNE_PRIME & _MASK32 for value in hashes)
+            for a, b in _PERMUTATIONS]
+
+
+def pack_minhash(signature):
+    return struct.pack(f'<{MINHASH_PERMUTATIONS}I', *signature) if signature else None
+
+
+def unpack_minhash(blob):
+    return list(struct.unpack(f'<{MINHASH_PERMUTATIONS}I', bytes(blob))) if blob else None
+
+
+def similarity(first, second):
+    """Estimated Jaccard similarity of the sets behind two signatures."""
+    if not first or not second:
+        return 0.0
+    return sum(1 for x, y in zip(first, second) if x == y) / MINHASH_PERMUTATIONS
+
+
+def metadata_shingles(title, author):
+    text = normalize_text(f'{title or ""} {author or ""}')
+    if len(text) < METADATA_SHINGLE_SIZE:
+        return {text} if text else set()
+    return {text[i:i + METADATA_SHINGLE_SIZE] for i in range(len(text) - METADATA_SHINGLE_SIZE + 1)}
+
+
+def title_numbers(title):
+    """Numbers in a title: volume and part numbers that tell otherwise similar titles apart."""
+    return sorted(word for word in normalize_text(title).split() if word.isdigit())
+
+
+def text_shingles(text):
+    words = normalize_text(text).split()[:MAX_TEXT_WORDS]
+    shingles = {' '.join(words[i:i + TEXT_SHINGLE_SIZE]) for i in range(len(words) - TEXT_SHINGLE_SIZE + 1)}
+    return shingles if len(shingles) >= MIN_TEXT_SHINGLES else set()
+
+
+def difference_hash(image):
+    """64-bit dHash of a Pillow image, or None for a near-blank one."""
+    from PIL import Image
+
+    pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            value = (value << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    if not COVER_MIN_BITS <= bin(value).count('1') <= 64 - COVER_MIN_BITS:
+        return None
+    # Stored in a signed 64-bit column
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def read_pdf(pdf):
+    """(text of the first pages, first page as a Pillow image) of a PDF path or bytes.
+
+    Either part is None when the libraries are missing or the PDF is unreadable;
+    damaged pages are skipped, so the text may come from fewer pages.
+    """
+    if not pdf_text_available():
+        return None, None
+    import pymupdf
+
+    pages, first_page = [], None
+    try:
+        document = pymupdf.open(stream=pdf, filetype='pdf') if isinstance(pdf, bytes) else pymupdf.open(pdf)
+        with document:
+            for index in range(min(DUPLICATE_TEXT_PAGES, document.page_count)):
+                try:
+                    pages.append(document.load_page(index).get_text())
+                except Exception:
+                    continue
+            if document.page_count and image_hash_available():
+                from PIL import Image
+
+                page = document.load_page(0)
+                zoom = 64 / page.rect.width if page.rect.width else 1
+                pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+                first_page = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+    except Exception:
+        pass  # keep the text read before the damage
+    return (' '.join(pages) if pages else None), first_page
+
+
+def _bucket(kind, band, values):
+    digest = hashlib.blake2b(f'{kind}:{band}:{values}'.encode('ascii'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def bucket_keys(fingerprint):
+    """LSH bucket keys of a fingerprint from DuplicateDetector.fingerprint()."""
+    keys = []
+    for kind in ('metadata', 'text'):
+        signature = fingerprint.get(kind)
+        if signature:
+            for band in range(MINHASH_BANDS):
+                keys.append(_bucket(kind, band, signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]))
+    if fingerprint.get('cover') is not None:
+        unsigned = fingerprint['cover'] & _MASK64
+        width = 64 // COVER_BANDS
+        for band in range(COVER_BANDS):
+            keys.append(_bucket('cover', band, (unsigned >> (band * width)) & ((1 << width) - 1)))
+    return keys
+
+
+class DuplicateDetector:
+    """Fingerprints in book_signatures, their LSH bucket keys in book_lsh_buckets."""
+
+    def __init__(self, connect, max_duplicates=MAX_DUPLICATES):
+        self.connect = connect
+        self.max_duplicates = max_duplicates
+
+    def fingerprint(self, title, author, pdf=None, cover=None):
+        """Fingerprints of a book from its metadata, PDF (path or bytes) and cover image (bytes).
+
+        Fingerprints that cannot be computed are None.
+        """
+        text, first_page = read_pdf(pdf) if pdf is not None else (None, None)
+        cover_hash = None
+        if image_hash_available():
+            from PIL import Image
+
+            image = first_page
+            if cover:
+                try:
+                    image = Image.open(io.BytesIO(cover))
+                except Exception:
+                    pass
+            if image is not None:
+                try:
+                    cover_hash = difference_hash(image)
+                except Exception:
+                    pass  # truncated image data only fails when decoded
+        return {
+            'metadata': minhash(metadata_shingles(title, author)),
+            'numbers': title_numbers(title),
+            'text': minhash(text_shingles(text)) if text else None,
+            'cover': cover_hash,
+        }
+
+    def metadata_fingerprint(self, title, author):
+        """A fingerprint from title and author only, for when the files cannot be read."""
+        return self.fingerprint(title, author)
+
+    def find(self, fingerprint, exclude=None):
+        """Likely duplicates of a fingerprint, most similar first.
+
+        Returns [{'id', 'title', 'author', 'reasons', 'score'}], where reasons
+        lists the matching fingerprints ('text', 'metadata', 'cover').
+        """
+        keys = bucket_keys(fingerprint)
+        if not keys:
+            return []
+        placeholders = ', '.join('?' * len(keys))
+        with self.connect() as conn:
+            candidates = conn.execute(
+                'SELECT book_signatures.*, books.title, books.author FROM book_signatures '
+                'JOIN books ON books.id = book_signatures.book_id '
+                f'WHERE book_id IN (SELECT book_id FROM book_lsh_buckets WHERE bucket IN ({placeholders}))',
+                keys
+            ).fetchall()
+        duplicates = []
+        for row in candidates:
+            if row['book_id'] == exclude:
+                continue
+            scores = {
+                'text': similarity(fingerprint['text'], unpack_minhash(row['text_minhash'])),
+                'metadata': similarity(fingerprint['metadata'], unpack_minhash(row['metadata_minhash'])),
+            }
+            reasons = []
+            if scores['text'] >= TEXT_THRESHOLD:
+                reasons.append('text')
+            # "Volume 1" and "Volume 2" share nearly every 4-gram but are different books
+            if scores['metadata'] >= METADATA_THRESHOLD and fingerprint['numbers'] == title_numbers(row['title']):
+                reasons.append('metadata')
+            if fingerprint['cover'] is not None and row['cover_hash'] is not None:
+                distance = bin((fingerprint['cover'] ^ row['cover_hash']) & _MASK64).count('1')
+                if distance <= COVER_MAX_DISTANCE:
+                    reasons.append('cover')
+            if reasons:
+                duplicates.append({'id': row['book_id'], 'title': row['title'], 'author': row['author'],
+                                   'reasons': reasons, 'score': round(max(scores.values()), 2)})
+        duplicates.sort(key=lambda duplicate: (len(duplicate['reasons']), duplicate['score']), reverse=True)
+        return duplicates[:self.max_duplicates]
+
+    def store(self, book_id, fingerprint):
+        """Record a book's fingerprints and bucket keys, replacing earlier ones."""
+        with self.connect() as conn:
+            self._delete(conn, book_id)
+            conn.execute(
+                'INSERT INTO book_signatures (book_id, metadata_minhash, text_minhash, cover_hash) '
+                'VALUES (?, ?, ?, ?)',
+                (book_id, pack_minhash(fingerprint['metadata']), pack_minhash(fingerprint['text']),
+                 fingerprint['cover'])
+            )
+            conn.executemany('INSERT INTO book_lsh_buckets (bucket, book_id) VALUES (?, ?)',
+                             [(key, book_id) for key in set(bucket_keys(fingerprint))])
+
+    def remove(self, book_id):
+        with self.connect() as conn:
+            self._delete(conn, book_id)
+
+    @staticmethod
+    def _delete(conn, book_id):
+        conn.execute('DELETE FROM book_lsh_buckets WHERE book_id = ?', (book_id,))
+        conn.execute('DELETE FROM book_signatures WHERE book_id = ?', (book_id,))
+
+    def backfill(self, storage):
+        """Fingerprint books that have none yet, in id order.
+
+        Yields (book, duplicates among the books fingerprinted before it).
+        """
+        with self.connect() as conn:
+            books = conn.execute(
+                'SELECT id, title, author, filename, image_filename FROM books '
+                'WHERE id NOT IN (SELECT book_id FROM book_signatures) ORDER BY id'
+            ).fetchall()
+        for book in books:
+            cover = None
+            if book['image_filename'] and storage.exists('covers', book['image_filename']):
+                with storage.local_copy('covers', book['image_filename']) as path, open(path, 'rb') as handle:
+                    cover = handle.read()
+            if storage.exists('uploads', book['filename']):
+                with storage.local_copy('uploads', book['filename']) as path:
+                    fingerprint = self.fingerprint(book['title'], book['author'], path, cover)
+            else:
+                fingerprint = self.fingerprint(book['title'], book['author'], cover=cover)
+            duplicates = self.find(fingerprint, exclude=book['id'])
+            self.store(book['id'], fingerprint)
+            yield book, duplicates
@@ -0,0 +1,191 @@
+"""
+Facet filters and counts for search results: discipline, author and
+publication decade.
+
+Counts are aggregated by the database, never by walking result rows in
+Python. Unfiltered catalogue-wide counts come straight from
+book_facet_counts, which triggers keep current on every insert, update and
+delete of books.
+Counts for a query are GROUP BY aggregates over the matching rows, each
+facet ignoring its own filter so users can switch between its values.
+"""
+
+FACET_NAMES = ('discipline', 'author', 'decade')
+TOP_AUTHORS = 10
+
+# SQL expression each facet groups by
+_FACET_COLUMNS = {
+    'discipline': 'discipline',
+    'author': 'author',
+    'decade': '(publication_year / 10) * 10',
+}
+
+# Rows that have a value for the facet
+_FACET_PRESENT = {
+    'discipline': "discipline IS NOT NULL AND discipline != ''",
+    'author': "author IS NOT NULL AND author != ''",
+    'decade': 'publication_year IS NOT NULL',
+}
+
+# Kept in step with the books table by triggers; see init_database()
+FACET_COUNT_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_books_facets_insert AFTER INSERT ON books BEGIN
+        INSERT INTO book_facet_counts (facet, value, count)
+            SELECT 'discipline', NEW.discipline, 1 WHERE COALESCE(NEW.discipline, '') != ''
+            ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+        INSERT INTO book_facet_counts (facet, value, count)
+            SELECT 'author', NEW.author, 1 WHERE COALESCE(NEW.author, '') != ''
+            ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+        INSERT INTO book_facet_counts (facet, value, count)
+            SELECT 'decade', CAST((NEW.publication_year / 10) * 10 AS TEXT), 1 WHERE NEW.publication_year IS NOT NULL
+            ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_books_facets_delete AFTER DELETE ON books BEGIN
+        UPDATE book_facet_counts SET count = count - 1 WHERE facet = 'discipline' AND value = OLD.discipline;
+        UPDATE book_facet_counts SET count = count - 1 WHERE facet = 'author' AND value = OLD.author;
+        UPDATE book_facet_counts SET count = count - 1
+            WHERE facet = 'decade' AND value = CAST((OLD.publication_year / 10) * 10 AS TEXT);
+        DELETE FROM book_facet_counts WHERE count <= 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_books_facets_update
+    AFTER UPDATE OF discipline, author, publication_year ON books BEGIN
+        UPDATE book_facet_counts SET count = count - 1 WHERE facet = 'discipline' AND value = OLD.discipline;
+        UPDATE book_facet_counts SET count = count - 1 WHERE facet = 'author' AND value = OLD.author;
+        UPDATE book_facet_counts SET count = count - 1
+            WHERE facet = 'decade' AND value = CAST((OLD.publication_year / 10) * 10 AS TEXT);
+        DELETE FROM book_facet_counts WHERE count <= 0;
+        INSERT INTO book_facet_counts (facet, value, count)
+            SELECT 'discipline', NEW.discipline, 1 WHERE COALESCE(NEW.discipline, '') != ''
+            ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+        INSERT INTO book_facet_counts (facet, value, count)
+            SELECT 'author', NEW.author, 1 WHERE COALESCE(NEW.author, '') != ''
+            ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+        INSERT INTO book_facet_counts (facet, value, count)
+            SELECT 'decade', CAST((NEW.publication_year / 10) * 10 AS TEXT), 1 WHERE NEW.publication_year IS NOT NULL
+            ON CONFLICT (facet, value) DO UPDATE SET count = count + 1;
+    END
+    ''',
+]
+
+# The same bookkeeping as one PL/pgSQL trigger, for PostgreSQL databases
+POSTGRES_FACET_COUNT_TRIGGERS = [
+    '''
+    CREATE OR REPLACE FUNCTION books_facet_counts() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE book_facet_counts SET count = count - 1
+                WHERE (facet = 'discipline' AND value = OLD.discipline)
+                   OR (facet = 'author' AND value = OLD.author)
+                   OR (facet = 'decade' AND value = CAST((OLD.publication_year / 10) * 10 AS TEXT));
+            DELETE FROM book_facet_counts WHERE count <= 0;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO book_facet_counts AS counts (facet, value, count)
+                SELECT facet, value, 1 FROM (VALUES
+                    ('discipline', NEW.discipline),
+                    ('author', NEW.author),
+                    ('decade', CAST((NEW.publication_year / 10) * 10 AS TEXT))
+                ) AS new_values (facet, value)
+                WHERE COALESCE(value, '') != ''
+                ON CONFLICT (facet, value) DO UPDATE SET count = counts.count + 1;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS trg_books_facets ON books',
+    '''
+    CREATE TRIGGER trg_books_facets
+    AFTER INSERT OR DELETE OR UPDATE OF discipline, author, publication_year ON books
+    FOR EACH ROW EXECUTE FUNCTION books_facet_counts()
+    ''',
+]
+
+# Rebuilds book_facet_counts from scratch (first run, or after a manual repair)
+REBUILD_FACET_COUNTS = [
+    'DELETE FROM book_facet_counts',
+    '''INSERT INTO book_facet_counts (facet, value, count)
+       SELECT 'discipline', discipline, COUNT(*) FROM books WHERE COALESCE(discipline, '') != '' GROUP BY discipline''',
+    '''INSERT INTO book_facet_counts (facet, value, count)
+       SELECT 'author', author, COUNT(*) FROM books WHERE COALESCE(author, '') != '' GROUP BY author''',
+    '''INSERT INTO book_facet_counts (facet, value, count)
+       SELECT 'decade', CAST((publication_year / 10) * 10 AS TEXT), COUNT(*) FROM books
+       WHERE publication_year IS NOT NULL GROUP BY (publication_year / 10) * 10''',
+]
+
+
+def parse_facet_filters(args, valid_disciplines):
+    """Read the active facet filters from request args, dropping invalid values."""
+    filters = {}
+    discipline = args.get('discipline', '').strip()
+    if discipline in valid_disciplines:
+        filters['discipline'] = discipline
+    author = args.get('author', '').strip()
+    if author:
+        filters['author'] = author
+    decade = args.get('decade', type=int)
+    if decade is not None:
+        filters['decade'] = decade - decade % 10
+    return filters
+
+
+def filter_clause(filters, exclude=None):
+    """Return (sql, params) restricting books to the filters, except `exclude`."""
+    clauses, params = [], []
+    for name, value in filters.items():
+        if name == exclude:
+            continue
+        if name == 'decade':
+            # A range on the column itself can use idx_books_publication_year
+            clauses.append('publication_year >= ? AND publication_year < ?')
+            params.extend([value, value + 10])
+        else:
+            clauses.append(f'{name} = ?')
+            params.append(value)
+    return ' AND '.join(clauses) or '1 = 1', params
+
+
+def facet_counts(conn, match_sql=None, match_params=(), filters=None):
+    """Return {facet: [(value, count), ...]} for the books matching the search.
+
+    match_sql is the text-match predicate (None for the whole catalogue).
+    Authors are limited to the TOP_AUTHORS most frequent; decades are newest first.
+    """
+    filters = filters or {}
+    if match_sql is None and not filters:
+        # One read per facet along idx_book_facet_counts_rank, so only the
+        # top authors are fetched however many distinct authors there are
+        counts = {}
+        for name in FACET_NAMES:
+            limit = f'LIMIT {TOP_AUTHORS}' if name == 'author' else ''
+            counts[name] = [
+                (int(row['value']) if name == 'decade' else row['value'], row['count'])
+                for row in conn.execute(
+                    f'SELECT value, count FROM book_facet_counts WHERE facet = ? ORDER BY count DESC, value {limit}',
+                    (name,)
+                )
+            ]
+        counts['decade'].sort(reverse=True)
+        return counts
+
+    counts = {}
+    for name in FACET_NAMES:
+        column = _FACET_COLUMNS[name]
+        where_sql, params = filter_clause(filters, exclude=name)
+        if match_sql is not None:
+            where_sql = f'({match_sql}) AND {where_sql}'
+            params = list(match_params) + params
+        order = 'value DESC' if name == 'decade' else 'count DESC, value'
+        limit = f'LIMIT {TOP_AUTHORS}' if name == 'author' else ''
+        counts[name] = [tuple(row) for row in conn.execute(
+            f'SELECT {column} AS value, COUNT(*) AS count FROM books '
+            f'WHERE {where_sql} AND {_FACET_PRESENT[name]} '
+            f'GROUP BY value ORDER BY {order} {limit}',
+            params
+        )]
+    return counts
@@ -0,0 +1,136 @@
+"""
+Template caching: compiled templates on disk and rendered book cards in memory.
+
+Listing pages render the same card for a book over and over: in both
+"recent" and "all" on the home page, on /books, for every visitor using the
+same language. book_card() renders BOOK_CARD_TEMPLATE once per book,
+language and permission flag and keeps the markup in a per-worker LRU.
+
+The key also includes a fingerprint of the book's row, so a card is
+re-rendered as soon as its row changes in the database, whichever worker
+made the change; the stale entry simply ages out. Columns that change on
+every hit (the write-behind counters) are left out of the fingerprint.
+
+stream_page() sends a listing page while it renders, so its head reaches
+the browser before the catalogue has been read, and the rows (LazyRows from
+repositories.py) are never all in memory at once.
+
+Compiled template bytecode is kept in JINJA_CACHE_DIR, shared by all
+workers and restarts, so a new worker loads templates instead of compiling
+them.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from flask import Response, get_flashed_messages, stream_template
+from jinja2 import FileSystemBytecodeCache, pass_context
+from markupsafe import Markup
+
+BOOK_CARD_TEMPLATE = '_book_card.html'
+CARD_CACHE_SIZE = int(os.getenv('CARD_CACHE_SIZE', '5000'))
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', '8192'))
+JINJA_CACHE_DIR = os.getenv('JINJA_CACHE_DIR')  # default: <instance>/jinja_cache
+# Columns that do not affect a card's markup
+CARD_IGNORED_COLUMNS = frozenset({'view_count', 'download_count'})
+
+
+def enable_bytecode_cache(app, directory=JINJA_CACHE_DIR):
+    """Store compiled templates on disk, shared by every worker."""
+    directory = directory or os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(directory, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def precompile_templates(app):
+    """Load every template once, so forked workers inherit them compiled."""
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+
+def row_fingerprint(row):
+    """A hashable snapshot of the row's card-relevant values."""
+    return tuple(row[key] for key in row.keys() if key not in CARD_IGNORED_COLUMNS)
+
+
+class FragmentCache:
+    """A bounded LRU of rendered markup, local to one worker."""
+
+    def __init__(self, max_entries=CARD_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            markup = self._entries.get(key)
+            if markup is not None:
+                self._entries.move_to_end(key)
+            return markup
+
+    def put(self, key, markup):
+        with self._lock:
+            self._entries[key] = markup
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, book_id):
+        """Drop every cached card of a book (keys start with its id)."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == book_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def make_book_card(cache, cover_url):
+    """Build the book_card(book) template global backed by cache.
+
+    The calling template supplies t, lang_data and can_add_book, exactly
+    as the listing pages already receive them.
+    """
+    @pass_context
+    def book_card(context, book):
+        lang_data = context.get('lang_data') or {}
+        can_add_book = bool(context.get('can_add_book'))
+        key = (book['id'], lang_data.get('code'), can_add_book, row_fingerprint(book))
+        markup = cache.get(key)
+        if markup is None:
+            template = context.environment.get_template(BOOK_CARD_TEMPLATE)
+            markup = Markup(template.render(
+                book=book, cover_url=cover_url(book), t=context.get('t'),
+                lang_data=lang_data, can_add_book=can_add_book,
+            ))
+            cache.put(key, markup)
+        return markup
+
+    return book_card
+
+
+def stream_page(template_name, **context):
+    """A streamed response rendering template_name as it is sent.
+
+    Jinja yields a page in many small pieces; they are sent in chunks of at
+    least STREAM_CHUNK_SIZE bytes rather than one (compressed and flushed)
+    write per tag.
+    """
+    # The session is saved before the body renders, so flashed messages must
+    # be taken from it now; the template's own calls reuse this request's copy
+    get_flashed_messages(with_categories=True)
+    pieces = stream_template(template_name, **context)
+
+    def chunks():
+        buffered, size = [], 0
+        for piece in pieces:
+            buffered.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(buffered)
+                buffered, size = [], 0
+        if buffered:
+            yield ''.join(buffered)
+
+    return Response(chunks(), mimetype='text/html')
@@ -0,0 +1,154 @@
+"""
+Typo-tolerant title/author search over an in-memory trigram index.
+
+Each word of a normalized title or author is padded ("  mahfouz ") and cut
+into trigrams; an inverted index maps every trigram to the books containing
+it. A query is scored by the share of its trigrams a book contains, and the
+best candidates are re-ranked by edit distance against the closest run of
+words in the title or author, so "mahfuz" finds "Mahfouz" and "ابراهم"
+finds "إبراهيم".
+
+Work per query is bounded: trigrams are visited rarest first and candidate
+generation stops after POSTING_BUDGET postings, and only RERANK_LIMIT
+candidates reach the edit-distance stage.
+"""
+from collections import Counter
+
+from bookindex import BookIndex
+from textnorm import normalize_text
+
+
+def word_trigrams(word):
+    """Return the padded trigrams of a single word."""
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def text_trigrams(text):
+    """Return the set of trigrams of every word in already-normalized text."""
+    trigrams = set()
+    for word in text.split():
+        trigrams |= word_trigrams(word)
+    return trigrams
+
+
+def edit_distance(a, b, limit=None):
+    """Levenshtein distance between a and b; stops early once it must exceed limit."""
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def closest_distance(query, text, limit, memo):
+    """Smallest edit distance between query and any run of as many words in text.
+
+    Distances above limit are reported as limit + 1. memo caches window
+    distances across the candidates of one query, which share many words.
+    """
+    words = text.split()
+    width = max(1, len(query.split()))
+    best = limit + 1
+    for start in range(max(1, len(words) - width + 1)):
+        window = ' '.join(words[start:start + width])
+        distance = memo.get(window)
+        if distance is None:
+            distance = memo[window] = edit_distance(query, window, limit=limit)
+        if distance < best:
+            best = distance
+            if best == 0:
+                break
+    return best
+
+
+class TrigramIndex(BookIndex):
+    """Inverted trigram index over normalized book titles and authors."""
+
+    MIN_SIMILARITY = 0.3     # share of query trigrams a candidate must contain
+    POSTING_BUDGET = 50000   # postings visited per query before candidate generation stops
+    RERANK_LIMIT = 30        # candidates re-ranked by edit distance
+    MIN_EDIT_SIMILARITY = 0.5  # 1 - distance / query length required after re-ranking
+
+    def __init__(self):
+        super().__init__()
+        self._postings = {}  # trigram -> set of book ids
+        # _books maps book_id -> (normalized title, normalized author, trigrams)
+
+    def load(self, rows):
+        with self._lock:
+            self._books = {}
+            self._postings = {}
+            for book_id, title, author in rows:
+                self._insert(book_id, title, author)
+            self._max_id = max(self._books, default=0)
+            self._loaded = True
+
+    def add_book(self, book_id, title, author):
+        with self._lock:
+            self.remove_book(book_id)
+            self._insert(book_id, title, author)
+            self._max_id = max(self._max_id, book_id)
+
+    def remove_book(self, book_id):
+        with self._lock:
+            book = self._books.pop(book_id, None)
+            if book is None:
+                return
+            for trigram in book[2]:
+                posting = self._postings.get(trigram)
+                if posting is not None:
+                    posting.discard(book_id)
+                    if not posting:
+                        del self._postings[trigram]
+
+    def search(self, query, limit=20):
+        """Return up to limit book ids similar to query, best match first."""
+        normalized = normalize_text(query)
+        query_trigrams = text_trigrams(normalized)
+        if not query_trigrams or limit <= 0:
+            return []
+        with self._lock:
+            postings = sorted((self._postings.get(t, ()) for t in query_trigrams), key=len)
+            counts = Counter()
+            visited = used = 0
+            for posting in postings:
+                if visited and visited + len(posting) > self.POSTING_BUDGET:
+                    # Remaining trigrams are the most common ones: they would
+                    # touch many books while barely separating candidates
+                    break
+                counts.update(posting)
+                visited += len(posting)
+                used += 1
+
+            threshold = self.MIN_SIMILARITY * used
+            candidates = [book_id for book_id, count in counts.most_common(self.RERANK_LIMIT)
+                          if count >= threshold]
+            # Windows further than this from the query could never pass MIN_EDIT_SIMILARITY
+            max_distance = int(len(normalized) * (1 - self.MIN_EDIT_SIMILARITY))
+            memo = {}
+            scored = []
+            for book_id in candidates:
+                title, author, _ = self._books[book_id]
+                distance = min(closest_distance(normalized, title, max_distance, memo),
+                               closest_distance(normalized, author, max_distance, memo))
+                if distance <= max_distance:
+                    scored.append((distance, -counts[book_id], -book_id))
+        scored.sort()
+        return [-negated_id for _, _, negated_id in scored[:limit]]
+
+    def _insert(self, book_id, title, author):
+        title, author = normalize_text(title), normalize_text(author)
+        trigrams = text_trigrams(title) | text_trigrams(author)
+        self._books[book_id] = (title, author, trigrams)
+        for trigram in trigrams:
+            self._postings.setdefault(trigram, set()).add(book_id)
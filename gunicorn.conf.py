@@ -0,0 +1,29 @@
+"""
+Gunicorn settings, picked up automatically when gunicorn runs from this directory.
+"""
+import os
+
+# Import the app once in the master so every worker inherits the loaded modules
+# and warmed caches copy-on-write instead of rebuilding them after fork().
+# Set GUNICORN_PRELOAD=0 to go back to importing in each worker (e.g. for --reload).
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') != '0'
+
+
+def on_starting(server):
+    """Run one-off startup work in the master before any worker is forked."""
+    from app import init_database, warm_up
+    init_database()
+    if preload_app:
+        warm_up()
+
+
+def post_fork(server, worker):
+    """Start per-worker background threads (threads do not survive fork())."""
+    from app import start_background_maintenance
+    start_background_maintenance()
+
+
+def worker_exit(server, worker):
+    """Flush write-behind counters before a worker goes away."""
+    from app import usage_counters
+    usage_counters.flush()
@@ -0,0 +1,139 @@
+"""
+Background jobs for slow AI generations.
+
+Jobs are recorded in the ai_jobs table of the library database so that any
+worker can answer a status poll, and run on a small thread pool inside the
+worker that accepted them, so the submitting request returns immediately
+instead of holding a sync worker for the whole OpenAI round trip.
+"""
+import os
+import json
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from db import IntegrityError
+
+JOB_WORKERS = int(os.getenv('AI_JOB_WORKERS', '4'))
+STALE_JOB_SECONDS = 10 * 60  # in-flight jobs untouched this long belong to a dead worker
+FINISHED_JOB_TTL_SECONDS = 24 * 60 * 60
+IN_FLIGHT_STATUSES = ('queued', 'running')
+_IN_FLIGHT_SQL = ', '.join(f"'{status}'" for status in IN_FLIGHT_STATUSES)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Return this process's thread pool; threads do not survive fork()."""
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='ai-job')
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def _utc_ago(seconds):
+    """UTC timestamp string comparable with CURRENT_TIMESTAMP columns."""
+    return (datetime.now(timezone.utc) - timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _expire_jobs(conn):
+    """Fail jobs orphaned by a dead worker and drop old finished ones."""
+    conn.execute(
+        "UPDATE ai_jobs SET status = 'failed', error = 'Job was interrupted', updated_at = CURRENT_TIMESTAMP "
+        f"WHERE status IN ({_IN_FLIGHT_SQL}) AND updated_at < ?",
+        (_utc_ago(STALE_JOB_SECONDS),)
+    )
+    conn.execute(
+        "DELETE FROM ai_jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+        (_utc_ago(FINISHED_JOB_TTL_SECONDS),)
+    )
+
+
+def submit_job(connect, kind, book_id, language, func, cancel=None):
+    """Queue func() as a (kind, book_id, language) job.
+
+    If an identical job is already queued or running, no new work is started
+    and its id is returned instead. Returns (job_id, created). cancel() is
+    called instead of func() if the job expired while it waited in the queue.
+    """
+    conn = connect()
+    try:
+        _expire_jobs(conn)
+        job_id = uuid.uuid4().hex
+        for attempt in range(3):
+            try:
+                conn.execute(
+                    'INSERT INTO ai_jobs (id, kind, book_id, language) VALUES (?, ?, ?, ?)',
+                    (job_id, kind, book_id, language)
+                )
+                conn.commit()
+                break
+            except IntegrityError:
+                # The partial unique index only admits one in-flight job per key
+                conn.rollback()
+                existing = conn.execute(
+                    "SELECT id FROM ai_jobs WHERE kind = ? AND book_id = ? AND language = ? "
+                    f"AND status IN ({_IN_FLIGHT_SQL})",
+                    (kind, book_id, language)
+                ).fetchone()
+                if existing is not None:
+                    return existing['id'], False
+                # The conflicting job finished in between; try the insert again
+                if attempt == 2:
+                    raise
+    finally:
+        conn.close()
+
+    _get_executor().submit(_run_job, connect, job_id, func, cancel)
+    return job_id, True
+
+
+def _run_job(connect, job_id, func, cancel=None):
+    """Execute a job and store its JSON result or error message."""
+    # A job that waited past STALE_JOB_SECONDS was failed by _expire_jobs()
+    # and may have an identical successor in flight; it must not run
+    if not _update_job(connect, job_id, 'queued', status='running'):
+        if cancel is not None:
+            cancel()
+        return
+    try:
+        result = func()
+    except Exception as exc:
+        _update_job(connect, job_id, 'running', status='failed', error=str(exc))
+    else:
+        _update_job(connect, job_id, 'running', status='done', result=json.dumps(result, ensure_ascii=False))
+
+
+def _update_job(connect, job_id, current, status, result=None, error=None):
+    """Move a job from status current to status; returns False if it was not in current."""
+    conn = connect()
+    try:
+        updated = conn.execute(
+            'UPDATE ai_jobs SET status = ?, result = ?, error = ?, updated_at = CURRENT_TIMESTAMP '
+            'WHERE id = ? AND status = ?',
+            (status, result, error, job_id, current)
+        ).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return updated > 0
+
+
+def get_job(connect, job_id):
+    """Return a job as a dict with its decoded result, or None if unknown."""
+    conn = connect()
+    try:
+        row = conn.execute('SELECT * FROM ai_jobs WHERE id = ?', (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    job = dict(row)
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
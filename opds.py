@@ -0,0 +1,226 @@
+"""
+OPDS catalogue feeds for e-reader apps.
+
+Feeds are served as OPDS 1.2 (Atom XML) or, when the client asks for
+application/opds+json, OPDS 2.0. A feed is a dict built by the view:
+
+  {'id', 'title', 'updated', 'kind': 'navigation' | 'acquisition',
+   'links': [{'rel', 'href', 'type'}], 'entries': [...]}
+
+where navigation entries are {'id', 'title', 'summary', 'href'} and
+acquisition entries describe books (see book_entry()).
+
+Acquisition feeds are paged with a keyset cursor on (upload_date, id), the
+listing order, so page N costs the same indexed range scan as page 1 and
+does not shift when books are added.
+
+Every feed carries an ETag and Last-Modified derived from the
+catalogue_version row, which triggers bump on any change to a book's
+listed fields. Polling clients are answered 304 after that one primary-key
+lookup, without querying or rendering the feed.
+"""
+import json
+import base64
+import binascii
+import hashlib
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape, quoteattr
+
+OPDS_PAGE_SIZE = 50
+ATOM_TYPE = 'application/atom+xml'
+NAVIGATION_TYPE = 'application/atom+xml;profile=opds-catalog;kind=navigation'
+ACQUISITION_TYPE = 'application/atom+xml;profile=opds-catalog;kind=acquisition'
+OPDS2_TYPE = 'application/opds+json'
+OPENSEARCH_TYPE = 'application/opensearchdescription+xml'
+ACQUISITION_REL = 'http://opds-spec.org/acquisition'
+IMAGE_REL = 'http://opds-spec.org/image'
+THUMBNAIL_REL = 'http://opds-spec.org/image/thumbnail'
+
+# Columns shown in feeds; changes to other columns (counters, sizes) leave
+# the catalogue version, and so every cached feed, untouched
+_LISTED_COLUMNS = ('title, author, description, filename, image_filename, discipline, '
+                   'publication_year, preview_filename')
+
+# Kept in step with the books table by triggers; see init_database()
+CATALOGUE_VERSION_TRIGGERS = [
+    "INSERT INTO catalogue_version (id, version, updated_at) VALUES (1, 0, CURRENT_TIMESTAMP) "
+    "ON CONFLICT (id) DO NOTHING",
+] + [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS trg_books_version_{name} AFTER {event} ON books BEGIN
+        UPDATE catalogue_version SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = 1;
+    END
+    '''
+    for name, event in (('insert', 'INSERT'), ('delete', 'DELETE'),
+                        ('update', f'UPDATE OF {_LISTED_COLUMNS}'))
+]
+
+# The same as one statement-level trigger, for PostgreSQL databases
+POSTGRES_CATALOGUE_VERSION_TRIGGERS = [
+    "INSERT INTO catalogue_version (id, version, updated_at) VALUES (1, 0, CURRENT_TIMESTAMP) "
+    "ON CONFLICT (id) DO NOTHING",
+    '''
+    CREATE OR REPLACE FUNCTION books_catalogue_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE catalogue_version SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = 1;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    'DROP TRIGGER IF EXISTS trg_books_version ON books',
+    f'''
+    CREATE TRIGGER trg_books_version
+    AFTER INSERT OR DELETE OR UPDATE OF {_LISTED_COLUMNS} ON books
+    FOR EACH STATEMENT EXECUTE FUNCTION books_catalogue_version()
+    ''',
+]
+
+
+def _as_utc(value):
+    """A CURRENT_TIMESTAMP value (text on SQLite, naive UTC datetime on PostgreSQL) as aware UTC."""
+    if value is None:
+        return datetime.now(timezone.utc)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.replace(tzinfo=timezone.utc, microsecond=0)
+
+
+def atom_date(value):
+    return _as_utc(value).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def catalogue_version(conn):
+    """(version, last modified) of the whole catalogue: one primary-key lookup."""
+    row = conn.execute('SELECT version, updated_at FROM catalogue_version WHERE id = 1').fetchone()
+    if row is None:
+        return 0, datetime.now(timezone.utc).replace(microsecond=0)
+    return row[0], _as_utc(row[1])
+
+
+def feed_etag(version, *parts):
+    """Validator for one rendering of one feed at one catalogue version."""
+    key = hashlib.sha1('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:16]
+    return f'v{version}-{key}'
+
+
+def encode_cursor(book):
+    """Opaque cursor continuing after this book in (upload_date, id) DESC order."""
+    raw = json.dumps([str(book['upload_date']), book['id']])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(upload_date, id) from encode_cursor(), or None for a missing or mangled cursor."""
+    if not cursor:
+        return None
+    try:
+        upload_date, book_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return str(upload_date), int(book_id)
+    except (binascii.Error, ValueError, TypeError, UnicodeDecodeError):
+        return None
+
+
+def book_entry(book, detail_href, download_href, cover_href=None, cover_type=None, category=None):
+    """An acquisition entry for a books row."""
+    return {
+        'id': f'urn:library:book:{book["id"]}',
+        'title': book['title'],
+        'author': book['author'],
+        'summary': book['description'] or '',
+        'updated': book['upload_date'],
+        'issued': book['publication_year'],
+        'category': category,
+        'detail_href': detail_href,
+        'download_href': download_href,
+        'cover_href': cover_href,
+        'cover_type': cover_type,
+    }
+
+
+def _link(link):
+    return f'<link rel={quoteattr(link["rel"])} href={quoteattr(link["href"])} type={quoteattr(link["type"])}/>'
+
+
+def _atom_entry(entry, kind, feed_updated):
+    parts = ['<entry>', f'<id>{escape(entry["id"])}</id>', f'<title>{escape(entry["title"])}</title>']
+    if kind == 'navigation':
+        parts.append(f'<updated>{atom_date(entry.get("updated") or feed_updated)}</updated>')
+        if entry.get('summary'):
+            parts.append(f'<content type="text">{escape(entry["summary"])}</content>')
+        parts.append(_link({'rel': 'subsection', 'href': entry['href'], 'type': ACQUISITION_TYPE}))
+    else:
+        parts.append(f'<updated>{atom_date(entry["updated"])}</updated>')
+        parts.append(f'<author><name>{escape(entry["author"])}</name></author>')
+        if entry['issued']:
+            parts.append(f'<dc:issued>{int(entry["issued"])}</dc:issued>')
+        if entry['summary']:
+            parts.append(f'<summary type="text">{escape(entry["summary"])}</summary>')
+        if entry['category']:
+            term, label = entry['category']
+            parts.append(f'<category term={quoteattr(term)} label={quoteattr(label)}/>')
+        parts.append(_link({'rel': ACQUISITION_REL, 'href': entry['download_href'], 'type': 'application/pdf'}))
+        if entry['cover_href']:
+            for rel in (IMAGE_REL, THUMBNAIL_REL):
+                parts.append(_link({'rel': rel, 'href': entry['cover_href'], 'type': entry['cover_type']}))
+        parts.append(_link({'rel': 'alternate', 'href': entry['detail_href'], 'type': 'text/html'}))
+    parts.append('</entry>\n')
+    return ''.join(parts)
+
+
+def render_atom(feed):
+    """Yield an OPDS 1.2 Atom document in pieces, one entry at a time."""
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/terms/" '
+           'xmlns:opds="http://opds-spec.org/2010/catalog">\n')
+    yield (f'<id>{escape(feed["id"])}</id><title>{escape(feed["title"])}</title>'
+           f'<updated>{atom_date(feed["updated"])}</updated>\n')
+    for link in feed['links']:
+        yield _link(link) + '\n'
+    for entry in feed['entries']:
+        yield _atom_entry(entry, feed['kind'], feed['updated'])
+    yield '</feed>\n'
+
+
+def render_opds2(feed):
+    """The same feed as an OPDS 2.0 JSON document."""
+    document = {
+        'metadata': {'title': feed['title'], 'modified': atom_date(feed['updated'])},
+        'links': [{'rel': link['rel'], 'href': link['href'],
+                   'type': OPDS2_TYPE if link['type'].startswith(ATOM_TYPE) else link['type']}
+                  for link in feed['links']],
+    }
+    if feed['kind'] == 'navigation':
+        document['navigation'] = [
+            {'title': entry['title'], 'href': entry['href'], 'type': OPDS2_TYPE, 'rel': 'subsection'}
+            for entry in feed['entries']
+        ]
+        return document
+    publications = []
+    for entry in feed['entries']:
+        metadata = {'@type': 'http://schema.org/Book', 'identifier': entry['id'], 'title': entry['title'],
+                    'author': entry['author'], 'modified': atom_date(entry['updated'])}
+        if entry['summary']:
+            metadata['description'] = entry['summary']
+        if entry['issued']:
+            metadata['published'] = str(int(entry['issued']))
+        if entry['category']:
+            metadata['subject'] = [{'name': entry['category'][1], 'code': entry['category'][0]}]
+        publication = {
+            'metadata': metadata,
+            'links': [{'rel': ACQUISITION_REL, 'href': entry['download_href'], 'type': 'application/pdf'},
+                      {'rel': 'alternate', 'href': entry['detail_href'], 'type': 'text/html'}],
+        }
+        if entry['cover_href']:
+            publication['images'] = [{'href': entry['cover_href'], 'type': entry['cover_type']}]
+        publications.append(publication)
+    document['publications'] = publications
+    return document
+
+
+def opensearch_description(title, template):
+    """OpenSearch description pointing clients at the search feed."""
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<OpenSearchDescription xmlns="http://a9.com/-/spec/opensearch/1.1/">'
+            f'<ShortName>{escape(title)}</ShortName><Description>{escape(title)}</Description>'
+            f'<Url type={quoteattr(ACQUISITION_TYPE)} template={quoteattr(template)}/>'
+            '</OpenSearchDescription>\n')
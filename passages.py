@@ -0,0 +1,233 @@
+"""
+Passage index over the text of each book's PDF, for "Ask this book".
+
+When a book is added, its text layer is extracted in a pool process and cut
+into overlapping passages of about PASSAGE_WORDS words, each remembering the
+page it starts on. Passages are stored in book_passages and indexed for
+full-text ranking: an FTS5 table ranked with BM25 on SQLite, a GIN-indexed
+tsvector ranked with ts_rank_cd on PostgreSQL. Both index the normalized
+text (textnorm.py), so Arabic spelling variants and diacritics match.
+
+A question is answered from context(): the best-ranked passages of that
+book only, added in rank order until QA_CONTEXT_TOKENS is spent and then
+put back in reading order. The prompt is therefore the same size for a
+pamphlet and for a thousand-page book, and so are the answer's latency and
+cost.
+
+books.passage_count records the outcome: NULL means not indexed yet, 0 a
+PDF without usable text (a bare scan), otherwise the number of passages.
+PyMuPDF is optional; without it no passages are made.
+"""
+import threading
+import importlib.util
+
+from process_pool import get_process_pool, shutdown_process_pool
+from storage import create_storage
+from textnorm import normalize_text
+
+PASSAGE_WORDS = 180
+PASSAGE_OVERLAP = 30          # words repeated at the start of the next passage
+PASSAGE_MAX_PAGES = 2000
+PASSAGE_WORKERS = 1
+QA_CONTEXT_TOKENS = 1500      # prompt budget for the book's passages
+QA_ANSWER_TOKENS = 400
+QA_MAX_QUESTION_CHARS = 500
+QA_CANDIDATES = 12            # best-ranked passages considered for the budget
+QA_MAX_TERMS = 32
+# Function words that match nearly every passage (compared after normalization)
+STOPWORDS = frozenset(normalize_text(word) for word in (
+    'a an and are as at be but by did do does for from has have how i in is it its '
+    'of on or that the this to was were what when where which who whom why will with '
+    'about book tell me you your author'
+    ' في من على إلى عن ما ماذا هل هو هي هذا هذه ذلك التي الذي كيف لماذا متى أين مع كان الكتاب'
+).split())
+
+_pending = set()  # book ids queued by this process
+_pending_lock = threading.Lock()
+
+
+def passages_available():
+    """Return True if PyMuPDF is installed (without importing it here)."""
+    return importlib.util.find_spec('pymupdf') is not None
+
+
+def estimate_tokens(text):
+    # About four characters per token for English; Arabic runs closer to
+    # three, so count conservatively
+    return len(text) // 3 + 1
+
+
+def chunk_pages(pages, words_per_passage=PASSAGE_WORDS, overlap=PASSAGE_OVERLAP):
+    """Cut (page number, text) pairs into overlapping passages.
+
+    Yields (page number of the passage's first word, passage text).
+    """
+    step = words_per_passage - overlap
+    window = []  # (word, page) not yet emitted, plus the overlap
+    fresh = 0    # words in window not already sent in an earlier passage
+    for page_number, text in pages:
+        for word in text.split():
+            window.append((word, page_number))
+            fresh += 1
+            if len(window) == words_per_passage:
+                yield window[0][1], ' '.join(word for word, _ in window)
+                window = window[step:]
+                fresh = 0
+    if fresh:
+        yield window[0][1], ' '.join(word for word, _ in window)
+
+
+def extract_passages(storage_config, pdf_name, max_pages=PASSAGE_MAX_PAGES):
+    """Passages of a stored PDF as (page, content, search text, tokens) tuples.
+
+    Runs in a pool process.
+    """
+    import pymupdf
+
+    storage = create_storage(storage_config)
+    with storage.local_copy('uploads', pdf_name) as pdf_path, pymupdf.open(pdf_path) as document:
+        pages = ((index + 1, document.load_page(index).get_text())
+                 for index in range(min(max_pages, document.page_count)))
+        return [(page, content, normalize_text(content), estimate_tokens(content))
+                for page, content in chunk_pages(pages)]
+
+
+def question_terms(question):
+    """Distinct normalized words of a question worth matching on."""
+    terms = []
+    for word in normalize_text(question).split():
+        if word not in STOPWORDS and word not in terms and (len(word) > 1 or word.isdigit()):
+            terms.append(word)
+    return terms[:QA_MAX_TERMS]
+
+
+class PassageIndex:
+    """Per-book passages of PDF text, ranked against questions."""
+
+    def __init__(self, connect):
+        self.connect = connect
+
+    def schedule(self, storage, book_id, pdf_name):
+        """Queue passage extraction for a book; returns without waiting.
+
+        Returns False if PyMuPDF is missing or the book is already queued in
+        this process.
+        """
+        if not passages_available():
+            return False
+        with _pending_lock:
+            if book_id in _pending:
+                return False
+            _pending.add(book_id)
+        future = get_process_pool('passages', PASSAGE_WORKERS).submit(extract_passages, storage.config, pdf_name)
+        future.add_done_callback(lambda done: self._record(book_id, done))
+        return True
+
+    def _record(self, book_id, future):
+        with _pending_lock:
+            _pending.discard(book_id)
+        try:
+            passages = future.result()
+        except Exception:
+            # Broken, encrypted or missing PDFs get no passages
+            passages = []
+        self.store(book_id, passages)
+
+    def store(self, book_id, passages):
+        """Replace a book's passages with (page, content, search text, tokens) tuples.
+
+        Returns False, storing nothing, if the book has been deleted meanwhile.
+        """
+        with self.connect() as conn:
+            # delete_book() removes the row before the passages, so a book
+            # deleted while its text was extracted is caught here
+            if not conn.execute('UPDATE books SET passage_count = ? WHERE id = ?',
+                                (len(passages), book_id)).rowcount:
+                return False
+            self._delete(conn, book_id)
+            for ordinal, (page, content, search_text, tokens) in enumerate(passages):
+                if conn.dialect == 'postgresql':
+                    conn.execute(
+                        'INSERT INTO book_passages (book_id, ordinal, page, content, search_text, tokens) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (book_id, ordinal, page, content, search_text, tokens)
+                    )
+                else:
+                    passage_id = conn.insert(
+                        'INSERT INTO book_passages (book_id, ordinal, page, content, tokens) VALUES (?, ?, ?, ?, ?)',
+                        (book_id, ordinal, page, content, tokens)
+                    )
+                    conn.execute('INSERT INTO book_passages_fts (rowid, book, body) VALUES (?, ?, ?)',
+                                 (passage_id, f'b{book_id}', search_text))
+        return True
+
+    def remove(self, book_id):
+        with self.connect() as conn:
+            self._delete(conn, book_id)
+
+    @staticmethod
+    def _delete(conn, book_id):
+        if conn.dialect != 'postgresql':
+            conn.execute('DELETE FROM book_passages_fts WHERE rowid IN '
+                         '(SELECT id FROM book_passages WHERE book_id = ?)', (book_id,))
+        conn.execute('DELETE FROM book_passages WHERE book_id = ?', (book_id,))
+
+    def search(self, book_id, question, limit=QA_CANDIDATES):
+        """A book's passages best matching question, best first."""
+        terms = question_terms(question)
+        if not terms:
+            return []
+        with self.connect() as conn:
+            if conn.dialect == 'postgresql':
+                query = ' | '.join("'{}'".format(term.replace("'", "''")) for term in terms)
+                return conn.execute(
+                    "SELECT id, ordinal, page, content, tokens, "
+                    "ts_rank_cd(to_tsvector('simple', search_text), to_tsquery('simple', ?)) AS score "
+                    "FROM book_passages WHERE book_id = ? "
+                    "AND to_tsvector('simple', search_text) @@ to_tsquery('simple', ?) "
+                    "ORDER BY score DESC, ordinal LIMIT ?",
+                    (query, book_id, query, limit)
+                ).fetchall()
+            # The book's own token narrows the match inside the index; its
+            # column has no weight in the ranking
+            match = 'book : "b{}" AND body : ({})'.format(
+                book_id, ' OR '.join('"{}"'.format(term.replace('"', '""')) for term in terms))
+            return conn.execute(
+                'SELECT p.id, p.ordinal, p.page, p.content, p.tokens, '
+                'bm25(book_passages_fts, 0.0, 1.0) AS score '
+                'FROM book_passages_fts JOIN book_passages p ON p.id = book_passages_fts.rowid '
+                'WHERE book_passages_fts MATCH ? ORDER BY score, p.ordinal LIMIT ?',
+                (match, limit)
+            ).fetchall()
+
+    def opening(self, book_id, limit=QA_CANDIDATES):
+        """A book's first passages, for questions that match nothing in particular."""
+        with self.connect() as conn:
+            return conn.execute(
+                'SELECT id, ordinal, page, content, tokens FROM book_passages '
+                'WHERE book_id = ? ORDER BY ordinal LIMIT ?',
+                (book_id, limit)
+            ).fetchall()
+
+    def context(self, book_id, question, budget=QA_CONTEXT_TOKENS):
+        """Passages to answer question from: the best ones that fit budget, in reading order."""
+        candidates = self.search(book_id, question) or self.opening(book_id)
+        chosen, spent = [], 0
+        for passage in candidates:
+            if spent + passage['tokens'] > budget:
+                continue
+            chosen.append(passage)
+            spent += passage['tokens']
+        return sorted(chosen, key=lambda passage: passage['ordinal'])
+
+    def backfill(self, storage, wait=True):
+        """Extract passages for every book not yet indexed; returns how many were queued."""
+        with self.connect() as conn:
+            rows = conn.execute('SELECT id, filename FROM books WHERE passage_count IS NULL').fetchall()
+        queued = 0
+        for row in rows:
+            if storage.exists('uploads', row['filename']) and self.schedule(storage, row['id'], row['filename']):
+                queued += 1
+        if wait:
+            shutdown_process_pool('passages')
+        return queued
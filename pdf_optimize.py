@@ -0,0 +1,124 @@
+"""
+Optional PDF optimization stage for uploads.
+
+Each uploaded PDF is rewritten with pikepdf (qpdf): linearized ("fast web
+view", so browsers can show page one before the whole file arrives), with
+streams recompressed losslessly and objects packed into object streams.
+Image content is left untouched. The rewrite replaces the upload only when it
+is worth it: a non-linearized file is swapped for its linearized version as
+long as it does not grow noticeably, and an already linearized one only if
+it shrinks by at least MIN_SAVING_RATIO.
+
+Runs in a process pool off the request path. The outcome is recorded per
+book in original_size, stored_size and optimized (1 rewritten, 0 kept,
+NULL not attempted). Set PDF_OPTIMIZE=0 to disable the stage; without
+pikepdf installed it is skipped.
+"""
+import os
+import importlib.util
+
+from process_pool import get_process_pool, shutdown_process_pool
+from storage import create_storage
+
+PDF_OPTIMIZE_ENABLED = os.getenv('PDF_OPTIMIZE', '1') != '0'
+PDF_OPTIMIZE_WORKERS = int(os.getenv('PDF_OPTIMIZE_WORKERS', '2'))
+MIN_SAVING_RATIO = 0.05   # required saving for files that are already linearized
+MAX_GROWTH_RATIO = 0.01   # linearization hint tables may add this much
+
+
+def optimization_available():
+    """Return True if the stage is enabled and pikepdf is installed."""
+    return PDF_OPTIMIZE_ENABLED and importlib.util.find_spec('pikepdf') is not None
+
+
+def optimize_pdf(storage_config, pdf_name):
+    """Rewrite a stored PDF in place if worthwhile. Runs in a pool process.
+
+    Returns (original_size, stored_size, replaced).
+    """
+    import pikepdf
+
+    storage = create_storage(storage_config)
+    with storage.local_copy('uploads', pdf_name) as pdf_path:
+        original_size = os.path.getsize(pdf_path)
+        tmp_path = f'{pdf_path}.{os.getpid()}.optimizing'
+        try:
+            with pikepdf.open(pdf_path) as pdf:
+                was_linearized = pdf.is_linearized
+                pdf.save(
+                    tmp_path,
+                    linearize=True,
+                    compress_streams=True,
+                    recompress_flate=True,
+                    object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                )
+            new_size = os.path.getsize(tmp_path)
+            if was_linearized:
+                worthwhile = new_size <= original_size * (1 - MIN_SAVING_RATIO)
+            else:
+                worthwhile = new_size <= original_size * (1 + MAX_GROWTH_RATIO)
+            if not worthwhile:
+                return original_size, original_size, False
+            # Local readers that already opened the old file keep reading the old inode
+            storage.put_file('uploads', pdf_name, tmp_path)
+            return original_size, new_size, True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def schedule_optimization(connect, storage, book_id, pdf_name):
+    """Queue optimization of a book's PDF; returns False if the stage is unavailable."""
+    if not optimization_available():
+        return False
+    future = get_process_pool('pdf_optimize', PDF_OPTIMIZE_WORKERS).submit(optimize_pdf, storage.config, pdf_name)
+    future.add_done_callback(lambda done: _record_optimization(connect, storage, book_id, pdf_name, done))
+    return True
+
+
+def _record_optimization(connect, storage, book_id, pdf_name, future):
+    try:
+        original_size, stored_size, replaced = future.result()
+    except Exception:
+        # Encrypted or damaged PDFs are kept exactly as uploaded
+        try:
+            original_size = stored_size = storage.size('uploads', pdf_name)
+        except Exception:
+            original_size = stored_size = None
+        replaced = False
+    conn = connect()
+    try:
+        conn.execute(
+            'UPDATE books SET original_size = ?, stored_size = ?, optimized = ? WHERE id = ?',
+            (original_size, stored_size, int(replaced), book_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def backfill_optimization(connect, storage):
+    """Optimize every book not yet attempted and wait for the pool to finish.
+
+    Returns (books queued, total original bytes, total stored bytes) for the
+    whole library after the run.
+    """
+    conn = connect()
+    try:
+        rows = conn.execute('SELECT id, filename FROM books WHERE optimized IS NULL').fetchall()
+    finally:
+        conn.close()
+    queued = 0
+    for row in rows:
+        if storage.exists('uploads', row['filename']) and schedule_optimization(connect, storage, row['id'], row['filename']):
+            queued += 1
+    shutdown_process_pool('pdf_optimize')
+
+    conn = connect()
+    try:
+        totals = conn.execute(
+            'SELECT COALESCE(SUM(original_size), 0), COALESCE(SUM(stored_size), 0) FROM books WHERE optimized IS NOT NULL'
+        ).fetchone()
+    finally:
+        conn.close()
+    return queued, totals[0], totals[1]
@@ -0,0 +1,128 @@
+"""
+First-page previews of uploaded PDFs, rendered off the request path.
+
+Pages are rasterized with PyMuPDF and saved as WebP with Pillow in a small
+process pool, so a slow or huge scan never holds a web worker. Previews are
+stored in the 'previews' storage area. Each preview is rendered once:
+existing pages are skipped, and the result is recorded on the book row
+(preview_filename, preview_pages) for pages to use as an automatic cover;
+preview_pages = 0 marks a PDF that could not be rendered, so it is not retried.
+Both libraries are optional; without them previews are simply not made.
+"""
+import os
+import tempfile
+import threading
+import importlib.util
+
+from process_pool import get_process_pool, shutdown_process_pool
+from storage import create_storage
+
+PREVIEW_FOLDER = os.path.join('static', 'previews')  # local storage location
+PREVIEW_PAGES = int(os.getenv('PREVIEW_PAGES', '3'))
+PREVIEW_WIDTH = 600  # pixels; enough for a detail-page cover at 2x
+PREVIEW_WORKERS = int(os.getenv('PREVIEW_WORKERS', '2'))
+
+_pending = set()  # book ids queued by this process
+_pending_lock = threading.Lock()
+
+
+def previews_available():
+    """Return True if PyMuPDF and Pillow are both installed (without importing them here)."""
+    return all(importlib.util.find_spec(name) is not None for name in ('pymupdf', 'PIL'))
+
+
+def preview_filename(book_id, page_number):
+    """Name of the WebP preview of a (1-based) page of a book."""
+    return f'book_{book_id}_p{page_number}.webp'
+
+
+def render_previews(storage_config, book_id, pdf_name, pages=PREVIEW_PAGES, width=PREVIEW_WIDTH):
+    """Rasterize the first pages of a book's PDF into the 'previews' area.
+
+    Runs in a pool process. Returns the number of pages rendered, which may
+    be fewer than requested for short documents.
+    """
+    import pymupdf
+    from PIL import Image
+
+    storage = create_storage(storage_config)
+    with storage.local_copy('uploads', pdf_name) as pdf_path, pymupdf.open(pdf_path) as document:
+        page_count = min(pages, document.page_count)
+        for index in range(page_count):
+            name = preview_filename(book_id, index + 1)
+            if storage.exists('previews', name):
+                continue
+            page = document.load_page(index)
+            zoom = width / page.rect.width if page.rect.width else 1
+            pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+            image = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+            fd, tmp_path = tempfile.mkstemp(suffix='.webp')
+            os.close(fd)
+            try:
+                image.save(tmp_path, 'WEBP', quality=80, method=4)
+                storage.put_file('previews', name, tmp_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    return page_count
+
+
+def schedule_preview(connect, storage, book_id, pdf_name):
+    """Queue preview rendering for a book; returns without waiting.
+
+    Returns False if previews are unavailable or the book is already queued
+    in this process.
+    """
+    if not previews_available():
+        return False
+    with _pending_lock:
+        if book_id in _pending:
+            return False
+        _pending.add(book_id)
+    future = get_process_pool('previews', PREVIEW_WORKERS).submit(render_previews, storage.config, book_id, pdf_name)
+    future.add_done_callback(lambda done: _record_preview(connect, book_id, done))
+    return True
+
+
+def _record_preview(connect, book_id, future):
+    with _pending_lock:
+        _pending.discard(book_id)
+    try:
+        page_count = future.result()
+    except Exception:
+        # Broken, encrypted or missing PDFs keep no preview
+        page_count = 0
+    conn = connect()
+    try:
+        conn.execute(
+            'UPDATE books SET preview_filename = ?, preview_pages = ? WHERE id = ?',
+            (preview_filename(book_id, 1) if page_count else None, page_count, book_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def delete_previews(storage, book_id, pages=PREVIEW_PAGES):
+    """Remove a book's preview files, ignoring ones that do not exist."""
+    for page_number in range(1, pages + 1):
+        try:
+            storage.delete('previews', preview_filename(book_id, page_number))
+        except Exception:
+            pass
+
+
+def backfill_previews(connect, storage, wait=True):
+    """Render previews for every book not yet attempted; returns how many were queued."""
+    conn = connect()
+    try:
+        rows = conn.execute('SELECT id, filename FROM books WHERE preview_pages IS NULL').fetchall()
+    finally:
+        conn.close()
+    queued = 0
+    for row in rows:
+        if storage.exists('uploads', row['filename']) and schedule_preview(connect, storage, row['id'], row['filename']):
+            queued += 1
+    if wait:
+        shutdown_process_pool('previews')
+    return queued
@@ -0,0 +1,38 @@
+"""
+Per-process worker pools for CPU-heavy background work (PDF rendering,
+PDF optimization).
+
+Pools are created on first use in each web worker and use spawned rather
+than forked children: web workers run threads, and forking a threaded
+process can copy held locks into the child. Task functions must therefore
+live in a module the children can import, not in app.py.
+"""
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+_pools = {}  # name -> (pid, executor)
+_lock = threading.Lock()
+
+
+def get_process_pool(name, max_workers):
+    """Return this process's pool called name, creating it on first use."""
+    pid = os.getpid()
+    entry = _pools.get(name)
+    if entry is None or entry[0] != pid:
+        with _lock:
+            entry = _pools.get(name)
+            if entry is None or entry[0] != pid:
+                executor = ProcessPoolExecutor(max_workers=max_workers,
+                                               mp_context=multiprocessing.get_context('spawn'))
+                entry = _pools[name] = (pid, executor)
+    return entry[1]
+
+
+def shutdown_process_pool(name, wait=True):
+    """Shut down a pool (e.g. at the end of a CLI backfill) if this process has one."""
+    with _lock:
+        entry = _pools.pop(name, None)
+    if entry is not None and entry[0] == os.getpid():
+        entry[1].shutdown(wait=wait)
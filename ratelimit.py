@@ -0,0 +1,149 @@
+"""
+Admission control for OpenAI calls, shared by every worker process.
+
+State lives in the library database, so the limits hold across gunicorn
+workers and, on PostgreSQL, across app hosts:
+
+  ai_rate_limits  one token bucket row per limiter; every acquire() locks it,
+                  which serializes admission decisions
+  ai_leases       one row per call in flight (the concurrency semaphore);
+                  leases expire, so a crashed worker cannot leak a slot
+  ai_usage        calls per user per quota window
+
+acquire() never waits: when a limit is reached it raises LimitExceeded with
+the number of seconds after which a retry may succeed, and the caller sheds
+the request instead of tying up a web worker.
+"""
+import os
+import math
+import time
+import uuid
+from contextlib import contextmanager
+
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', '4'))
+OPENAI_RATE_PER_MINUTE = float(os.getenv('OPENAI_RATE_PER_MINUTE', '60'))
+OPENAI_BURST = int(os.getenv('OPENAI_BURST', '10'))
+OPENAI_USER_QUOTA = int(os.getenv('OPENAI_USER_QUOTA', '30'))  # calls per user per window; 0 = unlimited
+OPENAI_QUOTA_WINDOW = 60 * 60
+LEASE_SECONDS = 120          # a synchronous call never holds its slot longer than this
+BUSY_RETRY_AFTER = 2         # hint when all slots are taken; calls are short
+
+
+class LimitExceeded(Exception):
+    """Raised by acquire(); reason is 'concurrency', 'rate' or 'quota'."""
+
+    def __init__(self, reason, retry_after):
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f'{reason} limit reached, retry after {self.retry_after}s')
+
+
+class RateLimiter:
+    """Concurrency cap, token bucket and per-user quota for one upstream API."""
+
+    def __init__(self, connect, name='openai', max_concurrency=OPENAI_MAX_CONCURRENCY,
+                 rate_per_minute=OPENAI_RATE_PER_MINUTE, burst=OPENAI_BURST,
+                 user_quota=OPENAI_USER_QUOTA, quota_window=OPENAI_QUOTA_WINDOW):
+        self.connect = connect
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.user_quota = user_quota
+        self.quota_window = quota_window
+
+    def acquire(self, user_key, lease_seconds=LEASE_SECONDS):
+        """Admit one call for user_key and return its lease id, or raise LimitExceeded."""
+        now = time.time()
+        window_start = int(now // self.quota_window) * self.quota_window
+        conn = self.connect()
+        try:
+            conn.execute(
+                'INSERT INTO ai_rate_limits (name, tokens, updated_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (name) DO NOTHING',
+                (self.name, self.burst, now)
+            )
+            # Writing the row first takes its lock, so the checks below see a
+            # state no other worker can change before this transaction commits
+            conn.execute('UPDATE ai_rate_limits SET tokens = tokens WHERE name = ?', (self.name,))
+            bucket = conn.execute(
+                'SELECT tokens, updated_at FROM ai_rate_limits WHERE name = ?', (self.name,)
+            ).fetchone()
+
+            conn.execute('DELETE FROM ai_leases WHERE name = ? AND expires_at < ?', (self.name, now))
+            in_flight = conn.execute('SELECT COUNT(*) FROM ai_leases WHERE name = ?', (self.name,)).fetchone()[0]
+            if in_flight >= self.max_concurrency:
+                raise LimitExceeded('concurrency', BUSY_RETRY_AFTER)
+
+            if self.user_quota:
+                usage = conn.execute(
+                    'SELECT count FROM ai_usage WHERE name = ? AND user_key = ? AND window_start = ?',
+                    (self.name, user_key, window_start)
+                ).fetchone()
+                if usage is not None and usage[0] >= self.user_quota:
+                    raise LimitExceeded('quota', window_start + self.quota_window - now)
+
+            tokens = min(self.burst, bucket[0] + max(0.0, now - bucket[1]) * self.rate)
+            if tokens < 1:
+                raise LimitExceeded('rate', (1 - tokens) / self.rate if self.rate else self.quota_window)
+
+            lease_id = uuid.uuid4().hex
+            conn.execute(
+                'UPDATE ai_rate_limits SET tokens = ?, updated_at = ? WHERE name = ?',
+                (tokens - 1, now, self.name)
+            )
+            conn.execute(
+                'INSERT INTO ai_leases (id, name, user_key, window_start, expires_at) VALUES (?, ?, ?, ?, ?)',
+                (lease_id, self.name, user_key, window_start, now + lease_seconds)
+            )
+            conn.execute(
+                'INSERT INTO ai_usage (name, user_key, window_start, count) VALUES (?, ?, ?, 1) '
+                'ON CONFLICT (name, user_key, window_start) DO UPDATE SET count = ai_usage.count + 1',
+                (self.name, user_key, window_start)
+            )
+            # Keep a day of history for inspection, no more
+            conn.execute(
+                'DELETE FROM ai_usage WHERE name = ? AND window_start < ?',
+                (self.name, window_start - 24 * 60 * 60)
+            )
+            conn.commit()
+            return lease_id
+        finally:
+            conn.close()
+
+    def release(self, lease_id, refund=False):
+        """Free a lease's slot; refund=True also gives back its token and quota charge.
+
+        Refund a call that never reached the API, such as a cancelled job.
+        """
+        conn = self.connect()
+        try:
+            lease = conn.execute(
+                'SELECT name, user_key, window_start FROM ai_leases WHERE id = ?', (lease_id,)
+            ).fetchone()
+            if lease is None:
+                return
+            conn.execute('DELETE FROM ai_leases WHERE id = ?', (lease_id,))
+            if refund:
+                conn.execute(
+                    'UPDATE ai_rate_limits SET tokens = CASE WHEN tokens + 1 > ? THEN ? ELSE tokens + 1 END '
+                    'WHERE name = ?',
+                    (self.burst, self.burst, lease['name'])
+                )
+                conn.execute(
+                    'UPDATE ai_usage SET count = count - 1 '
+                    'WHERE name = ? AND user_key = ? AND window_start = ? AND count > 0',
+                    (lease['name'], lease['user_key'], lease['window_start'])
+                )
+            conn.commit()
+        finally:
+            conn.close()
+
+    @contextmanager
+    def slot(self, user_key):
+        """Hold a lease for the duration of a synchronous call."""
+        lease_id = self.acquire(user_key)
+        try:
+            yield lease_id
+        finally:
+            self.release(lease_id)
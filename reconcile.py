@@ -0,0 +1,193 @@
+"""
+Reconciler for stored files that no database row refers to.
+
+Orphans are left behind when an upload fails half way, when delete_book()
+cannot remove a file, or when rows are removed by hand. reconcile() lists
+each storage area in batches (os.scandir locally, paged listings on S3) and
+checks every batch against the referencing columns with one indexed IN
+query per column. Orphans are first moved into the area's .quarantine
+folder and only deleted once they have sat there for QUARANTINE_SECONDS;
+a quarantined file that is referenced again is put back instead.
+
+Safe to run while uploads are in progress: add_book() stores a file before
+inserting its row, so files younger than MIN_AGE_SECONDS are never touched,
+and each batch is looked up in the database just before it is moved.
+
+Run it with `flask reconcile-files`, or set RECONCILE_INTERVAL (seconds) to
+have one gunicorn worker at a time run it in the background.
+"""
+import os
+import re
+import json
+import time
+import random
+import threading
+from itertools import islice
+
+QUARANTINE_FOLDER = '.quarantine'
+MIN_AGE_SECONDS = 60 * 60
+QUARANTINE_SECONDS = 7 * 24 * 60 * 60
+BATCH_SIZE = 500
+RECONCILE_INTERVAL = int(os.getenv('RECONCILE_INTERVAL', '0'))  # 0 = background runs off
+
+# Columns whose values name files in each area
+REFERENCES = {
+    'uploads': [('books', 'filename')],
+    'covers': [('books', 'image_filename'), ('category_books', 'cover_filename')],
+}
+# Previews are named after their book (see previews.preview_filename)
+_PREVIEW_NAME = re.compile(r'^book_(\d+)_p\d+\.webp$')
+
+_thread = None
+_thread_pid = None
+_thread_lock = threading.Lock()
+
+
+def _batches(iterable, size=BATCH_SIZE):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def referenced_names(conn, area, names):
+    """Return the subset of names that a database row refers to."""
+    if not names:
+        return set()
+    if area == 'previews':
+        book_ids = {}
+        for name in names:
+            match = _PREVIEW_NAME.match(name)
+            if match:
+                book_ids.setdefault(int(match.group(1)), []).append(name)
+        if not book_ids:
+            return set()
+        placeholders = ','.join('?' * len(book_ids))
+        live = conn.execute(f'SELECT id FROM books WHERE id IN ({placeholders})', list(book_ids)).fetchall()
+        return {name for row in live for name in book_ids[row[0]]}
+    referenced = set()
+    placeholders = ','.join('?' * len(names))
+    for table, column in REFERENCES[area]:
+        referenced.update(row[0] for row in conn.execute(
+            f'SELECT {column} FROM {table} WHERE {column} IN ({placeholders})', list(names)
+        ))
+    return referenced
+
+
+def _empty_report():
+    return {'scanned': 0, 'quarantined': 0, 'quarantined_bytes': 0,
+            'restored': 0, 'deleted': 0, 'reclaimed_bytes': 0}
+
+
+def reconcile(connect, storage, areas=('uploads', 'covers', 'previews'), dry_run=False):
+    """Quarantine orphaned files and delete expired quarantined ones.
+
+    Returns {area: counts} including the bytes reclaimed by deletion. With
+    dry_run=True nothing is moved or deleted; the report says what would be.
+    """
+    now = time.time()
+    report = {}
+    for area in areas:
+        counts = report[area] = _empty_report()
+
+        for batch in _batches(storage.list_files(area)):
+            counts['scanned'] += len(batch)
+            old_enough = {name: size for name, size, mtime in batch if mtime < now - MIN_AGE_SECONDS}
+            conn = connect()
+            try:
+                referenced = referenced_names(conn, area, list(old_enough))
+            finally:
+                conn.close()
+            for name, size in old_enough.items():
+                if name in referenced:
+                    continue
+                if not dry_run:
+                    try:
+                        storage.move(area, name, f'{QUARANTINE_FOLDER}/{name}')
+                    except FileNotFoundError:
+                        continue  # deleted by someone else in the meantime
+                counts['quarantined'] += 1
+                counts['quarantined_bytes'] += size
+
+        for batch in _batches(storage.list_files(area, QUARANTINE_FOLDER)):
+            conn = connect()
+            try:
+                referenced = referenced_names(conn, area, [name for name, _, _ in batch])
+            finally:
+                conn.close()
+            for name, size, mtime in batch:
+                quarantined_name = f'{QUARANTINE_FOLDER}/{name}'
+                if name in referenced:
+                    # A row points at it again (e.g. restored by hand): put it back
+                    if not dry_run and not storage.exists(area, name):
+                        try:
+                            storage.move(area, quarantined_name, name)
+                        except FileNotFoundError:
+                            continue  # deleted by someone else in the meantime
+                    counts['restored'] += 1
+                elif mtime < now - QUARANTINE_SECONDS:
+                    if dry_run or storage.delete(area, quarantined_name):
+                        counts['deleted'] += 1
+                        counts['reclaimed_bytes'] += size
+    return report
+
+
+def _claim_run(connect, interval):
+    """Return True if this process may run now; at most one run per interval overall."""
+    now = time.time()
+    conn = connect()
+    try:
+        conn.execute(
+            'INSERT INTO maintenance_runs (name, last_run) VALUES (?, 0) ON CONFLICT (name) DO NOTHING',
+            ('reconcile',)
+        )
+        claimed = conn.execute(
+            'UPDATE maintenance_runs SET last_run = ? WHERE name = ? AND last_run <= ?',
+            (now, 'reconcile', now - interval)
+        ).rowcount == 1
+        conn.commit()
+        return claimed
+    finally:
+        conn.close()
+
+
+def _record_run(connect, report):
+    conn = connect()
+    try:
+        conn.execute('UPDATE maintenance_runs SET last_report = ? WHERE name = ?',
+                     (json.dumps(report), 'reconcile'))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _run_periodically(connect, storage, interval):
+    while True:
+        # Jitter keeps workers from all polling at the same instant
+        time.sleep(interval / 4 * (0.5 + random.random()))
+        try:
+            if _claim_run(connect, interval):
+                report = reconcile(connect, storage)
+                _record_run(connect, report)
+        except Exception as exc:
+            try:
+                _record_run(connect, {'error': str(exc)})
+            except Exception:
+                pass
+
+
+def start_reconciler(connect, storage, interval=RECONCILE_INTERVAL):
+    """Start this process's background reconciler thread; no-op if disabled or running."""
+    global _thread, _thread_pid
+    if interval <= 0:
+        return False
+    with _thread_lock:
+        if _thread is not None and _thread_pid == os.getpid():
+            return False
+        _thread = threading.Thread(target=_run_periodically, args=(connect, storage, interval),
+                                   name='reconciler', daemon=True)
+        _thread.start()
+        _thread_pid = os.getpid()
+    return True
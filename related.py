@@ -0,0 +1,297 @@
+"""
+"Related books", precomputed from TF-IDF similarity.
+
+Every book is a TF-IDF vector over the normalized words of its title
+(counted twice), author, description and discipline. The RELATED_COUNT
+most similar books by cosine similarity are stored per book in the
+related_books table, so the detail page reads them with one indexed lookup.
+
+Lists are maintained incrementally. A new book is scored against the whole
+catalogue with one sparse matrix-vector product, which gives its own list
+and shows which existing lists it now belongs in. A deleted book only
+causes the lists it appeared in to be recomputed. IDF weights drift slowly
+as the catalogue grows; `flask rebuild-related` recomputes every list.
+
+The model lives in memory in the worker that performs the update and is
+caught up from the database before each change. Updates run on one
+background thread per worker. NumPy is optional: without it no lists are
+computed and the panel stays empty.
+"""
+import os
+import threading
+import importlib.util
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from textnorm import normalize_text
+
+RELATED_COUNT = 6
+MIN_SIMILARITY = 0.05
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def related_available():
+    """Return True if NumPy is installed (without importing it here)."""
+    return importlib.util.find_spec('numpy') is not None
+
+
+def _get_executor():
+    """One thread per process, so model updates never interleave."""
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='related')
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def book_terms(title, author, description, discipline):
+    """Term counts for one book; the title is weighted twice."""
+    counts = Counter()
+    for text, weight in ((title, 2), (author, 1), (description, 1)):
+        for word in normalize_text(text or '').split():
+            if len(word) > 1:
+                counts[word] += weight
+    if discipline:
+        counts[f'discipline:{discipline}'] += 1
+    return counts
+
+
+class RelatedBooks:
+    """TF-IDF model of the catalogue and the writer of related_books."""
+
+    def __init__(self, count=RELATED_COUNT, min_similarity=MIN_SIMILARITY):
+        self.count = count
+        self.min_similarity = min_similarity
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._vocab = {}         # term -> column
+        self._row_of = {}        # book_id -> row
+        self._book_ids = []      # row -> book_id, None once deleted
+        self._row_terms = []     # row -> (term columns, term counts) arrays
+        self._floor = []         # row -> score a newcomer must beat to join the list
+        self._max_id = 0
+        self._loaded = False
+        self._matrix = None      # weights, rebuilt lazily after changes
+
+    # -- scheduling ---------------------------------------------------------
+
+    def schedule_add(self, connect, book_id):
+        """Compute a new book's list and slot it into others, off the request path."""
+        if not related_available():
+            return False
+        _get_executor().submit(self.add_book, connect, book_id)
+        return True
+
+    def schedule_remove(self, connect, book_id):
+        """Drop a deleted book from every list, off the request path."""
+        if not related_available():
+            return False
+        _get_executor().submit(self.remove_book, connect, book_id)
+        return True
+
+    # -- model --------------------------------------------------------------
+
+    def _append(self, book_id, terms):
+        import numpy as np
+
+        columns = [self._vocab.setdefault(term, len(self._vocab)) for term in terms]
+        self._row_of[book_id] = len(self._book_ids)
+        self._book_ids.append(book_id)
+        self._row_terms.append((np.array(columns, dtype=np.int64),
+                                np.array(list(terms.values()), dtype=np.float64)))
+        self._floor.append(0.0)
+        self._max_id = max(self._max_id, book_id)
+        self._matrix = None
+
+    def _drop(self, book_id):
+        import numpy as np
+
+        row = self._row_of.pop(book_id, None)
+        if row is not None:
+            self._book_ids[row] = None
+            self._row_terms[row] = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64))
+            self._matrix = None
+
+    def sync(self, connect):
+        """Catch the model up with books added or deleted by any worker."""
+        with self._lock:
+            conn = connect()
+            try:
+                if not self._loaded:
+                    floors = {row[0]: (row[1], row[2]) for row in conn.execute(
+                        'SELECT book_id, COUNT(*), MIN(score) FROM related_books GROUP BY book_id'
+                    )}
+                new_rows = conn.execute(
+                    'SELECT id, title, author, description, discipline FROM books WHERE id > ? ORDER BY id',
+                    (self._max_id,)
+                ).fetchall()
+                for row in new_rows:
+                    self._append(row[0], book_terms(row[1], row[2], row[3], row[4]))
+                count = conn.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+                if count != len(self._row_of):
+                    live_ids = {row[0] for row in conn.execute('SELECT id FROM books')}
+                    for book_id in set(self._row_of) - live_ids:
+                        self._drop(book_id)
+            finally:
+                conn.close()
+            if not self._loaded:
+                for book_id, (listed, lowest) in floors.items():
+                    row = self._row_of.get(book_id)
+                    if row is not None and listed >= self.count:
+                        self._floor[row] = lowest
+                self._loaded = True
+
+    def _weights(self):
+        """L2-normalized TF-IDF weights as flat (terms, weights, rows, row_ptr) arrays."""
+        import numpy as np
+
+        if self._matrix is not None:
+            return self._matrix
+        lengths = np.array([len(columns) for columns, _ in self._row_terms], dtype=np.int64)
+        if lengths.sum():
+            terms = np.concatenate([columns for columns, _ in self._row_terms])
+            tfs = np.concatenate([counts for _, counts in self._row_terms])
+        else:
+            terms, tfs = np.zeros(0, dtype=np.int64), np.zeros(0)
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        row_ptr = np.concatenate(([0], np.cumsum(lengths)))
+
+        document_frequency = np.bincount(terms, minlength=len(self._vocab))
+        idf = np.log((1 + len(self._row_of)) / (1 + document_frequency)) + 1
+        weights = (1 + np.log(tfs)) * idf[terms]
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=len(lengths)))
+        weights = weights / np.where(norms > 0, norms, 1)[rows]
+        self._matrix = (terms, weights, rows, row_ptr)
+        return self._matrix
+
+    def _scores(self, row):
+        """Cosine similarity of one row to every row: a sparse matrix-vector product."""
+        import numpy as np
+
+        terms, weights, rows, row_ptr = self._weights()
+        query = np.zeros(len(self._vocab))
+        query[terms[row_ptr[row]:row_ptr[row + 1]]] = weights[row_ptr[row]:row_ptr[row + 1]]
+        scores = np.bincount(rows, weights=weights * query[terms], minlength=len(self._book_ids))
+        scores[row] = 0.0
+        return scores
+
+    def _all_scores(self):
+        """Yield (row, scores) for every live row, for a full rebuild.
+
+        Uses a column-sorted copy of the weights so each row only touches the
+        postings of its own terms, instead of the whole matrix per row.
+        """
+        import numpy as np
+
+        terms, weights, rows, row_ptr = self._weights()
+        order = np.argsort(terms, kind='stable')
+        col_rows, col_weights = rows[order], weights[order]
+        col_ptr = np.concatenate(([0], np.cumsum(np.bincount(terms, minlength=len(self._vocab)))))
+        for row in self._row_of.values():
+            query_terms = terms[row_ptr[row]:row_ptr[row + 1]]
+            query_weights = weights[row_ptr[row]:row_ptr[row + 1]]
+            starts = col_ptr[query_terms]
+            lengths = col_ptr[query_terms + 1] - starts
+            # Indices of every posting of every query term, without a Python loop
+            postings = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+            postings += np.arange(lengths.sum())
+            scores = np.bincount(col_rows[postings],
+                                 weights=col_weights[postings] * np.repeat(query_weights, lengths),
+                                 minlength=len(self._book_ids))
+            scores[row] = 0.0
+            yield row, scores
+
+    def _top(self, scores):
+        """[(book_id, score)] of the best rows above the similarity floor."""
+        import numpy as np
+
+        candidates = np.flatnonzero(scores >= self.min_similarity)
+        if len(candidates) > self.count:
+            candidates = candidates[np.argpartition(scores[candidates], -self.count)[-self.count:]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(self._book_ids[row], float(scores[row])) for row in candidates]
+
+    # -- related_books ------------------------------------------------------
+
+    def _store(self, conn, book_id, neighbours):
+        conn.execute('DELETE FROM related_books WHERE book_id = ?', (book_id,))
+        conn.executemany(
+            'INSERT INTO related_books (book_id, related_id, score) VALUES (?, ?, ?)',
+            [(book_id, related_id, score) for related_id, score in neighbours]
+        )
+        row = self._row_of.get(book_id)
+        if row is not None:
+            self._floor[row] = neighbours[-1][1] if len(neighbours) >= self.count else 0.0
+
+    def _recompute(self, conn, book_ids):
+        for book_id in book_ids:
+            row = self._row_of.get(book_id)
+            if row is not None:
+                self._store(conn, book_id, self._top(self._scores(row)))
+
+    def add_book(self, connect, book_id):
+        """Store a book's neighbours and add it to the lists it now belongs in."""
+        import numpy as np
+
+        with self._lock:
+            self.sync(connect)
+            row = self._row_of.get(book_id)
+            if row is None:
+                return
+            scores = self._scores(row)
+            floors = np.array(self._floor)
+            # Symmetric similarity: the book joins every list whose floor it beats
+            joins = np.flatnonzero((scores >= self.min_similarity) & (scores > floors))
+            conn = connect()
+            try:
+                self._store(conn, book_id, self._top(scores))
+                for other in joins:
+                    other_id = self._book_ids[other]
+                    listed = conn.execute(
+                        'SELECT related_id, score FROM related_books WHERE book_id = ?', (other_id,)
+                    ).fetchall()
+                    merged = {related_id: score for related_id, score in listed}
+                    merged[book_id] = float(scores[other])
+                    best = sorted(merged.items(), key=lambda item: -item[1])[:self.count]
+                    self._store(conn, other_id, best)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def remove_book(self, connect, book_id):
+        """Forget a deleted book and refill the lists it appeared in."""
+        with self._lock:
+            self.sync(connect)
+            self._drop(book_id)
+            conn = connect()
+            try:
+                affected = [row[0] for row in conn.execute(
+                    'SELECT book_id FROM related_books WHERE related_id = ?', (book_id,)
+                )]
+                conn.execute('DELETE FROM related_books WHERE book_id = ? OR related_id = ?', (book_id, book_id))
+                self._recompute(conn, affected)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def rebuild(self, connect):
+        """Recompute every list with fresh IDF weights; returns the number of books."""
+        with self._lock:
+            self._reset()
+            self.sync(connect)
+            conn = connect()
+            try:
+                conn.execute('DELETE FROM related_books')
+                for row, scores in self._all_scores():
+                    self._store(conn, self._book_ids[row], self._top(scores))
+                conn.commit()
+            finally:
+                conn.close()
+            return len(self._row_of)
@@ -0,0 +1,208 @@
+"""
+Repository for the books table.
+
+The repository takes the app's connect callable and borrows a pooled
+connection per call, so the same code runs on SQLite and PostgreSQL (see
+db.py). Text search is the one place the SQL differs: PostgreSQL matches
+with a full-text query plus ILIKE (served by the GIN indexes created in
+init_database() when pg_trgm is installed), SQLite with LIKE.
+
+Listing pages take their rows as LazyRows, which are fetched while the
+template renders them, so a page's memory does not grow with the catalogue.
+"""
+from collation import SORT_KEY_COLUMNS, book_sort_keys, sort_language
+
+# ORDER BY clauses for the book listings' sort options; {language} is the
+# interface language whose collation keys order titles and authors
+BOOK_ORDERINGS = {
+    'newest': 'upload_date DESC, id DESC',
+    # Counters are written behind by counters.py, so this lags by one flush
+    'popular': 'download_count DESC, view_count DESC, upload_date DESC, id DESC',
+    # Precomputed keys (see collation.py), so these are index scans too
+    'title': 'title_sort_{language}, id',
+    'author': 'author_sort_{language}, title_sort_{language}, id',
+}
+
+_INSERTED_COLUMNS = ('title', 'author', 'description', 'filename', 'image_filename', 'discipline',
+                     'publication_year') + SORT_KEY_COLUMNS
+_INSERT_BOOK = 'INSERT INTO books ({}) VALUES ({})'.format(
+    ', '.join(_INSERTED_COLUMNS), ', '.join('?' for _ in _INSERTED_COLUMNS))
+
+
+def order_by(sort, language='en'):
+    """The ORDER BY clause of one of the BOOK_ORDERINGS for an interface language."""
+    return BOOK_ORDERINGS[sort].format(language=sort_language(language))
+
+
+class LazyRows:
+    """The rows of a query, fetched in batches as they are iterated.
+
+    An iteration reads the rows through a pooled connection of its own,
+    which stays borrowed until the iteration ends. On a streamed page that
+    is as long as the client takes to receive the listing, so a slow client
+    holds a connection that long: size DB_POOL_SIZE for the streamed pages
+    expected in flight at once, not only for the requests being handled.
+
+    A truth test starts the iteration to see the first row, and the next
+    iteration carries on from it, so "{% if rows %}{% for row in rows %}"
+    runs the query once. len() asks the database for a count, once. Any
+    further iteration runs the query again.
+    """
+
+    def __init__(self, connect, sql, params=()):
+        self.connect = connect
+        self.sql = sql
+        self.params = tuple(params)
+        self._count = None
+        self._started = None  # (connection, rows, first row) left by a truth test
+
+    def _start(self):
+        conn = self.connect()
+        try:
+            rows = conn.stream(self.sql, self.params)
+            return conn, rows, next(rows, None)
+        except BaseException:
+            conn.close()
+            raise
+
+    @staticmethod
+    def _finish(conn, rows):
+        try:
+            rows.close()
+        finally:
+            conn.close()
+
+    def __iter__(self):
+        started, self._started = self._started, None
+        conn, rows, first = started or self._start()
+        try:
+            if first is not None:
+                yield first
+                yield from rows
+        finally:
+            self._finish(conn, rows)
+
+    def __len__(self):
+        if self._count is None:
+            with self.connect() as conn:
+                self._count = conn.execute(f'SELECT COUNT(*) FROM ({self.sql}) AS counted',
+                                           self.params).fetchone()[0]
+        return self._count
+
+    def __bool__(self):
+        if self._count is not None:
+            return self._count > 0
+        if self._started is None:
+            self._started = self._start()
+            if self._started[2] is None:
+                # Nothing to carry on from; give the connection back now
+                self._finish(*self._started[:2])
+                self._started = None
+                self._count = 0
+                return False
+        return True
+
+    def __del__(self):
+        # Tested for truth but never iterated
+        if self._started is not None:
+            self._finish(*self._started[:2])
+            self._started = None
+
+
+class BookRepository:
+    """Queries on the books table."""
+
+    def __init__(self, connect, dialect='sqlite'):
+        self.connect = connect
+        self.dialect = dialect
+
+    def get(self, book_id):
+        with self.connect() as conn:
+            return conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
+
+    def latest(self, limit=None):
+        """Books newest first, optionally only the first limit."""
+        return self.ordered('newest', limit)
+
+    def ordered(self, sort='newest', limit=None, language='en'):
+        """Books in one of the BOOK_ORDERINGS, optionally only the first limit."""
+        sql = f'SELECT * FROM books ORDER BY {order_by(sort, language)}'
+        params = ()
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params = (limit,)
+        with self.connect() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def stream_ordered(self, sort='newest', discipline=None, language='en'):
+        """Books in one of the BOOK_ORDERINGS as LazyRows, optionally of one discipline."""
+        if discipline is None:
+            return LazyRows(self.connect, f'SELECT * FROM books ORDER BY {order_by(sort, language)}')
+        return LazyRows(self.connect, f'SELECT * FROM books WHERE discipline = ? ORDER BY {order_by(sort, language)}',
+                        (discipline,))
+
+    def create(self, title, author, description, filename, image_filename=None,
+               discipline=None, publication_year=None):
+        """Insert a book and return its id."""
+        with self.connect() as conn:
+            return conn.insert(
+                _INSERT_BOOK,
+                (title, author, description, filename, image_filename, discipline, publication_year)
+                + book_sort_keys(title, author)
+            )
+
+    def delete(self, book_id):
+        with self.connect() as conn:
+            conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
+
+    def page(self, where_sql='1 = 1', params=(), after=None, limit=50):
+        """Books newest first, continuing after an (upload_date, id) keyset cursor."""
+        sql = f'SELECT * FROM books WHERE ({where_sql})'
+        params = list(params)
+        if after is not None:
+            sql += ' AND (upload_date < ? OR (upload_date = ? AND id < ?))'
+            params += [after[0], after[0], after[1]]
+        sql += ' ORDER BY upload_date DESC, id DESC LIMIT ?'
+        with self.connect() as conn:
+            return conn.execute(sql, params + [limit]).fetchall()
+
+    def related(self, book_id):
+        """The precomputed related books of a book, most similar first."""
+        with self.connect() as conn:
+            return conn.execute(
+                'SELECT books.* FROM related_books JOIN books ON books.id = related_books.related_id '
+                'WHERE related_books.book_id = ? ORDER BY related_books.score DESC',
+                (book_id,)
+            ).fetchall()
+
+    def match_clause(self, query):
+        """Return (sql, params) matching books whose title or author contains query."""
+        pattern = f'%{query}%'
+        if self.dialect == 'postgresql':
+            return (
+                "to_tsvector('simple', title || ' ' || author) @@ plainto_tsquery('simple', ?) "
+                'OR title ILIKE ? OR author ILIKE ?',
+                [query, pattern, pattern]
+            )
+        return 'title LIKE ? OR author LIKE ?', [pattern, pattern]
+
+    def search(self, match_sql, match_params, filter_sql, filter_params, sort='newest', language='en'):
+        """Books matching a match_clause() predicate and facet filters, in one of the BOOK_ORDERINGS."""
+        with self.connect() as conn:
+            return conn.execute(
+                f'SELECT * FROM books WHERE ({match_sql or "1 = 1"}) AND {filter_sql} '
+                f'ORDER BY {order_by(sort, language)}',
+                list(match_params) + list(filter_params)
+            ).fetchall()
+
+    def by_ids(self, book_ids, filter_sql='1 = 1', filter_params=()):
+        """Books with the given ids (in no particular order) that pass the filters."""
+        if not book_ids:
+            return []
+        placeholders = ','.join('?' * len(book_ids))
+        with self.connect() as conn:
+            return conn.execute(
+                f'SELECT * FROM books WHERE id IN ({placeholders}) AND {filter_sql}',
+                list(book_ids) + list(filter_params)
+            ).fetchall()
+
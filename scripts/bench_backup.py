@@ -0,0 +1,124 @@
+"""
+Backup benchmark: how long an online backup takes and what it costs requests.
+
+Builds a synthetic library database in a temporary folder, then runs a
+reader thread (a book lookup plus a listing page query) and a writer thread
+(an insert committed per iteration) twice: once idle and once while
+run_backup() copies the database. Latency percentiles of both are printed
+for the two phases along with the backup report.
+
+Usage:
+    python scripts/bench_backup.py [--books 50000] [--files 200]
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backup import run_backup  # noqa: E402
+from db import Database  # noqa: E402
+from storage import LocalStorage  # noqa: E402
+
+
+def build_library(folder, books, files, rng):
+    path = os.path.join(folder, 'library.db')
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')  # as init_database() sets it
+    conn.execute('CREATE TABLE books (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT, author TEXT, '
+                 'description TEXT, filename TEXT, upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)')
+    conn.executemany(
+        'INSERT INTO books (title, author, description, filename) VALUES (?, ?, ?, ?)',
+        [(f'Book {i}', f'Author {i % 500}', 'lorem ipsum ' * rng.randint(20, 120), f'book_{i}.pdf')
+         for i in range(books)]
+    )
+    conn.commit()
+    conn.close()
+    for area in ('uploads', 'covers'):
+        os.makedirs(os.path.join(folder, area))
+    for i in range(files):
+        with open(os.path.join(folder, 'uploads', f'book_{i}.pdf'), 'wb') as handle:
+            handle.write(os.urandom(rng.randint(50_000, 500_000)))
+    return path
+
+
+def load(path, stop, samples, books):
+    """Alternate a read and a committed write, recording each latency in ms."""
+    conn = sqlite3.connect(path, timeout=30)
+    rng = random.Random()
+    while not stop.is_set():
+        started = time.perf_counter()
+        conn.execute('SELECT * FROM books WHERE id = ?', (rng.randint(1, books),)).fetchone()
+        conn.execute('SELECT * FROM books ORDER BY id DESC LIMIT 20').fetchall()
+        samples['read'].append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        conn.execute("INSERT INTO books (title, author, filename) VALUES ('bench', 'bench', 'bench.pdf')")
+        conn.commit()
+        samples['write'].append((time.perf_counter() - started) * 1000)
+    conn.close()
+
+
+def summarize(values):
+    values = sorted(values)
+    return (f'n={len(values):6d}  p50={statistics.median(values):7.2f}  '
+            f'p99={values[int(len(values) * 0.99) - 1]:7.2f}  max={values[-1]:7.2f} ms')
+
+
+def measure(path, books, seconds=None, during=None):
+    samples = {'read': [], 'write': []}
+    stop = threading.Event()
+    worker = threading.Thread(target=load, args=(path, stop, samples, books))
+    worker.start()
+    result = None
+    if during is not None:
+        result = during()
+    else:
+        time.sleep(seconds)
+    stop.set()
+    worker.join()
+    return samples, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--books', type=int, default=50000)
+    parser.add_argument('--files', type=int, default=200)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='bench-backup-')
+    try:
+        path = build_library(folder, args.books, args.files, random.Random(0))
+        database = Database(f'sqlite:///{path}')
+        storage = LocalStorage({'folders': {'uploads': os.path.join(folder, 'uploads'),
+                                            'covers': os.path.join(folder, 'covers')}})
+        backups = os.path.join(folder, 'backups')
+
+        started = time.perf_counter()
+        samples, report = measure(path, args.books, during=lambda: run_backup(database, storage, backups))
+        duration = time.perf_counter() - started
+        idle, _ = measure(path, args.books, seconds=duration)
+
+        print(f'database: {os.path.getsize(path) / 1e6:.1f} MB, files: {args.files}')
+        print(f"backup:   {report['duration_seconds']:.2f} s, {report['database']['mode']}, "
+              f"{report['database']['steps']} steps, {report['database']['restarts']} restarts, "
+              f"longest step {report['database']['max_step_ms']} ms, archive {report['archive_bytes'] / 1e6:.1f} MB")
+        for kind in ('read', 'write'):
+            print(f'{kind:5s} idle    {summarize(idle[kind])}')
+            print(f'{kind:5s} backup  {summarize(samples[kind])}')
+
+        report = run_backup(database, storage, backups)
+        print(f"incremental backup: {report['duration_seconds']:.2f} s, "
+              f"{report['files']['included']} of {report['files']['total']} files copied")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Duplicate detection benchmark: LSH bucket lookups against a synthetic catalogue.
+
+Fingerprints --books synthetic books (metadata and a page of text each) into
+a temporary SQLite database, then looks up --queries uploads: half are
+re-titled, lightly edited copies of existing books and half are new. Prints
+lookup latency, recall on the copies, false alarms on the new books, and
+the time a comparison against every stored signature takes instead.
+
+Usage:
+    python scripts/bench_duplicates.py [--books 20000] [--queries 500]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_typeahead import percentile  # noqa: E402
+from db import Database  # noqa: E402
+from duplicates import (DuplicateDetector, bucket_keys, minhash, metadata_shingles,  # noqa: E402
+                        pack_minhash, similarity, text_shingles, title_numbers, unpack_minhash)
+
+SCHEMA = [
+    'CREATE TABLE books (id INTEGER PRIMARY KEY, title TEXT, author TEXT)',
+    'CREATE TABLE book_signatures (book_id INTEGER PRIMARY KEY, metadata_minhash BLOB, '
+    'text_minhash BLOB, cover_hash INTEGER)',
+    'CREATE TABLE book_lsh_buckets (bucket INTEGER NOT NULL, book_id INTEGER NOT NULL, '
+    'PRIMARY KEY (bucket, book_id))',
+]
+
+
+def pseudo_words(count, rng):
+    return [''.join(rng.choice('abcdefghijklmnoprstuvw') for _ in range(rng.randint(3, 9))) for _ in range(count)]
+
+
+def synthetic_book(rng, words, names):
+    """(title, author) drawn from a catalogue-sized vocabulary."""
+    title = ' '.join(rng.choice(words) for _ in range(rng.randint(2, 6)))
+    return title, f'{rng.choice(names)} {rng.choice(names)}'
+
+
+def page_text(rng, words):
+    return ' '.join(rng.choice(words) for _ in range(400))
+
+
+def fingerprint(title, author, text):
+    return {'metadata': minhash(metadata_shingles(title, author)), 'numbers': title_numbers(title),
+            'text': minhash(text_shingles(text)), 'cover': None}
+
+
+def edit(text, rng, words, fraction=0.05):
+    """Replace a fraction of the words, as a different scan's OCR would."""
+    return ' '.join(word if rng.random() > fraction else rng.choice(words) for word in text.split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--books', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=500)
+    args = parser.parse_args()
+    rng = random.Random(11)
+    words, names = pseudo_words(20000, rng), pseudo_words(2000, rng)
+
+    folder = tempfile.mkdtemp(prefix='bench-duplicates-')
+    try:
+        database = Database(f"sqlite:///{os.path.join(folder, 'library.db')}")
+        with database.connect() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+        detector = DuplicateDetector(database.connect)
+
+        books, texts = [], {}
+        started = time.perf_counter()
+        with database.connect() as conn:
+            for book_id in range(1, args.books + 1):
+                title, author = synthetic_book(rng, words, names)
+                text = page_text(rng, words)
+                texts[book_id] = text
+                books.append((book_id, title, author))
+                prints = fingerprint(title, author, text)
+                conn.execute('INSERT INTO books (id, title, author) VALUES (?, ?, ?)', (book_id, title, author))
+                conn.execute('INSERT INTO book_signatures (book_id, metadata_minhash, text_minhash) VALUES (?, ?, ?)',
+                             (book_id, pack_minhash(prints['metadata']), pack_minhash(prints['text'])))
+                conn.executemany('INSERT INTO book_lsh_buckets (bucket, book_id) VALUES (?, ?)',
+                                 [(key, book_id) for key in set(bucket_keys(prints))])
+        print(f'fingerprinted {args.books} books in {time.perf_counter() - started:.1f} s')
+
+        lookups, brute, found, false_alarms = [], [], 0, 0
+        copies = args.queries // 2
+        for query in range(args.queries):
+            if query < copies:
+                book_id, title, author = rng.choice(books)
+                prints = fingerprint(f'{title} revised', author, edit(texts[book_id], rng, words))
+            else:
+                book_id, (title, author) = None, synthetic_book(rng, words, names)
+                prints = fingerprint(title, author, page_text(rng, words))
+
+            started = time.perf_counter()
+            matches = detector.find(prints)
+            lookups.append((time.perf_counter() - started) * 1000)
+            if book_id is not None:
+                found += any(match['id'] == book_id for match in matches)
+            else:
+                false_alarms += bool(matches)
+
+            if query < 20:
+                # The alternative: compare with every stored signature
+                started = time.perf_counter()
+                with database.connect() as conn:
+                    for row in conn.execute('SELECT metadata_minhash, text_minhash FROM book_signatures'):
+                        similarity(prints['metadata'], unpack_minhash(row['metadata_minhash']))
+                        similarity(prints['text'], unpack_minhash(row['text_minhash']))
+                brute.append((time.perf_counter() - started) * 1000)
+
+        print(f'lookup:   p50={percentile(lookups, 0.5):.2f} ms  p99={percentile(lookups, 0.99):.2f} ms')
+        print(f'full scan: p50={percentile(brute, 0.5):.0f} ms')
+        print(f'found {found} of {copies} edited copies; '
+              f'{false_alarms} of {args.queries - copies} new books flagged')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Fuzzy search benchmark: misspelled queries against a synthetic catalogue.
+
+Usage:
+    python scripts/bench_fuzzy.py [--books 100000] [--queries 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_typeahead import synthetic_books, percentile  # noqa: E402
+from fuzzy import TrigramIndex  # noqa: E402
+
+
+def misspell(word, rng):
+    """Drop, double or swap one letter."""
+    if len(word) < 3:
+        return word
+    i = rng.randrange(1, len(word) - 1)
+    return rng.choice((word[:i] + word[i + 1:], word[:i] + word[i] + word[i:],
+                       word[:i - 1] + word[i] + word[i - 1] + word[i + 1:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=2000)
+    args = parser.parse_args()
+    rng = random.Random(7)
+
+    books = list(synthetic_books(args.books, rng))
+    index = TrigramIndex()
+    started = time.perf_counter()
+    index.load(books)
+    print(f'build: {args.books} books in {time.perf_counter() - started:.2f} s')
+
+    queries = []
+    for _ in range(args.queries):
+        _, title, author = rng.choice(books)
+        words = rng.choice((title, author)).split()
+        queries.append(' '.join(misspell(word, rng) for word in words[:rng.randint(1, 2)]))
+
+    timings, hits = [], 0
+    for query in queries:
+        started = time.perf_counter()
+        hits += bool(index.search(query))
+        timings.append((time.perf_counter() - started) * 1000)
+    print(f'search(): p50 {percentile(timings, 0.5):.2f} ms, p99 {percentile(timings, 0.99):.2f} ms, '
+          f'max {max(timings):.2f} ms; {hits}/{len(queries)} queries matched')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Startup benchmark: time from `import app` to the first served request.
+
+Every sample runs in a fresh interpreter so module caches cannot hide the
+cost. Two modes are measured:
+
+  cold     - import app.py and serve one request (a plain gunicorn worker)
+  preload  - import app.py and call warm_up() in a parent, then fork and time
+             the child's first request (gunicorn with preload_app)
+
+Usage:
+    python scripts/bench_startup.py [--runs 10]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COLD = r'''
+import json, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+response = app.app.test_client().get('/set_language/en')
+t2 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'first_request': t2 - t1, 'total': t2 - t0,
+                  'status': response.status_code}))
+'''
+
+PRELOAD = r'''
+import json, os, time
+import app
+app.warm_up()
+read_fd, write_fd = os.pipe()
+pid = os.fork()
+if pid == 0:
+    os.close(read_fd)
+    t0 = time.perf_counter()
+    response = app.app.test_client().get('/set_language/en')
+    t1 = time.perf_counter()
+    os.write(write_fd, json.dumps({'import': 0.0, 'first_request': t1 - t0, 'total': t1 - t0,
+                                   'status': response.status_code}).encode())
+    os._exit(0)
+os.close(write_fd)
+os.waitpid(pid, 0)
+print(os.read(read_fd, 4096).decode())
+'''
+
+
+def run_sample(code):
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(label, samples):
+    print(f'{label}:')
+    for key in ('import', 'first_request', 'total'):
+        values = [sample[key] * 1000 for sample in samples]
+        print(f'  {key:<14} median {statistics.median(values):8.1f} ms   '
+              f'min {min(values):8.1f} ms   max {max(values):8.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    summarize('cold worker', [run_sample(COLD) for _ in range(args.runs)])
+    if hasattr(os, 'fork'):
+        summarize('preloaded worker', [run_sample(PRELOAD) for _ in range(args.runs)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Typeahead benchmark: prefix lookups against a synthetic catalogue.
+
+Builds a PrefixIndex over generated Arabic and English titles/authors, then
+times suggest() for random 1-6 character prefixes, including the first
+(uncached) hit of wide one- and two-letter prefixes.
+
+Usage:
+    python scripts/bench_typeahead.py [--books 100000] [--queries 20000]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from typeahead import PrefixIndex  # noqa: E402
+
+EN_WORDS = ('history', 'library', 'science', 'media', 'ancient', 'modern', 'introduction', 'theory',
+            'archive', 'digital', 'culture', 'society', 'methods', 'studies', 'world', 'empire')
+AR_WORDS = ('تاريخ', 'المكتبات', 'علم', 'الإعلام', 'الاتصال', 'الآثار', 'مدخل', 'الحضارة',
+            'دراسات', 'المخطوطات', 'الفهرسة', 'العربية', 'الرقمية', 'المعلومات', 'نظرية', 'القديمة')
+EN_NAMES = ('john', 'mary', 'ahmed', 'fatima', 'youssef', 'sarah', 'omar', 'layla', 'karim', 'nadia')
+AR_NAMES = ('محمد', 'أحمد', 'فاطمة', 'يوسف', 'عبد الله', 'خديجة', 'إبراهيم', 'مريم', 'علي', 'نجيب')
+
+
+def synthetic_books(count, rng):
+    for book_id in range(1, count + 1):
+        if rng.random() < 0.5:
+            title = ' '.join(rng.choice(EN_WORDS) for _ in range(rng.randint(2, 5)))
+            author = f'{rng.choice(EN_NAMES)} {rng.choice(EN_NAMES)}son{rng.randint(1, 999)}'
+        else:
+            title = ' '.join(rng.choice(AR_WORDS) for _ in range(rng.randint(2, 5)))
+            author = f'{rng.choice(AR_NAMES)} {rng.choice(AR_NAMES)} {rng.randint(1, 999)}'
+        yield book_id, title, author
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=20000)
+    args = parser.parse_args()
+    rng = random.Random(42)
+
+    books = list(synthetic_books(args.books, rng))
+    index = PrefixIndex()
+    started = time.perf_counter()
+    index.load(books)
+    print(f'build: {args.books} books in {time.perf_counter() - started:.2f} s')
+
+    words = [word for _, title, author in books[:2000] for word in (title + ' ' + author).split()]
+    prefixes = [rng.choice(words)[:rng.randint(1, 6)] for _ in range(args.queries)]
+
+    cold = []
+    for prefix in sorted({p[:2] for p in prefixes})[:50]:
+        started = time.perf_counter()
+        index.suggest(prefix)
+        cold.append((time.perf_counter() - started) * 1e6)
+    print(f'first hit of wide prefixes: median {statistics.median(cold):.0f} us, max {max(cold):.0f} us')
+
+    timings = []
+    for prefix in prefixes:
+        started = time.perf_counter()
+        index.suggest(prefix)
+        timings.append((time.perf_counter() - started) * 1e6)
+    print(f'suggest(): p50 {percentile(timings, 0.5):.0f} us, p99 {percentile(timings, 0.99):.0f} us, '
+          f'max {max(timings):.0f} us')
+
+    started = time.perf_counter()
+    for book_id in range(args.books + 1, args.books + 101):
+        index.add_book(book_id, 'new history of the library', 'new author')
+    print(f'add_book(): {(time.perf_counter() - started) * 1e4:.0f} us per book')
+
+
+if __name__ == '__main__':
+    main()
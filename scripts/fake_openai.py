@@ -0,0 +1,215 @@
+"""
+Local fake of the OpenAI chat completions API, for load tests.
+
+Answers POST /v1/chat/completions (streamed or not) after a configurable
+delay, with a configurable number of completion tokens, and injects 429 and
+500 responses at configurable rates. Settings are attributes of FakeOpenAI
+and may be changed while it runs; stats() reports what it served, including
+the most calls it had in flight at once.
+
+Point the app at it with OPENAI_BASE_URL (the openai package reads it) and
+any OPENAI_API_KEY:
+
+    python scripts/fake_openai.py --port 8900 --latency 2 --error-429 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=fake gunicorn app:app
+
+scripts/soak_ai.py runs it in-process.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ('library', 'book', 'reading', 'history', 'author', 'chapter', 'theme', 'science', 'culture', 'study')
+
+
+class FakeOpenAI:
+    """A chat completions endpoint with tunable latency, output size and failures."""
+
+    def __init__(self, latency=1.0, jitter=0.2, completion_tokens=200, token_interval=0.0,
+                 error_429=0.0, error_500=0.0, seed=None):
+        self.latency = latency                  # seconds before the first token
+        self.jitter = jitter                    # +/- fraction applied to latency
+        self.completion_tokens = completion_tokens
+        self.token_interval = token_interval    # seconds per further token
+        self.error_429 = error_429              # fraction of calls answered 429
+        self.error_500 = error_500              # fraction of calls answered 500
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Start counting afresh; calls already in flight still count towards in_flight."""
+        with self._lock:
+            in_flight = getattr(self, '_in_flight', 0)
+            self._stats = {'requests': 0, 'ok': 0, 'streamed': 0, '429': 0, '500': 0,
+                           'prompt_tokens': 0, 'completion_tokens': 0, 'max_in_flight': in_flight}
+            self._in_flight = in_flight
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, in_flight=self._in_flight)
+
+    def _begin(self):
+        with self._lock:
+            self._stats['requests'] += 1
+            self._in_flight += 1
+            self._stats['max_in_flight'] = max(self._stats['max_in_flight'], self._in_flight)
+            roll = self._rng.random()
+            delay = self.latency * (1 + self._rng.uniform(-self.jitter, self.jitter))
+        if roll < self.error_429:
+            return '429', delay
+        if roll < self.error_429 + self.error_500:
+            return '500', delay
+        return 'ok', delay
+
+    def _end(self, outcome, prompt_tokens=0, completion_tokens=0, streamed=False):
+        with self._lock:
+            self._in_flight -= 1
+            self._stats[outcome] += 1
+            self._stats['streamed'] += streamed
+            self._stats['prompt_tokens'] += prompt_tokens
+            self._stats['completion_tokens'] += completion_tokens
+
+    def completion_words(self):
+        return [WORDS[i % len(WORDS)] for i in range(self.completion_tokens)]
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve on a daemon thread; returns the base URL for OPENAI_BASE_URL."""
+        handler = type('Handler', (_Handler,), {'fake': self})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-openai', daemon=True).start()
+        return f'http://{host}:{self._server.server_address[1]}/v1'
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def estimate_tokens(messages):
+    """Roughly four characters per token, as the real tokenizer averages for English."""
+    return sum(len(str(message.get('content', ''))) for message in messages) // 4 + 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    fake = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {'object': 'list', 'data': [{'id': 'gpt-3.5-turbo', 'object': 'model'}]})
+        else:
+            self._send_json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+            return
+        request = json.loads(body or b'{}')
+        fake = self.fake
+        outcome, delay = fake._begin()
+        prompt_tokens = estimate_tokens(request.get('messages', []))
+        try:
+            time.sleep(max(0.0, delay))
+            if outcome == '429':
+                self._send_json(429, {'error': {'message': 'Rate limit reached (injected)',
+                                                'type': 'rate_limit_error', 'code': 'rate_limit_exceeded'}},
+                                {'Retry-After': '1'})
+                fake._end('429')
+                return
+            if outcome == '500':
+                self._send_json(500, {'error': {'message': 'Internal error (injected)', 'type': 'server_error'}})
+                fake._end('500')
+                return
+            words = fake.completion_words()[:request.get('max_tokens') or None]
+            if request.get('stream'):
+                self._stream(request, words, prompt_tokens)
+            else:
+                time.sleep(fake.token_interval * len(words))
+                self._send_json(200, {
+                    'id': f'chatcmpl-{uuid.uuid4().hex}',
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': request.get('model', 'gpt-3.5-turbo'),
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': ' '.join(words)}}],
+                    'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(words),
+                              'total_tokens': prompt_tokens + len(words)},
+                })
+            fake._end('ok', prompt_tokens, len(words), bool(request.get('stream')))
+        except (BrokenPipeError, ConnectionResetError):
+            fake._end('ok', prompt_tokens)  # the client gave up; it still cost a slot
+
+    def _stream(self, request, words, prompt_tokens):
+        """Server-sent events, one chunk per token, as the real API streams."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        completion_id = f'chatcmpl-{uuid.uuid4().hex}'
+
+        def event(delta, finish_reason=None):
+            chunk = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                     'model': request.get('model', 'gpt-3.5-turbo'),
+                     'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+            self._chunk(f'data: {json.dumps(chunk)}\n\n')
+
+        event({'role': 'assistant', 'content': ''})
+        for index, word in enumerate(words):
+            event({'content': word if index == 0 else f' {word}'})
+            time.sleep(self.fake.token_interval)
+        event({}, 'stop')
+        self._chunk('data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=1.0, help='seconds before the first token')
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--tokens', type=int, default=200, help='completion tokens per answer')
+    parser.add_argument('--token-interval', type=float, default=0.0, help='seconds per further token')
+    parser.add_argument('--error-429', type=float, default=0.0, help='fraction of calls answered 429')
+    parser.add_argument('--error-500', type=float, default=0.0, help='fraction of calls answered 500')
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(args.latency, args.jitter, args.tokens, args.token_interval, args.error_429, args.error_500)
+    print(f'Serving a fake OpenAI API at {fake.start(args.host, args.port)}', flush=True)
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps(fake.stats()), flush=True)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""
+AI soak test: rising AI concurrency next to catalogue traffic, against a fake OpenAI.
+
+Starts scripts/fake_openai.py in-process and the app under gunicorn (on a
+copy of library.db, pointed at the fake with OPENAI_BASE_URL), then for each
+upstream latency in --latencies and each AI concurrency in --levels runs a
+phase of --duration seconds with:
+
+  AI users         each logs in and loops over ai_search, ai_search_api,
+                   generate_abstract and generate_annotation (polling the job
+                   until it finishes)
+  catalogue users  --catalogue-users loop over the home, listing, detail,
+                   search and autocomplete pages
+  a probe          GET /healthz every PROBE_INTERVAL seconds; it does no work,
+                   so its latency is time spent waiting for a free gunicorn
+                   thread: worker saturation
+
+Each phase reports throughput, latency percentiles and outcomes for AI and
+catalogue requests (ok; shed = 429/503 from the app's AI limiter; error =
+anything else), the probe's p99 and how often it waited over SATURATED_MS,
+and what the fake upstream served. --json also writes the results to a file.
+
+Usage:
+    python scripts/soak_ai.py [--workers 2] [--threads 4] [--levels 1,4,16,32]
+                              [--latencies 0.5,2,8] [--duration 20]
+                              [--error-429 0.05] [--error-500 0.02] [--env OPENAI_MAX_CONCURRENCY=8]
+    # An app already running elsewhere, started with OPENAI_BASE_URL=http://<this host>:8900/v1:
+    python scripts/soak_ai.py --target http://staging:8000 --fake-host 0.0.0.0 --fake-port 8900
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_openai import FakeOpenAI  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROBE_INTERVAL = 0.2
+SATURATED_MS = 100          # a probe waiting longer found every thread busy
+REQUEST_TIMEOUT = 120
+MAX_BACKOFF = 5             # seconds; shed users wait Retry-After, as a polite client would
+JOB_POLL_INTERVAL = 0.5
+QUERIES = ('history of science', 'books about ancient empires', 'introduction to library studies',
+           'digital archives', 'modern culture and society')
+AI_ENDPOINTS = ('ai_search', 'ai_search_api', 'generate_abstract', 'generate_annotation')
+UNFINISHED = object()       # a job still running when its phase ended: not counted
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(args, openai_base_url, folder):
+    """Run the app under gunicorn on a copy of the database; returns (process, base URL)."""
+    database = os.path.join(folder, 'library.db')
+    if os.path.exists(os.path.join(ROOT, 'library.db')):
+        shutil.copy(os.path.join(ROOT, 'library.db'), database)
+    port = free_port()
+    env = dict(os.environ, OPENAI_BASE_URL=openai_base_url, OPENAI_API_KEY='fake',
+               DATABASE_URL=f'sqlite:///{database}', RECONCILE_INTERVAL='0')
+    env.update(pair.split('=', 1) for pair in args.env)
+    log = open(os.path.join(folder, 'gunicorn.log'), 'w')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers), '--threads', str(args.threads),
+         '--timeout', str(REQUEST_TIMEOUT), '--bind', f'127.0.0.1:{port}', 'app:app'],
+        cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'gunicorn exited; see {log.name}')
+        try:
+            if requests.get(f'{base_url}/healthz', timeout=1).status_code == 200:
+                return process, base_url
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f'gunicorn did not come up within 60 s; see {log.name}')
+
+
+def seed_books(database, count):
+    """Top the database copy up to count books, so detail pages and generations have targets."""
+    conn = sqlite3.connect(database)
+    existing = conn.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+    rng = random.Random(3)
+    conn.executemany(
+        'INSERT INTO books (title, author, description, filename) VALUES (?, ?, ?, ?)',
+        [(rng.choice(QUERIES).title(), f'Soak Author {n}', ' '.join(rng.choice(QUERIES) for _ in range(20)),
+          f'soak_{n}.pdf') for n in range(existing, count)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def logged_in_session(base_url, name):
+    session = requests.Session()
+    session.post(f'{base_url}/login', data={'first_name': 'Soak', 'last_name': name,
+                                            'email': f'{name}@soak.test'}, timeout=REQUEST_TIMEOUT)
+    return session
+
+
+def book_ids(base_url):
+    """Ids of listed books, read from the OPDS feed."""
+    session = logged_in_session(base_url, 'setup')
+    response = session.get(f'{base_url}/opds/new', headers={'Accept': 'application/opds+json'},
+                           timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return [int(publication['metadata']['identifier'].rsplit(':', 1)[1])
+            for publication in response.json().get('publications', [])]
+
+
+def outcome(status):
+    if status is None or status >= 500 and status != 503:
+        return 'error'
+    if status in (429, 503):
+        return 'shed'
+    return 'ok' if status < 400 else 'error'
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []  # (kind, name, outcome, seconds)
+
+    def add(self, kind, name, result, seconds):
+        with self.lock:
+            self.samples.append((kind, name, result, seconds))
+
+
+def timed(recorder, kind, name, call, stop=None):
+    """Record one call; call returns a response or a bare status code."""
+    started = time.perf_counter()
+    try:
+        response = call()
+    except requests.RequestException:
+        response = None
+    if response is UNFINISHED:
+        return
+    status = response if isinstance(response, int) or response is None else response.status_code
+    result = outcome(status)
+    recorder.add(kind, name, result, time.perf_counter() - started)
+    if result == 'shed' and stop is not None and not isinstance(response, int):
+        stop.wait(min(MAX_BACKOFF, float(response.headers.get('Retry-After') or 1)))
+
+
+def ai_user(base_url, number, ids, stop, recorder):
+    session = logged_in_session(base_url, f'ai{number}')
+    rng = random.Random(number)
+
+    def generate(kind):
+        response = session.post(f'{base_url}/generate_{kind}/{rng.choice(ids)}', timeout=REQUEST_TIMEOUT)
+        if response.status_code != 202:
+            return response
+        status_url = base_url + response.json()['status_url']
+        while not stop.is_set():
+            job = session.get(status_url, timeout=REQUEST_TIMEOUT).json()
+            if job['status'] == 'done':
+                return 200
+            if job['status'] == 'failed':
+                return 500
+            time.sleep(JOB_POLL_INTERVAL)
+        return UNFINISHED
+
+    calls = {
+        'ai_search': lambda: session.post(f'{base_url}/ai_search', data={'query': rng.choice(QUERIES)},
+                                          timeout=REQUEST_TIMEOUT),
+        'ai_search_api': lambda: session.post(f'{base_url}/ai_search_api', json={'query': rng.choice(QUERIES)},
+                                              timeout=REQUEST_TIMEOUT),
+        'generate_abstract': lambda: generate('abstract'),
+        'generate_annotation': lambda: generate('annotation'),
+    }
+    for name in itertools.cycle(rng.sample(AI_ENDPOINTS, len(AI_ENDPOINTS))):
+        if stop.is_set() or (name.startswith('generate') and not ids):
+            if stop.is_set():
+                return
+            continue
+        timed(recorder, 'ai', name, calls[name], stop)
+
+
+def catalogue_user(base_url, number, ids, stop, recorder):
+    session = logged_in_session(base_url, f'reader{number}')
+    rng = random.Random(1000 + number)
+    pages = [('home', lambda: '/'), ('books', lambda: '/books'),
+             ('search', lambda: f'/search?q={rng.choice(QUERIES).split()[0]}'),
+             ('autocomplete', lambda: f'/autocomplete?q={rng.choice(QUERIES)[:3]}')]
+    if ids:
+        pages.append(('detail', lambda: f'/book/{rng.choice(ids)}'))
+    while not stop.is_set():
+        name, path = rng.choice(pages)
+        timed(recorder, 'catalogue', name,
+              lambda: session.get(base_url + path(), timeout=REQUEST_TIMEOUT))
+
+
+def probe(base_url, stop, recorder):
+    while not stop.wait(PROBE_INTERVAL):
+        timed(recorder, 'probe', 'healthz',
+              lambda: requests.get(f'{base_url}/healthz', timeout=REQUEST_TIMEOUT))
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else float('nan')
+
+
+def summarize(samples, kind, duration):
+    chosen = [sample for sample in samples if sample[0] == kind]
+    latencies = [sample[3] * 1000 for sample in chosen if sample[2] == 'ok']
+    counts = {result: sum(1 for sample in chosen if sample[2] == result) for result in ('ok', 'shed', 'error')}
+    return {
+        'requests': len(chosen),
+        'per_second': round(len(chosen) / duration, 2),
+        'p50_ms': round(percentile(latencies, 0.5), 1),
+        'p99_ms': round(percentile(latencies, 0.99), 1),
+        'mean_ms': round(statistics.mean(latencies), 1) if latencies else None,
+        **counts,
+        'error_rate': round(counts['error'] / len(chosen), 3) if chosen else 0.0,
+        'by_endpoint': {name: {result: sum(1 for sample in chosen if sample[1] == name and sample[2] == result)
+                               for result in ('ok', 'shed', 'error')}
+                        for name in sorted({sample[1] for sample in chosen})},
+    }
+
+
+def run_phase(base_url, level, args, ids, fake):
+    recorder = Recorder()
+    stop = threading.Event()
+    fake.reset_stats()
+    threads = [threading.Thread(target=ai_user, args=(base_url, n, ids, stop, recorder)) for n in range(level)]
+    threads += [threading.Thread(target=catalogue_user, args=(base_url, n, ids, stop, recorder))
+                for n in range(args.catalogue_users)]
+    threads.append(threading.Thread(target=probe, args=(base_url, stop, recorder)))
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    probes = [sample[3] * 1000 for sample in recorder.samples if sample[0] == 'probe']
+    return {
+        'ai': summarize(recorder.samples, 'ai', args.duration),
+        'catalogue': summarize(recorder.samples, 'catalogue', args.duration),
+        'probe': {'p99_ms': round(percentile(probes, 0.99), 1),
+                  'saturated': round(sum(1 for value in probes if value > SATURATED_MS) / len(probes), 3)
+                  if probes else None},
+        'upstream': fake.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--levels', default='1,4,16,32', help='concurrent AI users per phase')
+    parser.add_argument('--latencies', default='0.5,2,8', help='fake upstream latencies (seconds)')
+    parser.add_argument('--duration', type=float, default=20, help='seconds per phase')
+    parser.add_argument('--catalogue-users', type=int, default=4)
+    parser.add_argument('--books', type=int, default=200, help='synthetic books to add to the database copy')
+    parser.add_argument('--tokens', type=int, default=300, help='completion tokens per fake answer')
+    parser.add_argument('--error-429', type=float, default=0.0)
+    parser.add_argument('--error-500', type=float, default=0.0)
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra environment for the app, e.g. OPENAI_MAX_CONCURRENCY=8')
+    parser.add_argument('--target', help='soak an app already running at this URL instead of starting one')
+    parser.add_argument('--fake-host', default='127.0.0.1')
+    parser.add_argument('--fake-port', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(completion_tokens=args.tokens, error_429=args.error_429, error_500=args.error_500)
+    openai_base_url = fake.start(args.fake_host, args.fake_port)
+    folder = tempfile.mkdtemp(prefix='soak-ai-')
+    process = None
+    try:
+        if args.target:
+            base_url = args.target.rstrip('/')
+            print(f'fake OpenAI at {openai_base_url}; the app at {base_url} must use it')
+        else:
+            process, base_url = start_app(args, openai_base_url, folder)
+            seed_books(os.path.join(folder, 'library.db'), args.books)
+            print(f'gunicorn: {args.workers} worker(s) x {args.threads} thread(s) at {base_url}')
+        ids = book_ids(base_url)
+        results = []
+        print(f"{'upstream':>8} {'AI users':>8} | {'AI req/s':>8} {'p50':>7} {'p99':>7} {'shed':>5} {'err':>5} | "
+              f"{'page/s':>7} {'p50':>7} {'p99':>7} {'err':>5} | {'probe p99':>9} {'sat.':>5} | {'upstream':>8}")
+        for latency in (float(value) for value in args.latencies.split(',')):
+            fake.latency = latency
+            for level in (int(value) for value in args.levels.split(',')):
+                phase = run_phase(base_url, level, args, ids, fake)
+                phase.update(upstream_latency=latency, ai_users=level)
+                results.append(phase)
+                ai, page, probed, upstream = phase['ai'], phase['catalogue'], phase['probe'], phase['upstream']
+                print(f"{latency:7.1f}s {level:8d} | {ai['per_second']:8.2f} {ai['p50_ms']:7.0f} {ai['p99_ms']:7.0f} "
+                      f"{ai['shed']:5d} {ai['error']:5d} | {page['per_second']:7.1f} {page['p50_ms']:7.0f} "
+                      f"{page['p99_ms']:7.0f} {page['error']:5d} | {probed['p99_ms']:9.0f} "
+                      f"{probed['saturated'] or 0:5.0%} | {upstream['max_in_flight']:3d} max", flush=True)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as handle:
+                json.dump(results, handle, indent=2)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+        fake.stop()
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+File storage for uploaded PDFs, cover images and rendered previews.
+
+Files live in named areas ('uploads', 'covers', 'previews'). Two drivers
+implement the same small interface:
+
+  LocalStorage  one directory per area on this host (the default)
+  S3Storage     one key prefix per area in an S3-compatible bucket (AWS S3,
+                MinIO, ...); downloads are redirects to short-lived
+                pre-signed URLs, so file bytes never pass through Flask
+
+Drivers are described by a plain, picklable config dict so that background
+pool processes can rebuild the same storage with create_storage(config).
+Saves, sends and deletes are traced as spans (see tracing.py).
+"""
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import quote
+
+from flask import redirect, send_from_directory
+
+import tracing
+
+STORAGE_AREAS = ('uploads', 'covers', 'previews')
+
+
+def traced(operation):
+    """Wrap a driver method taking (area, name, ...) in a storage span."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, area, name, *args, **kwargs):
+            with tracing.start_span(f'storage {operation}', tracing.CLIENT, {
+                'storage.backend': self.config['backend'],
+                'storage.area': area,
+                'file.name': name,
+            }) as span:
+                result = method(self, area, name, *args, **kwargs)
+                if operation == 'send' and span.sampled:
+                    span.set_attribute('http.response.status_code', result.status_code)
+                    span.set_attribute('file.size', result.content_length)
+                return result
+        return wrapper
+    return decorator
+
+
+def storage_config_from_env(local_folders):
+    """Build a storage config from STORAGE_BACKEND and the S3_* environment variables."""
+    backend = os.getenv('STORAGE_BACKEND', 'local')
+    if backend == 's3':
+        return {
+            'backend': 's3',
+            'bucket': os.environ['S3_BUCKET'],
+            'prefix': os.getenv('S3_PREFIX', ''),
+            'endpoint_url': os.getenv('S3_ENDPOINT_URL') or None,
+            'region': os.getenv('S3_REGION') or None,
+            'url_ttl': int(os.getenv('S3_URL_TTL', '300')),
+        }
+    return {'backend': 'local', 'folders': dict(local_folders)}
+
+
+def create_storage(config):
+    """Return the storage driver described by config."""
+    if config['backend'] == 's3':
+        return S3Storage(config)
+    return LocalStorage(config)
+
+
+class LocalStorage:
+    """Areas are directories on the local filesystem."""
+
+    def __init__(self, config):
+        self.config = config
+        self.folders = config['folders']
+
+    def path(self, area, name):
+        return os.path.join(self.folders[area], name)
+
+    @traced('save')
+    def save(self, area, name, file_storage):
+        """Save a werkzeug FileStorage (or any object with .save(path))."""
+        os.makedirs(self.folders[area], exist_ok=True)
+        file_storage.save(self.path(area, name))
+
+    @traced('put_file')
+    def put_file(self, area, name, local_path):
+        """Move a finished local file into place atomically."""
+        os.makedirs(self.folders[area], exist_ok=True)
+        destination = self.path(area, name)
+        try:
+            os.replace(local_path, destination)
+        except OSError:
+            # Different filesystem: copy next to the target, then swap
+            staging = f'{destination}.{os.getpid()}.tmp'
+            shutil.copyfile(local_path, staging)
+            os.replace(staging, destination)
+            os.remove(local_path)
+
+    def move(self, area, name, new_name):
+        """Rename a file within an area; its modification time becomes now."""
+        destination = self.path(area, new_name)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(self.path(area, name), destination)
+        os.utime(destination)
+
+    def list_files(self, area, folder=''):
+        """Yield (name, size, mtime) for the files directly inside an area (or a folder of it).
+
+        Hidden entries (dotfiles, in-progress temp files, .quarantine) are skipped.
+        """
+        try:
+            entries = os.scandir(os.path.join(self.folders[area], folder))
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue  # removed while we were listing
+                yield entry.name, stat.st_size, stat.st_mtime
+
+    def exists(self, area, name):
+        return os.path.exists(self.path(area, name))
+
+    def size(self, area, name):
+        return os.path.getsize(self.path(area, name))
+
+    @traced('delete')
+    def delete(self, area, name):
+        """Delete a file; returns False if it did not exist."""
+        try:
+            os.remove(self.path(area, name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    @contextmanager
+    def local_copy(self, area, name):
+        """Yield a local path to the file; here, the file itself."""
+        yield self.path(area, name)
+
+    @traced('send')
+    def send(self, area, name, as_attachment=False, download_name=None):
+        """Response serving the file to the client."""
+        return send_from_directory(self.folders[area], name, as_attachment=as_attachment,
+                                   download_name=download_name, conditional=True)
+
+
+def _missing(exc):
+    """True if a botocore ClientError says the object does not exist."""
+    return exc.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+class S3Storage:
+    """Areas are key prefixes in one S3-compatible bucket."""
+
+    def __init__(self, config):
+        self.config = config
+        self.bucket = config['bucket']
+        self._client = None
+        self._client_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # boto3 is imported on first use and its client is not shared across fork()
+        if self._client is None or self._client_pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._client_pid != os.getpid():
+                    import boto3
+                    self._client = boto3.client('s3', endpoint_url=self.config.get('endpoint_url'),
+                                                region_name=self.config.get('region'))
+                    self._client_pid = os.getpid()
+        return self._client
+
+    def key(self, area, name):
+        return f"{self.config.get('prefix', '')}{area}/{name}"
+
+    @traced('save')
+    def save(self, area, name, file_storage):
+        stream = getattr(file_storage, 'stream', file_storage)
+        stream.seek(0)
+        self.client.upload_fileobj(stream, self.bucket, self.key(area, name),
+                                   ExtraArgs=self._content_type_args(file_storage))
+
+    @traced('put_file')
+    def put_file(self, area, name, local_path):
+        # No request object here, so the type comes from the name
+        content_type = mimetypes.guess_type(name)[0]
+        self.client.upload_file(local_path, self.bucket, self.key(area, name),
+                                ExtraArgs={'ContentType': content_type} if content_type else {})
+        os.remove(local_path)
+
+    def move(self, area, name, new_name):
+        """Copy then delete; the copy's LastModified becomes now.
+
+        Raises FileNotFoundError if the object is gone, as LocalStorage does.
+        """
+        from botocore.exceptions import ClientError
+        try:
+            self.client.copy_object(Bucket=self.bucket, Key=self.key(area, new_name),
+                                    CopySource={'Bucket': self.bucket, 'Key': self.key(area, name)})
+        except ClientError as exc:
+            if _missing(exc):
+                raise FileNotFoundError(self.key(area, name)) from exc
+            raise
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(area, name))
+
+    def list_files(self, area, folder=''):
+        """Yield (name, size, mtime) for the objects directly under an area (or a folder of it)."""
+        prefix = self.key(area, f'{folder}/' if folder else '')
+        pages = self.client.get_paginator('list_objects_v2').paginate(
+            Bucket=self.bucket, Prefix=prefix, Delimiter='/'
+        )
+        for page in pages:
+            for item in page.get('Contents', []):
+                name = item['Key'][len(prefix):]
+                if name and not name.startswith('.'):
+                    yield name, item['Size'], item['LastModified'].timestamp()
+
+    def exists(self, area, name):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(area, name))
+            return True
+        except ClientError as exc:
+            if _missing(exc):
+                return False
+            raise
+
+    def size(self, area, name):
+        return self.client.head_object(Bucket=self.bucket, Key=self.key(area, name))['ContentLength']
+
+    @traced('delete')
+    def delete(self, area, name):
+        if not self.exists(area, name):
+            return False
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(area, name))
+        return True
+
+    @contextmanager
+    def local_copy(self, area, name):
+        """Download the object to a temporary file for local processing."""
+        directory = tempfile.mkdtemp(prefix='library-')
+        path = os.path.join(directory, name)
+        try:
+            self.client.download_file(self.bucket, self.key(area, name), path)
+            yield path
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def presigned_url(self, area, name, as_attachment=False, download_name=None):
+        params = {'Bucket': self.bucket, 'Key': self.key(area, name)}
+        if as_attachment:
+            filename = quote(download_name or name)
+            params['ResponseContentDisposition'] = f"attachment; filename*=UTF-8''{filename}"
+        return self.client.generate_presigned_url('get_object', Params=params,
+                                                  ExpiresIn=self.config.get('url_ttl', 300))
+
+    @traced('send')
+    def send(self, area, name, as_attachment=False, download_name=None):
+        """Redirect the client to a short-lived pre-signed URL for the object."""
+        response = redirect(self.presigned_url(area, name, as_attachment, download_name), code=302)
+        # The URL expires, so the redirect itself must not be cached for longer
+        response.headers['Cache-Control'] = 'private, max-age=60'
+        return response
+
+    @staticmethod
+    def _content_type_args(file_storage):
+        content_type = getattr(file_storage, 'mimetype', None)
+        return {'ContentType': content_type} if content_type else {}
@@ -0,0 +1,59 @@
+"""
+Fixtures running each database test on SQLite and on PostgreSQL.
+
+SQLite tests get a fresh file in a temporary directory. PostgreSQL tests
+run when TEST_DATABASE_URL names a server to use (for example
+postgresql://postgres@/library?host=/tmp&port=5433); each test gets a
+schema of its own on it, dropped afterwards. The schema is built by the
+app's own init_database(), so the tests see the tables, indexes and
+triggers production uses.
+"""
+import os
+import uuid
+from urllib.parse import quote
+
+import pytest
+
+from db import Database
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+
+
+def _postgres_database(schema):
+    separator = '&' if '?' in TEST_DATABASE_URL else '?'
+    # public stays on the path for extensions such as pg_trgm
+    options = quote(f'-csearch_path={schema},public')
+    return Database(f'{TEST_DATABASE_URL}{separator}options={options}', pool_size=4)
+
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def database(request, tmp_path, monkeypatch):
+    """A Database with the app's schema, on each backend in turn."""
+    import app
+
+    if request.param == 'sqlite':
+        database = Database(f'sqlite:///{tmp_path / "library.db"}', pool_size=4)
+    else:
+        if not TEST_DATABASE_URL:
+            pytest.skip('TEST_DATABASE_URL is not set')
+        pytest.importorskip('psycopg')
+        schema = f'test_{uuid.uuid4().hex[:12]}'
+        admin = Database(TEST_DATABASE_URL, pool_size=1)
+        with admin.connect() as conn:
+            conn.execute(f'CREATE SCHEMA {schema}')
+        database = _postgres_database(schema)
+
+    monkeypatch.setattr(app, 'database', database)
+    app.init_database()
+    yield database
+    database.close_pool()
+
+    if request.param == 'postgresql':
+        with admin.connect() as conn:
+            conn.execute(f'DROP SCHEMA {schema} CASCADE')
+        admin.close_pool()
+
+
+@pytest.fixture
+def connect(database):
+    return database.connect
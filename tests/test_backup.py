@@ -0,0 +1,62 @@
+"""Scheduling backups: one at a time, and failures reported."""
+import threading
+
+import pytest
+
+import backup
+from backup import BackupInProgress, list_backups, list_failed_backups, schedule_backup
+
+
+class _Storage:
+    def __init__(self, error=None):
+        self.error = error
+
+    def list_files(self, area):
+        if self.error:
+            raise self.error
+        return iter(())
+
+
+def _wait():
+    # The backup thread runs jobs in order, done callbacks included
+    backup._get_executor().submit(lambda: None).result(timeout=30)
+
+
+def test_second_schedule_is_refused_while_first_holds_the_lock(database, tmp_path, monkeypatch):
+    started = []
+    release = threading.Event()
+    real_run = backup._run_backup
+
+    def slow_run(*args):
+        started.append(True)
+        release.wait(10)
+        return real_run(*args)
+
+    monkeypatch.setattr(backup, '_run_backup', slow_run)
+    folder = str(tmp_path / 'backups')
+    name = schedule_backup(database, _Storage(), folder)
+    with pytest.raises(BackupInProgress):
+        schedule_backup(database, _Storage(), folder)
+    assert backup.backup_running(folder)
+    release.set()
+    _wait()
+
+    assert [report['report']['archive'] for report in list_backups(folder)] == [name]
+    assert not backup.backup_running(folder)
+    assert list_failed_backups(folder) == []
+
+
+def test_failed_backup_leaves_a_failed_sidecar(database, tmp_path):
+    folder = str(tmp_path / 'backups')
+    name = schedule_backup(database, _Storage(OSError('No space left on device')), folder)
+    _wait()
+
+    assert list_backups(folder) == []
+    [failure] = list_failed_backups(folder)
+    assert failure['report']['archive'] == name
+    assert failure['report']['status'] == 'failed'
+    assert 'No space left on device' in failure['report']['error']
+    # The lock was released, so the next backup can start
+    schedule_backup(database, _Storage(), folder)
+    _wait()
+    assert len(list_backups(folder)) == 1
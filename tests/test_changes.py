@@ -0,0 +1,109 @@
+"""The trigger-maintained change log behind /changes, on both backends."""
+import pytest
+
+import app
+from changes import parse_since, read_changes
+from repositories import BookRepository
+
+
+def _describe(entity, row):
+    return row['title']
+
+
+def _read(database, since, limit=500):
+    with database.connect() as conn:
+        return read_changes(conn, since, _describe, limit)
+
+
+def _sync(database, since=0, limit=500):
+    """Walk the feed from since to its end; (id, op) of every change and the final cursor."""
+    seen = []
+    while True:
+        page = _read(database, since, limit)
+        seen += [(change['id'], change['op']) for change in page['changes']]
+        since = int(page['cursor'])
+        if not page['has_more']:
+            return seen, since
+
+
+@pytest.fixture
+def books(database):
+    return BookRepository(database.connect, database.dialect)
+
+
+def test_cursor_pages_through_every_book_once(database, books):
+    ids = [books.create(f'Book {i}', 'A', '', f'{i}.pdf') for i in range(5)]
+
+    first = _read(database, 0, limit=2)
+    assert [change['data'] for change in first['changes']] == ['Book 0', 'Book 1']
+    assert first['has_more'] and not first['reset']
+
+    seen, cursor = _sync(database, limit=2)
+    assert seen == [(book_id, 'upsert') for book_id in ids]
+    assert _read(database, cursor) == {'changes': [], 'cursor': str(cursor), 'has_more': False, 'reset': False}
+
+
+def test_update_moves_the_row_to_the_end_of_the_log(database, books):
+    first = books.create('First', 'A', '', 'first.pdf')
+    second = books.create('Second', 'A', '', 'second.pdf')
+    _, cursor = _sync(database)
+
+    with database.connect() as conn:
+        conn.execute('UPDATE books SET title = ? WHERE id = ?', ('First, revised', first))
+    page = _read(database, cursor)
+    assert [(change['id'], change['data']) for change in page['changes']] == [(first, 'First, revised')]
+    # One entry per row: a client starting from scratch sees each book once
+    assert sorted(_sync(database)[0]) == sorted([(first, 'upsert'), (second, 'upsert')])
+
+
+def test_untracked_columns_are_not_logged(database, books):
+    book_id = books.create('Quiet', 'A', '', 'quiet.pdf')
+    _, cursor = _sync(database)
+    with database.connect() as conn:
+        conn.execute('UPDATE books SET view_count = view_count + 1 WHERE id = ?', (book_id,))
+    assert _read(database, cursor)['changes'] == []
+
+
+def test_delete_leaves_a_tombstone(database, books):
+    kept = books.create('Kept', 'A', '', 'kept.pdf')
+    gone = books.create('Gone', 'A', '', 'gone.pdf')
+    _, cursor = _sync(database)
+
+    books.delete(gone)
+    page = _read(database, cursor)
+    assert page['changes'] == [{'seq': page['changes'][0]['seq'], 'type': 'book', 'id': gone, 'op': 'delete'}]
+    assert _sync(database)[0] == [(kept, 'upsert'), (gone, 'delete')]
+
+
+def test_curated_books_are_logged_separately(database, books):
+    book_id = books.create('Book', 'A', '', 'book.pdf')
+    with database.connect() as conn:
+        conn.execute('INSERT INTO category_books (category_key, title, author, source, cover_filename) '
+                     'VALUES (?, ?, ?, ?, ?)', ('history', 'Curated', 'B', 'manual', 'c.jpg'))
+    changes = _read(database, 0)['changes']
+    assert [(change['type'], change['data']) for change in changes] == [('book', 'Book'), ('category_book', 'Curated')]
+    assert changes[0]['id'] == book_id
+
+
+def test_cursor_past_the_end_asks_for_a_reset(database, books):
+    books.create('Book', 'A', '', 'book.pdf')
+    _, cursor = _sync(database)
+    page = _read(database, cursor + 10)
+    assert page['reset'] and page['has_more']
+    assert page['cursor'] == '0'
+
+
+def test_parse_since():
+    assert parse_since(None) == 0
+    assert parse_since('42') == 42
+    for value in ('-1', 'abc'):
+        with pytest.raises(ValueError):
+            parse_since(value)
+
+
+def test_endpoint_rejects_malformed_cursor(database):
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+    assert client.get('/changes?since=abc').status_code == 400
+    assert client.get('/changes?since=0').get_json()['reset'] is False
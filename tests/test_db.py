@@ -0,0 +1,70 @@
+"""The connection layer: placeholders, rows, transactions and errors on both backends."""
+import pytest
+
+from db import IntegrityError, _to_format_placeholders
+
+
+def test_placeholders_become_format_style_with_literal_percent_escaped():
+    assert _to_format_placeholders('SELECT * FROM books WHERE id = ? AND title = ?') == \
+        'SELECT * FROM books WHERE id = %s AND title = %s'
+    assert _to_format_placeholders("SELECT * FROM books WHERE title LIKE '50%' AND id > ?") == \
+        "SELECT * FROM books WHERE title LIKE '50%%' AND id > %s"
+
+
+def _insert_book(conn, title, author='Author'):
+    return conn.insert('INSERT INTO books (title, author, filename) VALUES (?, ?, ?)', (title, author, f'{title}.pdf'))
+
+
+def test_execute_binds_parameters_next_to_literal_percent(connect):
+    with connect() as conn:
+        _insert_book(conn, '100% Arabic')
+        _insert_book(conn, 'Plain')
+        rows = conn.execute("SELECT title FROM books WHERE title LIKE '%\\%%' ESCAPE '\\' AND author = ?",
+                            ('Author',)).fetchall()
+    assert [row['title'] for row in rows] == ['100% Arabic']
+
+
+def test_executemany_inserts_every_row(connect):
+    with connect() as conn:
+        conn.executemany('INSERT INTO books (title, author, filename) VALUES (?, ?, ?)',
+                         [(f'Book {i}', 'Author', f'{i}.pdf') for i in range(5)])
+    with connect() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM books WHERE author = ?', ('Author',)).fetchone()[0] == 5
+
+
+def test_rows_read_by_index_and_by_name(connect):
+    with connect() as conn:
+        book_id = _insert_book(conn, 'Row')
+        row = conn.execute('SELECT id, title FROM books WHERE id = ?', (book_id,)).fetchone()
+    assert row[0] == row['id'] == book_id
+    assert row[1] == row['title'] == 'Row'
+
+
+def test_context_manager_commits_and_release_rolls_back(connect):
+    with connect() as conn:
+        _insert_book(conn, 'Committed')
+    conn = connect()
+    _insert_book(conn, 'Abandoned')
+    conn.close()
+    with connect() as conn:
+        titles = [row['title'] for row in conn.execute('SELECT title FROM books')]
+    assert titles == ['Committed']
+
+
+def test_constraint_violations_raise_integrity_error(connect):
+    with connect() as conn:
+        with pytest.raises(IntegrityError):
+            conn.execute('INSERT INTO books (title, author, filename) VALUES (?, ?, ?)', (None, 'Author', 'x.pdf'))
+        conn.rollback()
+
+
+def test_stream_yields_all_rows_in_batches(connect):
+    with connect() as conn:
+        conn.executemany('INSERT INTO books (title, author, filename) VALUES (?, ?, ?)',
+                         [(f'Book {i:02d}', 'Author', f'{i}.pdf') for i in range(25)])
+    conn = connect()
+    try:
+        titles = [row['title'] for row in conn.stream('SELECT title FROM books ORDER BY title', batch_size=4)]
+    finally:
+        conn.close()
+    assert titles == [f'Book {i:02d}' for i in range(25)]
@@ -0,0 +1,58 @@
+"""Near-duplicate fingerprints of uploads that are partly unreadable."""
+import pytest
+
+import app
+from duplicates import DuplicateDetector, read_pdf
+
+pymupdf = pytest.importorskip('pymupdf')
+
+
+def _pdf(*texts):
+    document = pymupdf.open()
+    for text in texts:
+        document.new_page().insert_text((72, 72), text)
+    data = document.tobytes()
+    document.close()
+    return data
+
+
+def test_read_pdf_skips_a_damaged_page(monkeypatch):
+    get_text = pymupdf.Page.get_text
+
+    def damaged(page, *args, **kwargs):
+        if page.number == 1:
+            raise RuntimeError('invalid content stream')
+        return get_text(page, *args, **kwargs)
+
+    monkeypatch.setattr(pymupdf.Page, 'get_text', damaged)
+    text, _ = read_pdf(_pdf('first page', 'second page', 'third page'))
+    assert 'first page' in text and 'third page' in text
+    assert 'second' not in text
+
+
+def test_read_pdf_of_garbage_is_empty():
+    assert read_pdf(b'not a pdf at all') == (None, None)
+
+
+def test_fingerprint_survives_undecodable_cover():
+    fingerprint = DuplicateDetector(None).fingerprint('Title', 'Author', cover=b'\x89PNG\r\n\x1a\n' + b'\0' * 40)
+    assert fingerprint['metadata'] is not None
+    assert fingerprint['cover'] is None
+
+
+def test_failed_fingerprint_falls_back_to_metadata(database, monkeypatch):
+    detector = DuplicateDetector(database.connect)
+    monkeypatch.setattr(app, 'duplicate_detector', detector)
+    book_id = app.books_repository.create('Kitab al-Hayawan', 'Al-Jahiz', '', 'a.pdf')
+    detector.store(book_id, detector.metadata_fingerprint('Kitab al-Hayawan', 'Al-Jahiz'))
+
+    def broken(*args, **kwargs):
+        if len(args) > 2 or kwargs:
+            raise RuntimeError('damaged PDF')
+        return DuplicateDetector.fingerprint(detector, *args)
+
+    monkeypatch.setattr(detector, 'fingerprint', broken)
+    stored, found = app.fingerprint_upload('Kitab al-Hayawan', 'Al-Jahiz', b'%PDF', None)
+    assert stored is None
+    assert [duplicate['id'] for duplicate in found] == [book_id]
+
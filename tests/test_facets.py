@@ -0,0 +1,56 @@
+"""Trigger-maintained facet counts against the GROUP BY counts they replace."""
+from facets import facet_counts
+from repositories import BookRepository
+
+
+def _catalogue_counts(conn):
+    return facet_counts(conn)
+
+
+def _grouped_counts(conn):
+    # The query path with a predicate matching every book groups the live rows
+    return facet_counts(conn, '1 = 1', [])
+
+
+def test_insert_update_and_delete_keep_counts_current(database):
+    books = BookRepository(database.connect, database.dialect)
+    first = books.create('One', 'Ghazali', '', '1.pdf', discipline='philosophy', publication_year=1095)
+    books.create('Two', 'Ghazali', '', '2.pdf', discipline='philosophy', publication_year=1105)
+    third = books.create('Three', 'Razi', '', '3.pdf', discipline='medicine', publication_year=925)
+
+    with database.connect() as conn:
+        counts = _catalogue_counts(conn)
+        assert counts == _grouped_counts(conn)
+    assert counts['discipline'] == [('philosophy', 2), ('medicine', 1)]
+    assert counts['author'] == [('Ghazali', 2), ('Razi', 1)]
+    assert counts['decade'] == [(1100, 1), (1090, 1), (920, 1)]
+
+    with database.connect() as conn:
+        conn.execute('UPDATE books SET discipline = ?, author = ?, publication_year = ? WHERE id = ?',
+                     ('medicine', 'Ibn Sina', 1025, first))
+    books.delete(third)
+
+    with database.connect() as conn:
+        counts = _catalogue_counts(conn)
+        assert counts == _grouped_counts(conn)
+    assert counts['discipline'] == [('medicine', 1), ('philosophy', 1)]
+    assert counts['author'] == [('Ghazali', 1), ('Ibn Sina', 1)]
+    assert counts['decade'] == [(1100, 1), (1020, 1)]
+
+
+def test_empty_values_are_not_counted(database):
+    books = BookRepository(database.connect, database.dialect)
+    books.create('Untitled', '', '', 'u.pdf', discipline='')
+    with database.connect() as conn:
+        assert _catalogue_counts(conn) == {'discipline': [], 'author': [], 'decade': []}
+
+
+def test_catalogue_counts_keep_only_top_authors(database):
+    books = BookRepository(database.connect, database.dialect)
+    for index in range(15):
+        for _ in range(index % 3 + 1):
+            books.create(f'Book {index}', f'Author {index:02d}', '', f'{index}.pdf')
+    with database.connect() as conn:
+        authors = _catalogue_counts(conn)['author']
+    assert len(authors) == 10
+    assert authors[:5] == [(f'Author {index:02d}', 3) for index in (2, 5, 8, 11, 14)]
@@ -0,0 +1,29 @@
+"""Streamed pages."""
+from flask import Flask, flash, redirect, session
+
+from fragments import stream_page
+
+
+def test_streamed_page_consumes_flashed_messages(tmp_path):
+    (tmp_path / 'page.html').write_text(
+        '{% for category, message in get_flashed_messages(with_categories=true) %}'
+        '[{{ category }}:{{ message }}]{% endfor %}{% for row in rows %}<{{ row }}>{% endfor %}'
+    )
+    app = Flask(__name__, template_folder=str(tmp_path))
+    app.secret_key = 'test'
+
+    @app.route('/add')
+    def add():
+        flash('added', 'success')
+        return redirect('/')
+
+    @app.route('/')
+    def index():
+        return stream_page('page.html', rows=iter(['a', 'b']))
+
+    client = app.test_client()
+    client.get('/add')
+    assert client.get('/').get_data(as_text=True) == '[success:added]<a><b>'
+    with client.session_transaction() as state:
+        assert '_flashes' not in state
+    assert client.get('/').get_data(as_text=True) == '<a><b>'
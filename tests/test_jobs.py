@@ -0,0 +1,80 @@
+"""Background AI jobs: one in-flight job per (kind, book, language)."""
+import threading
+import time
+
+import jobs
+from jobs import get_job, submit_job
+
+
+def _wait_for(connect, job_id, status, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = get_job(connect, job_id)
+        if job['status'] == status:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f'job {job_id} never reached {status!r}')
+
+
+def test_identical_job_in_flight_is_joined(connect):
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append('slow')
+        release.wait(10)
+        return {'abstract': 'text'}
+
+    first_id, first_created = submit_job(connect, 'abstract', 1, 'en', slow)
+    second_id, second_created = submit_job(connect, 'abstract', 1, 'en', lambda: calls.append('duplicate'))
+    assert first_created and not second_created
+    assert second_id == first_id
+
+    release.set()
+    job = _wait_for(connect, first_id, 'done')
+    assert job['result'] == {'abstract': 'text'}
+    assert calls == ['slow']
+
+
+def test_jobs_differing_in_key_run_separately(connect):
+    release = threading.Event()
+    ids = [submit_job(connect, kind, book_id, language, lambda: release.wait(10) and 'ok')
+           for kind, book_id, language in (('abstract', 1, 'en'), ('abstract', 1, 'ar'),
+                                           ('annotation', 1, 'en'), ('abstract', 2, 'en'))]
+    assert all(created for _, created in ids)
+    assert len({job_id for job_id, _ in ids}) == 4
+    release.set()
+    for job_id, _ in ids:
+        _wait_for(connect, job_id, 'done')
+
+
+def test_finished_job_admits_a_new_one(connect):
+    first_id, _ = submit_job(connect, 'abstract', 3, 'en', lambda: 'first')
+    _wait_for(connect, first_id, 'done')
+    second_id, created = submit_job(connect, 'abstract', 3, 'en', lambda: 'second')
+    assert created and second_id != first_id
+    assert _wait_for(connect, second_id, 'done')['result'] == 'second'
+
+
+def test_failure_is_recorded(connect):
+    def broken():
+        raise RuntimeError('quota exceeded')
+
+    job_id, _ = submit_job(connect, 'abstract', 4, 'en', broken)
+    assert _wait_for(connect, job_id, 'failed')['error'] == 'quota exceeded'
+
+
+def test_job_expired_in_queue_is_cancelled_not_run(connect):
+    with connect() as conn:
+        conn.execute("INSERT INTO ai_jobs (id, kind, book_id, language, updated_at) "
+                     "VALUES ('stale', 'abstract', 5, 'en', '2000-01-01 00:00:00')")
+    # Expiring the stale job admits a successor for the same key
+    successor_id, created = submit_job(connect, 'abstract', 5, 'en', lambda: 'fresh')
+    assert created
+    assert get_job(connect, 'stale')['status'] == 'failed'
+
+    calls = []
+    jobs._run_job(connect, 'stale', lambda: calls.append('ran'), lambda: calls.append('cancelled'))
+    assert calls == ['cancelled']
+    assert get_job(connect, 'stale')['status'] == 'failed'
+    assert _wait_for(connect, successor_id, 'done')['result'] == 'fresh'
@@ -0,0 +1,77 @@
+"""The "Ask this book" passage index and endpoint."""
+import pytest
+
+import app
+from passages import PassageIndex, chunk_pages
+from repositories import BookRepository
+from textnorm import normalize_text
+
+
+def _passages(*texts):
+    return [(page, text, normalize_text(text), len(text) // 3 + 1) for page, text in enumerate(texts, 1)]
+
+
+def _passage_rows(conn):
+    return conn.execute('SELECT COUNT(*) FROM book_passages').fetchone()[0]
+
+
+def test_chunk_pages_overlaps_and_remembers_start_page():
+    pages = [(1, ' '.join(f'w{i}' for i in range(5))), (2, ' '.join(f'w{i}' for i in range(5, 9)))]
+    chunks = list(chunk_pages(pages, words_per_passage=4, overlap=1))
+    assert chunks == [(1, 'w0 w1 w2 w3'), (1, 'w3 w4 w5 w6'), (2, 'w6 w7 w8')]
+
+
+def test_store_and_search_within_one_book(database):
+    books = BookRepository(database.connect, database.dialect)
+    first = books.create('Optics', 'Ibn al-Haytham', '', 'optics.pdf')
+    second = books.create('Canon', 'Ibn Sina', '', 'canon.pdf')
+    index = PassageIndex(database.connect)
+
+    assert index.store(first, _passages('light travels in straight lines', 'the camera obscura'))
+    assert index.store(second, _passages('fever and the pulse', 'light diet for the sick'))
+
+    assert [row['page'] for row in index.search(first, 'How does light travel?')] == [1]
+    assert [row['page'] for row in index.search(second, 'light')] == [2]
+    assert books.get(first)['passage_count'] == 2
+
+
+def test_store_for_deleted_book_leaves_nothing(database):
+    books = BookRepository(database.connect, database.dialect)
+    book_id = books.create('Gone', 'A', '', 'gone.pdf')
+    books.delete(book_id)
+
+    assert PassageIndex(database.connect).store(book_id, _passages('orphaned text')) is False
+    with database.connect() as conn:
+        assert _passage_rows(conn) == 0
+        if conn.dialect == 'sqlite':
+            assert conn.execute('SELECT COUNT(*) FROM book_passages_fts').fetchone()[0] == 0
+
+
+@pytest.fixture
+def client(database):
+    app.app.config['TESTING'] = True
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+    return client
+
+
+def test_ask_without_pymupdf_is_unavailable_not_retryable(database, client, monkeypatch):
+    monkeypatch.setattr(app, 'passages_available', lambda: False)
+    book_id = BookRepository(database.connect, database.dialect).create('Scan', 'A', '', 'scan.pdf')
+
+    response = client.post(f'/ask_book/{book_id}', json={'question': 'What is it about?'})
+    assert response.status_code == 422
+    assert 'Retry-After' not in response.headers
+
+
+def test_ask_while_indexing_asks_client_to_retry(database, client, monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(app, 'passages_available', lambda: True)
+    monkeypatch.setattr(app.passage_index, 'schedule', lambda storage, book_id, name: scheduled.append(book_id))
+    book_id = BookRepository(database.connect, database.dialect).create('New', 'A', '', 'new.pdf')
+
+    response = client.post(f'/ask_book/{book_id}', json={'question': 'What is it about?'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '10'
+    assert scheduled == [book_id]
@@ -0,0 +1,123 @@
+"""OpenAI admission control shared through the database."""
+import pytest
+
+import app
+import ratelimit
+from ratelimit import LimitExceeded, RateLimiter
+
+WINDOW = 3600
+START = 1_000 * WINDOW + 600  # ten minutes into a quota window
+
+
+class Clock:
+    def __init__(self):
+        self.now = START
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    return clock
+
+
+def _limiter(database, **limits):
+    options = dict(max_concurrency=10, rate_per_minute=60, burst=10, user_quota=0, quota_window=WINDOW)
+    options.update(limits)
+    return RateLimiter(database.connect, **options)
+
+
+def _shed(limiter, user_key='alice'):
+    with pytest.raises(LimitExceeded) as exc_info:
+        limiter.acquire(user_key)
+    return exc_info.value
+
+
+def test_concurrency_limit_sheds_with_503(database, clock):
+    limiter = _limiter(database, max_concurrency=2)
+    first = limiter.acquire('alice')
+    limiter.acquire('bob')
+
+    exc = _shed(limiter, 'carol')
+    assert exc.reason == 'concurrency'
+    assert exc.retry_after == ratelimit.BUSY_RETRY_AFTER
+    assert app.ai_limit_headers(exc) == (503, {'Retry-After': str(ratelimit.BUSY_RETRY_AFTER)})
+
+    limiter.release(first)
+    assert limiter.acquire('carol')
+
+
+def test_token_bucket_sheds_until_refilled(database, clock):
+    limiter = _limiter(database, rate_per_minute=30, burst=2)
+    for _ in range(2):
+        limiter.release(limiter.acquire('alice'))
+
+    exc = _shed(limiter)
+    assert exc.reason == 'rate'
+    assert exc.retry_after == 2  # one token every two seconds
+    assert app.ai_limit_headers(exc)[0] == 503
+
+    clock.now += 2
+    assert limiter.acquire('alice')
+
+
+def test_refund_restores_token_and_quota(database, clock):
+    limiter = _limiter(database, burst=1, user_quota=1)
+    limiter.release(limiter.acquire('alice'), refund=True)
+    # Neither the bucket nor alice's quota was charged for the refunded call
+    limiter.release(limiter.acquire('alice'))
+
+    exc = _shed(limiter)
+    assert exc.reason == 'quota'
+    with database.connect() as conn:
+        assert conn.execute('SELECT tokens FROM ai_rate_limits').fetchone()[0] == 0
+
+
+def test_refund_never_overfills_the_bucket(database, clock):
+    limiter = _limiter(database, burst=2)
+    lease_id = limiter.acquire('alice')
+    clock.now += 60
+    limiter.release(lease_id, refund=True)
+    with database.connect() as conn:
+        assert conn.execute('SELECT tokens FROM ai_rate_limits').fetchone()[0] == 2
+
+
+def test_expired_lease_is_reclaimed(database, clock):
+    limiter = _limiter(database, max_concurrency=1)
+    limiter.acquire('crashed-worker', lease_seconds=10)
+
+    clock.now += 5
+    assert _shed(limiter).reason == 'concurrency'
+
+    clock.now += 6
+    assert limiter.acquire('alice')
+    with database.connect() as conn:
+        assert [row[0] for row in conn.execute('SELECT user_key FROM ai_leases')] == ['alice']
+
+
+def test_user_quota_sheds_with_429_until_window_ends(database, clock):
+    limiter = _limiter(database, user_quota=2)
+    for _ in range(2):
+        limiter.release(limiter.acquire('alice'))
+
+    exc = _shed(limiter)
+    assert exc.reason == 'quota'
+    assert exc.retry_after == WINDOW - 600
+    assert app.ai_limit_headers(exc) == (429, {'Retry-After': str(WINDOW - 600)})
+    # Other users are unaffected
+    assert limiter.acquire('bob')
+
+    clock.now += WINDOW - 600
+    assert limiter.acquire('alice')
+
+
+def test_slot_releases_on_error(database, clock):
+    limiter = _limiter(database, max_concurrency=1)
+    with pytest.raises(RuntimeError):
+        with limiter.slot('alice'):
+            raise RuntimeError('upstream failed')
+    with limiter.slot('alice'):
+        pass
@@ -0,0 +1,121 @@
+"""BookRepository on both backends."""
+import pytest
+
+from facets import filter_clause
+from repositories import BookRepository
+
+
+@pytest.fixture
+def books(database):
+    return BookRepository(database.connect, database.dialect)
+
+
+def test_create_then_get(books):
+    book_id = books.create('Muqaddimah', 'Ibn Khaldun', 'History of the world', 'muqaddimah.pdf',
+                           image_filename='cover.jpg', discipline='history', publication_year=1377)
+    book = books.get(book_id)
+    assert book['title'] == 'Muqaddimah'
+    assert book['author'] == 'Ibn Khaldun'
+    assert book['image_filename'] == 'cover.jpg'
+    assert book['discipline'] == 'history'
+    assert book['publication_year'] == 1377
+    assert book['view_count'] == 0
+
+
+def test_get_unknown_book_is_none(books):
+    assert books.get(12345) is None
+
+
+def test_delete_removes_only_that_book(books):
+    kept = books.create('Kept', 'A', '', 'kept.pdf')
+    gone = books.create('Gone', 'A', '', 'gone.pdf')
+    books.delete(gone)
+    assert books.get(gone) is None
+    assert books.get(kept) is not None
+
+
+def test_search_matches_title_or_author_with_filters(books):
+    books.create('Arabic Grammar', 'Sibawayh', '', 'a.pdf', discipline='linguistics')
+    books.create('Grammar of Science', 'Pearson', '', 'b.pdf', discipline='philosophy')
+    books.create('Travels', 'Ibn Battuta', '', 'c.pdf', discipline='history')
+
+    match_sql, match_params = books.match_clause('grammar')
+    found = books.search(match_sql, match_params, '1 = 1', [])
+    assert sorted(book['title'] for book in found) == ['Arabic Grammar', 'Grammar of Science']
+
+    filter_sql, filter_params = filter_clause({'discipline': 'philosophy'})
+    found = books.search(match_sql, match_params, filter_sql, filter_params)
+    assert [book['title'] for book in found] == ['Grammar of Science']
+
+    match_sql, match_params = books.match_clause('battuta')
+    assert [book['title'] for book in books.search(match_sql, match_params, '1 = 1', [])] == ['Travels']
+
+
+def test_search_orders_by_title_keys(books):
+    for title in ('The Zebra', 'apple', 'Émile', 'Part 10', 'Part 2'):
+        books.create(title, 'A', '', f'{title}.pdf')
+    found = books.search(None, [], '1 = 1', [], sort='title', language='en')
+    assert [book['title'] for book in found] == ['apple', 'Émile', 'Part 2', 'Part 10', 'The Zebra']
+
+
+def test_page_walks_newest_first_with_keyset_cursor(books):
+    ids = [books.create(f'Book {i}', 'A', '', f'{i}.pdf') for i in range(7)]
+    seen, after = [], None
+    while True:
+        page = books.page(after=after, limit=3)
+        if not page:
+            break
+        seen += [book['id'] for book in page]
+        after = (page[-1]['upload_date'], page[-1]['id'])
+    assert seen == sorted(ids, reverse=True)
+
+
+def test_page_applies_where_clause(books):
+    books.create('History 1', 'A', '', 'h1.pdf', discipline='history')
+    books.create('Physics', 'A', '', 'p.pdf', discipline='physics')
+    books.create('History 2', 'A', '', 'h2.pdf', discipline='history')
+    page = books.page('discipline = ?', ['history'], limit=10)
+    assert [book['title'] for book in page] == ['History 2', 'History 1']
+
+
+def test_stream_ordered_reads_lazily_in_order(books):
+    for title in ('b', 'a', 'c'):
+        books.create(title, 'A', '', f'{title}.pdf', discipline='history')
+    books.create('d', 'A', '', 'd.pdf', discipline='physics')
+    rows = books.stream_ordered('title', discipline='history')
+    assert len(rows) == 3
+    assert [book['title'] for book in rows] == ['a', 'b', 'c']
+
+
+def test_lazy_rows_truth_test_and_loop_share_one_query(database):
+    books = BookRepository(database.connect, database.dialect)
+    for title in ('a', 'b'):
+        books.create(title, 'A', '', f'{title}.pdf')
+    borrowed = []
+
+    def connect():
+        borrowed.append(1)
+        return database.connect()
+
+    rows = BookRepository(connect, database.dialect).stream_ordered('title')
+    assert rows
+    assert [book['title'] for book in rows] == ['a', 'b']
+    assert len(borrowed) == 1
+    assert len(rows) == 2 and len(rows) == 2
+    assert len(borrowed) == 2
+
+
+def test_lazy_rows_empty_result_returns_its_connection(database):
+    borrowed, returned = [], []
+
+    def connect():
+        conn = database.connect()
+        borrowed.append(conn)
+        close = conn.close
+        conn.close = lambda: returned.append(conn) or close()
+        return conn
+
+    rows = BookRepository(connect, database.dialect).stream_ordered('newest', discipline='none')
+    assert not rows
+    assert list(rows) == [] and len(rows) == 0
+    assert len(returned) == len(borrowed)
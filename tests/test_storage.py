@@ -0,0 +1,123 @@
+"""S3Storage against moto's in-process S3 stand-in."""
+import io
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+moto = pytest.importorskip('moto')
+
+from storage import S3Storage, create_storage
+
+BUCKET = 'library-test'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        storage = create_storage({'backend': 's3', 'bucket': BUCKET, 'prefix': 'library/',
+                                  'endpoint_url': None, 'region': 'us-east-1', 'url_ttl': 120})
+        storage.client.create_bucket(Bucket=BUCKET)
+        yield storage
+
+
+class Upload(io.BytesIO):
+    """The parts of a werkzeug FileStorage that S3Storage.save() uses."""
+    mimetype = 'application/pdf'
+
+    @property
+    def stream(self):
+        return self
+
+
+def test_create_storage_picks_s3_driver(s3):
+    assert isinstance(s3, S3Storage)
+    assert s3.key('covers', 'a.jpg') == 'library/covers/a.jpg'
+
+
+def test_save_keeps_content_and_type(s3):
+    upload = Upload(b'%PDF-1.4 book')
+    upload.read()  # save() must rewind
+    s3.save('uploads', 'book.pdf', upload)
+
+    obj = s3.client.get_object(Bucket=BUCKET, Key='library/uploads/book.pdf')
+    assert obj['Body'].read() == b'%PDF-1.4 book'
+    assert obj['ContentType'] == 'application/pdf'
+    assert s3.exists('uploads', 'book.pdf')
+    assert s3.size('uploads', 'book.pdf') == len(b'%PDF-1.4 book')
+
+
+def test_put_file_uploads_and_removes_local_file(s3, tmp_path):
+    local = tmp_path / 'preview.png'
+    local.write_bytes(b'png')
+    s3.put_file('previews', 'preview.png', str(local))
+
+    assert not local.exists()
+    assert s3.exists('previews', 'preview.png')
+    head = s3.client.head_object(Bucket=BUCKET, Key='library/previews/preview.png')
+    assert head['ContentType'] == 'image/png'
+
+
+def test_exists_is_false_for_missing_object(s3):
+    assert not s3.exists('uploads', 'missing.pdf')
+
+
+def test_list_files_stays_in_its_area_and_folder(s3):
+    for key in ('uploads/a.pdf', 'uploads/b.pdf', 'uploads/.hidden', 'uploads/.quarantine/c.pdf', 'covers/a.jpg'):
+        s3.client.put_object(Bucket=BUCKET, Key=f'library/{key}', Body=b'12345')
+
+    listed = {name: (size, mtime) for name, size, mtime in s3.list_files('uploads')}
+    assert set(listed) == {'a.pdf', 'b.pdf'}
+    assert listed['a.pdf'][0] == 5
+    assert listed['a.pdf'][1] > 0
+    assert [name for name, _, _ in s3.list_files('uploads', '.quarantine')] == ['c.pdf']
+
+
+def test_move_renames_within_area(s3):
+    s3.client.put_object(Bucket=BUCKET, Key='library/uploads/a.pdf', Body=b'pdf')
+    s3.move('uploads', 'a.pdf', '.quarantine/a.pdf')
+
+    assert not s3.exists('uploads', 'a.pdf')
+    assert s3.exists('uploads', '.quarantine/a.pdf')
+
+
+def test_move_of_missing_object_raises_file_not_found(s3):
+    with pytest.raises(FileNotFoundError):
+        s3.move('uploads', 'gone.pdf', '.quarantine/gone.pdf')
+
+
+def test_delete_reports_whether_object_existed(s3):
+    s3.client.put_object(Bucket=BUCKET, Key='library/covers/a.jpg', Body=b'jpg')
+
+    assert s3.delete('covers', 'a.jpg') is True
+    assert not s3.exists('covers', 'a.jpg')
+    assert s3.delete('covers', 'a.jpg') is False
+
+
+def test_presigned_url_signs_key_and_attachment_name(s3):
+    url = s3.presigned_url('uploads', 'book.pdf', as_attachment=True, download_name='كتاب.pdf')
+    parts = urlsplit(url)
+    query = parse_qs(parts.query)
+
+    assert parts.path.endswith('/library/uploads/book.pdf')
+    # Signature version 4 states the lifetime, version 2 the expiry time
+    if 'X-Amz-Expires' in query:
+        assert query['X-Amz-Expires'] == ['120']
+    else:
+        assert 0 < int(query['Expires'][0]) - time.time() <= 120
+    assert query['response-content-disposition'] == [
+        "attachment; filename*=UTF-8''%D9%83%D8%AA%D8%A7%D8%A8.pdf"
+    ]
+
+    plain = parse_qs(urlsplit(s3.presigned_url('uploads', 'book.pdf')).query)
+    assert 'response-content-disposition' not in plain
+
+
+def test_presigned_url_is_fetchable(s3):
+    s3.client.put_object(Bucket=BUCKET, Key='library/uploads/book.pdf', Body=b'pdf bytes')
+    requests = pytest.importorskip('requests')
+
+    assert requests.get(s3.presigned_url('uploads', 'book.pdf')).content == b'pdf bytes'
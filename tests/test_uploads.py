@@ -0,0 +1,117 @@
+"""Resumable chunked uploads: sessions in the database, bytes in staging files."""
+import base64
+import hashlib
+import io
+import os
+
+import pytest
+
+import app
+import uploads
+from uploads import ResumableUploads, UploadError
+
+PDF = b'%PDF-1.4 ' + b'x' * 91
+
+
+@pytest.fixture
+def resumable(database, tmp_path):
+    return ResumableUploads(database.connect, staging_folder=str(tmp_path / 'staging'), max_size=1000,
+                            expiry_seconds=60)
+
+
+def _error(call, *args):
+    with pytest.raises(UploadError) as exc_info:
+        call(*args)
+    return exc_info.value
+
+
+def _staged(resumable, upload_id):
+    with open(resumable.staging_path(upload_id), 'rb') as handle:
+        return handle.read()
+
+
+def test_partial_upload_resumes_and_finishes(resumable):
+    upload_id = resumable.create('alice', 'book.pdf', len(PDF), hashlib.sha256(PDF).hexdigest())
+    assert resumable.append(upload_id, 'alice', 0, io.BytesIO(PDF[:40])) == 40
+
+    assert _error(resumable.finish, upload_id, 'alice').status == 409
+    # After a dropped connection the client asks for the offset and continues
+    assert resumable.get(upload_id, 'alice')[1] == 40
+    assert resumable.append(upload_id, 'alice', 40, io.BytesIO(PDF[40:])) == len(PDF)
+
+    session, path = resumable.finish(upload_id, 'alice')
+    assert session['filename'] == 'book.pdf'
+    with open(path, 'rb') as handle:
+        assert handle.read() == PDF
+    # Claimed: a second completion finds nothing
+    assert _error(resumable.get, upload_id, 'alice').status == 404
+
+
+def test_offset_mismatch_is_409_and_writes_nothing(resumable):
+    upload_id = resumable.create('alice', 'book.pdf', len(PDF))
+    resumable.append(upload_id, 'alice', 0, io.BytesIO(PDF[:10]))
+
+    for offset in (0, 20):
+        assert _error(resumable.append, upload_id, 'alice', offset, io.BytesIO(PDF[10:])).status == 409
+    assert _staged(resumable, upload_id) == PDF[:10]
+
+
+def test_size_limits_are_413(resumable):
+    assert _error(resumable.create, 'alice', 'big.pdf', 1001).status == 413
+
+    upload_id = resumable.create('alice', 'book.pdf', 20)
+    resumable.append(upload_id, 'alice', 0, io.BytesIO(PDF[:15]))
+    assert _error(resumable.append, upload_id, 'alice', 15, io.BytesIO(PDF[15:30])).status == 413
+    # The rejected chunk is rolled back, so the client can resend it
+    assert _staged(resumable, upload_id) == PDF[:15]
+
+
+def test_bad_chunk_checksum_is_rolled_back(resumable):
+    upload_id = resumable.create('alice', 'book.pdf', len(PDF))
+    wrong = hashlib.sha256(b'something else').digest()
+    assert _error(resumable.append, upload_id, 'alice', 0, io.BytesIO(PDF), wrong).status == 460
+    assert _staged(resumable, upload_id) == b''
+
+
+def test_uploads_are_private_to_their_user(resumable):
+    upload_id = resumable.create('alice', 'book.pdf', len(PDF))
+    assert _error(resumable.get, upload_id, 'mallory').status == 404
+    assert _error(resumable.append, upload_id, 'mallory', 0, io.BytesIO(PDF)).status == 404
+
+
+def test_idle_upload_expires(resumable, monkeypatch):
+    clock = [1_000_000.0]
+    monkeypatch.setattr(uploads, 'time', type('Clock', (), {'time': staticmethod(lambda: clock[0])}))
+    idle = resumable.create('alice', 'idle.pdf', len(PDF))
+    active = resumable.create('alice', 'active.pdf', len(PDF))
+    assert resumable.expires_at(resumable.get(idle, 'alice')[0]) == clock[0] + 60
+
+    clock[0] += 50
+    resumable.append(active, 'alice', 0, io.BytesIO(PDF[:10]))
+    clock[0] += 20
+    assert resumable.purge_expired() == 1
+
+    assert _error(resumable.get, idle, 'alice').status == 404
+    assert not os.path.exists(resumable.staging_path(idle))
+    assert resumable.get(active, 'alice')[1] == 10
+
+
+def test_patch_endpoint_answers_409_with_tus_header(database, resumable, monkeypatch):
+    monkeypatch.setattr(app, 'resumable_uploads', resumable)
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+        session['email'] = app.ALLOWED_ADD_BOOK_EMAIL
+    upload_id = resumable.create(f'user:{app.ALLOWED_ADD_BOOK_EMAIL}', 'book.pdf', len(PDF))
+
+    headers = {'Tus-Resumable': '1.0.0', 'Content-Type': 'application/offset+octet-stream'}
+    response = client.patch(f'/resumable_uploads/{upload_id}', data=PDF[10:],
+                            headers={**headers, 'Upload-Offset': '10'})
+    assert response.status_code == 409
+    assert response.headers['Tus-Resumable'] == '1.0.0'
+
+    checksum = 'sha256 ' + base64.b64encode(hashlib.sha256(PDF).digest()).decode('ascii')
+    response = client.patch(f'/resumable_uploads/{upload_id}', data=PDF,
+                            headers={**headers, 'Upload-Offset': '0', 'Upload-Checksum': checksum})
+    assert response.status_code == 204
+    assert response.headers['Upload-Offset'] == str(len(PDF))
@@ -0,0 +1,36 @@
+"""
+Text normalization shared by the search indexes.
+
+Folds the differences users do not type consistently: case, Latin accents,
+Arabic diacritics (tashkeel) and tatweel, and the common Arabic letter
+variants (hamza forms of alef, alef maqsura, ta marbuta).
+"""
+import re
+import unicodedata
+
+# Harakat, tanween, shadda, sukun, superscript alef, Quranic marks and tatweel
+_ARABIC_MARKS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+_ARABIC_FOLD = str.maketrans({
+    '\u0623': '\u0627',  # alef with hamza above -> alef
+    '\u0625': '\u0627',  # alef with hamza below -> alef
+    '\u0622': '\u0627',  # alef with madda -> alef
+    '\u0671': '\u0627',  # alef wasla -> alef
+    '\u0649': '\u064a',  # alef maqsura -> ya
+    '\u0629': '\u0647',  # ta marbuta -> ha
+    '\u0624': '\u0648',  # waw with hamza -> waw
+    '\u0626': '\u064a',  # ya with hamza -> ya
+})
+_LATIN_ACCENTS = re.compile('[\u0300-\u036f]')
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize_text(value):
+    """Return a lowercase, accent- and diacritic-free form of value with single spaces."""
+    if not value:
+        return ''
+    value = _ARABIC_MARKS.sub('', unicodedata.normalize('NFKC', value))
+    value = value.translate(_ARABIC_FOLD).casefold()
+    if not value.isascii():
+        # Split accented Latin letters and drop the accents (é -> e)
+        value = _LATIN_ACCENTS.sub('', unicodedata.normalize('NFKD', value))
+    return _NON_WORD.sub(' ', value).strip()
@@ -0,0 +1,427 @@
+"""
+Request tracing: spans for requests, SQL, file I/O, templates and OpenAI calls.
+
+Each sampled request gets a trace, with a server span for the request and
+child spans for every statement run through db.Connection, storage saves
+and sends, Jinja renders and chat completion calls. AI jobs queued by a
+request continue its trace on the job thread. Spans follow the
+OpenTelemetry data model and are exported as OTLP/JSON, either to an
+OTLP/HTTP collector or appended to a file (one ExportTraceServiceRequest
+per line, which the collector's otlpjsonfile receiver reads):
+
+    TRACING_EXPORT=http://localhost:4318/v1/traces
+    TRACING_EXPORT=file:instance/traces.jsonl
+
+Sampling is decided once, at the head of the trace: a request carrying a
+W3C traceparent header follows its caller's decision, any other request is
+kept with probability TRACING_SAMPLE_RATIO. Everything inside an unsampled
+request, and everything when TRACING_EXPORT is unset, costs one context
+variable lookup per would-be span. Finished spans are queued in memory and
+exported in batches by a background thread; if the exporter falls behind,
+new spans are dropped rather than slowing requests down.
+"""
+import os
+import json
+import time
+import random
+import atexit
+import threading
+import contextvars
+import urllib.request
+
+from flask import request, before_render_template, template_rendered
+
+TRACING_EXPORT = os.getenv('TRACING_EXPORT', '')
+TRACING_SAMPLE_RATIO = float(os.getenv('TRACING_SAMPLE_RATIO', '0.01'))
+TRACING_SERVICE_NAME = os.getenv('TRACING_SERVICE_NAME', 'library')
+TRACING_FLUSH_SECONDS = float(os.getenv('TRACING_FLUSH_SECONDS', '5'))
+TRACING_MAX_QUEUE = int(os.getenv('TRACING_MAX_QUEUE', '10000'))
+EXPORT_BATCH_SIZE = 512
+STATEMENT_MAX_CHARS = 1000
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+# OTLP status codes
+STATUS_ERROR = 2
+
+_current = contextvars.ContextVar('tracing_span', default=None)
+_random = random.SystemRandom()
+
+
+class Span:
+    """One timed operation in a sampled trace."""
+
+    sampled = True
+
+    def __init__(self, name, kind, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = f'{_random.getrandbits(64):016x}'
+        self.parent_id = parent_id
+        self.attributes = {key: value for key, value in (attributes or {}).items() if value is not None}
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self._token = _current.set(self)
+
+    @property
+    def traceparent(self):
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def set_attribute(self, key, value):
+        if value is not None:
+            self.attributes[key] = value
+
+    def record_error(self, exc):
+        self.error = f'{type(exc).__name__}: {exc}'
+
+    def end(self):
+        """Finish the span, restore its parent as the current span and queue it for export."""
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # Ended in another context (a streamed body, say): nothing to restore
+            pass
+        if _exporter is not None:
+            _exporter.submit(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc is not None:
+            self.record_error(exc)
+        self.end()
+
+
+class _NoopSpan:
+    """Stands in for a span that is not recorded."""
+
+    sampled = False
+    traceparent = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def record_error(self, exc):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def enabled():
+    return _exporter is not None
+
+
+def current_span():
+    """The innermost open span of this context, or None outside a sampled trace."""
+    return _current.get()
+
+
+def parse_traceparent(header):
+    """(trace_id, parent span id, sampled) from a W3C traceparent header, or None."""
+    parts = (header or '').strip().split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or parts[0] == 'ff':
+        return None
+    try:
+        trace_id, span_id, flags = int(parts[1], 16), int(parts[2], 16), int(parts[3][:2], 16)
+    except ValueError:
+        return None
+    if not trace_id or not span_id:
+        return None
+    return parts[1].lower(), parts[2].lower(), bool(flags & 1)
+
+
+def should_sample(trace_id, ratio=None):
+    """Head sampling on the trace id, so every service keeps the same traces."""
+    ratio = TRACING_SAMPLE_RATIO if ratio is None else ratio
+    # As OpenTelemetry's TraceIdRatioBased sampler: compare the low 64 bits
+    return int(trace_id[16:], 16) < ratio * 2 ** 64
+
+
+def start_trace(name, kind=SERVER, traceparent=None, attributes=None):
+    """Begin a trace (or join the caller's) and make its root span current.
+
+    Returns NOOP_SPAN when tracing is off or the trace is not sampled.
+    """
+    if _exporter is None:
+        return NOOP_SPAN
+    incoming = parse_traceparent(traceparent)
+    if incoming is not None:
+        trace_id, parent_id, sampled = incoming
+    else:
+        trace_id, parent_id = f'{_random.getrandbits(128):032x}', None
+        sampled = should_sample(trace_id)
+    if not sampled:
+        return NOOP_SPAN
+    return Span(name, kind, trace_id, parent_id, attributes)
+
+
+def start_span(name, kind=INTERNAL, attributes=None, parent=None):
+    """Begin a child of parent (default: the current span) and make it current.
+
+    Outside a sampled trace this returns NOOP_SPAN without doing anything.
+    """
+    parent = parent if parent is not None else _current.get()
+    if parent is None or not parent.sampled:
+        return NOOP_SPAN
+    return Span(name, kind, parent.trace_id, parent.span_id, attributes)
+
+
+def statement_span(dialect, sql, batch_size=None):
+    """A client span for one SQL statement (parameters are never recorded)."""
+    if _current.get() is None:
+        return NOOP_SPAN
+    statement = ' '.join(sql.split())
+    operation = statement.split(' ', 1)[0].upper()
+    return start_span(f'db {operation}', CLIENT, {
+        'db.system': dialect,
+        'db.operation': operation,
+        'db.statement': statement[:STATEMENT_MAX_CHARS],
+        'db.batch.size': batch_size,
+    })
+
+
+def chat_completion_span(model, messages, max_tokens):
+    """A client span for one chat completion call, sized by its prompt."""
+    if _current.get() is None:
+        return NOOP_SPAN
+    return start_span('openai chat.completions', CLIENT, {
+        'gen_ai.system': 'openai',
+        'gen_ai.operation.name': 'chat',
+        'gen_ai.request.model': model,
+        'gen_ai.request.max_tokens': max_tokens,
+        'gen_ai.prompt.messages': len(messages),
+        'gen_ai.prompt.characters': sum(len(message.get('content') or '') for message in messages),
+    })
+
+
+def record_usage(span, response):
+    """Copy a completion's model and token usage onto its span."""
+    if not span.sampled:
+        return
+    span.set_attribute('gen_ai.response.model', getattr(response, 'model', None))
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        span.set_attribute('gen_ai.usage.input_tokens', usage.prompt_tokens)
+        span.set_attribute('gen_ai.usage.output_tokens', usage.completion_tokens)
+
+
+# --- Export ---------------------------------------------------------------
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, int):
+        typed = {'intValue': str(value)}
+    elif isinstance(value, float):
+        typed = {'doubleValue': value}
+    else:
+        typed = {'stringValue': str(value)}
+    return {'key': key, 'value': typed}
+
+
+def _otlp_span(span):
+    record = {
+        'traceId': span.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': span.kind,
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(span.end_ns),
+        'attributes': [_attribute(key, value) for key, value in span.attributes.items()],
+    }
+    if span.parent_id:
+        record['parentSpanId'] = span.parent_id
+    if span.error:
+        record['status'] = {'code': STATUS_ERROR, 'message': span.error}
+    return record
+
+
+def otlp_payload(spans):
+    """An OTLP/JSON ExportTraceServiceRequest carrying spans."""
+    return {'resourceSpans': [{
+        'resource': {'attributes': [_attribute('service.name', TRACING_SERVICE_NAME),
+                                    _attribute('process.pid', os.getpid())]},
+        'scopeSpans': [{'scope': {'name': 'library.tracing'},
+                        'spans': [_otlp_span(span) for span in spans]}],
+    }]}
+
+
+class SpanExporter:
+    """Per-process queue of finished spans, written out in batches by a thread."""
+
+    def __init__(self, target, flush_interval=TRACING_FLUSH_SECONDS, max_queue=TRACING_MAX_QUEUE):
+        self.target = target
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.dropped = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending = []
+        self._pid = None
+        atexit.register(self.flush)
+
+    def submit(self, span):
+        self._ensure_thread()
+        with self._lock:
+            if len(self._pending) >= self.max_queue:
+                self.dropped += 1
+            else:
+                self._pending.append(span)
+
+    def _ensure_thread(self):
+        # Threads do not survive fork(); a child exports only its own spans
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pending = []
+                    threading.Thread(target=self._run, name='tracing', daemon=True).start()
+                    self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Export everything queued; returns the number of spans sent."""
+        with self._lock:
+            batch, self._pending = self._pending, []
+        for start in range(0, len(batch), EXPORT_BATCH_SIZE):
+            chunk = batch[start:start + EXPORT_BATCH_SIZE]
+            try:
+                self._write(json.dumps(otlp_payload(chunk), separators=(',', ':')).encode('utf-8'))
+            except Exception:
+                self.failed += len(chunk)  # tracing must never take the app down
+        return len(batch)
+
+    def _write(self, data):
+        with self._write_lock:
+            if self.target.startswith(('http://', 'https://')):
+                post = urllib.request.Request(self.target, data=data, method='POST',
+                                              headers={'Content-Type': 'application/json'})
+                with urllib.request.urlopen(post, timeout=10) as response:
+                    response.read()
+            else:
+                path = self.target[len('file:'):] if self.target.startswith('file:') else self.target
+                if os.path.dirname(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                # One O_APPEND write per batch keeps lines from several workers whole
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, data + b'\n')
+                finally:
+                    os.close(fd)
+
+
+_exporter = SpanExporter(TRACING_EXPORT) if TRACING_EXPORT else None
+
+
+def configure(export=None, sample_ratio=None):
+    """Change the export target (falsy turns tracing off) or the sample ratio at runtime."""
+    global _exporter, TRACING_SAMPLE_RATIO
+    if export is not None:
+        if _exporter is not None:
+            _exporter.flush()
+        _exporter = SpanExporter(export) if export else None
+    if sample_ratio is not None:
+        TRACING_SAMPLE_RATIO = sample_ratio
+
+
+def flush():
+    return _exporter.flush() if _exporter is not None else 0
+
+
+# --- Flask hooks ----------------------------------------------------------
+
+def _start_request_span():
+    rule = request.url_rule.rule if request.url_rule is not None else None
+    span = start_trace(f'{request.method} {rule or request.path}', SERVER,
+                       request.headers.get('traceparent'))
+    if span.sampled:
+        span.set_attribute('http.request.method', request.method)
+        span.set_attribute('http.route', rule)
+        span.set_attribute('url.path', request.path)
+        span.set_attribute('url.query', request.query_string.decode('latin-1') or None)
+        span.set_attribute('user_agent.original', request.user_agent.string or None)
+    request.environ['library.trace_span'] = span
+
+
+def _record_response(response):
+    span = request.environ.get('library.trace_span', NOOP_SPAN)
+    if span.sampled:
+        span.set_attribute('http.response.status_code', response.status_code)
+        span.set_attribute('http.response.body.size', response.content_length)
+        if response.status_code >= 500:
+            span.error = f'HTTP {response.status_code}'
+        if response.is_streamed:
+            # The body is rendered after teardown: the span lasts until it is sent
+            response.response = _traced_body(span, response.response)
+            request.environ['library.trace_span'] = NOOP_SPAN
+    return response
+
+
+def _traced_body(span, body):
+    # The server iterates the body in the request's thread and context, so
+    # spans opened while rendering (the template's own, SQL) are still current
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk) if isinstance(chunk, bytes) else len(chunk.encode('utf-8'))
+            yield chunk
+    except Exception as exc:
+        span.record_error(exc)
+        raise
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+        # A client that disconnects early leaves the template's span open
+        inner = _current.get()
+        while inner is not None and inner is not span and inner.end_ns is None:
+            inner.end()
+            inner = _current.get()
+        span.set_attribute('http.response.body.size', size)
+        span.end()
+
+
+def _end_request_span(exc):
+    span = request.environ.pop('library.trace_span', NOOP_SPAN)
+    if exc is not None:
+        span.record_error(exc)
+    span.end()
+
+
+def _start_render_span(sender, template, context, **extra):
+    start_span(f'render {template.name or "<string>"}', attributes={'template.name': template.name})
+
+
+def _end_render_span(sender, template, context, **extra):
+    span = current_span()
+    if span is not None and span.name == f'render {template.name or "<string>"}':
+        span.end()
+
+
+def init_app(app):
+    """Trace every request handled by app, and its template renders."""
+    app.before_request(_start_request_span)
+    # Registered first, so it runs last and sees the final status and size
+    app.after_request_funcs.setdefault(None, []).insert(0, _record_response)
+    app.teardown_request(_end_request_span)
+    before_render_template.connect(_start_render_span, app)
+    template_rendered.connect(_end_render_span, app)
@@ -0,0 +1,160 @@
+"""
+In-memory prefix index for title/author typeahead.
+
+Every word-start suffix of a book's normalized title and author ("naguib
+mahfouz" -> "naguib mahfouz", "mahfouz") is kept as a (key, book_id) pair in
+one sorted list, so a prefix lookup is two bisects. Prefixes that match a
+large slice of the catalogue ("a", "al", "history of") are answered from
+precomputed top-suggestion lists, built bottom-up when the index is loaded
+and patched in place when a matching book is added or removed.
+"""
+import heapq
+from bisect import bisect_left, insort
+
+from bookindex import BookIndex
+from textnorm import normalize_text
+
+
+def _word_suffixes(text):
+    """Return the normalized text and each of its later word-start suffixes."""
+    normalized = normalize_text(text)
+    if not normalized:
+        return []
+    words = normalized.split(' ')
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+def _prefix_upper_bound(prefix):
+    """Smallest string greater than every string starting with prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class PrefixIndex(BookIndex):
+    """Sorted-array prefix index over normalized book titles and authors."""
+
+    SCAN_LIMIT = 512      # ranges wider than this go through the top-suggestion cache
+    CACHE_DEPTH = 20      # suggestions kept per cached prefix
+
+    def __init__(self):
+        super().__init__()
+        self._entries = []    # sorted (key, book_id)
+        self._top_cache = {}  # prefix -> book ids, best first
+        # _books maps book_id -> (rank, title, author, keys)
+
+    def load(self, rows):
+        with self._lock:
+            self._books = {}
+            entries = []
+            for book_id, title, author in rows:
+                keys = self._keys_for(title, author)
+                self._books[book_id] = (book_id, title, author, keys)
+                entries.extend((key, book_id) for key in keys)
+            entries.sort()
+            self._entries = entries
+            self._top_cache = {}
+            self._precompute('', 0, len(entries))
+            self._max_id = max(self._books, default=0)
+            self._loaded = True
+
+    def add_book(self, book_id, title, author):
+        with self._lock:
+            self.remove_book(book_id)
+            keys = self._keys_for(title, author)
+            self._books[book_id] = (book_id, title, author, keys)
+            for key in keys:
+                insort(self._entries, (key, book_id))
+            self._promote(book_id, keys)
+            self._max_id = max(self._max_id, book_id)
+
+    def remove_book(self, book_id):
+        with self._lock:
+            book = self._books.pop(book_id, None)
+            if book is None:
+                return
+            keys = book[3]
+            for key in keys:
+                position = bisect_left(self._entries, (key, book_id))
+                if position < len(self._entries) and self._entries[position] == (key, book_id):
+                    del self._entries[position]
+            self._demote(book_id, keys)
+
+    def suggest(self, query, limit=8):
+        """Return up to limit books whose title or author has a word starting with query.
+
+        Suggestions are ordered newest first.
+        """
+        prefix = normalize_text(query)
+        if not prefix or limit <= 0:
+            return []
+        with self._lock:
+            low = bisect_left(self._entries, (prefix,))
+            high = bisect_left(self._entries, (_prefix_upper_bound(prefix),))
+            if high - low <= self.SCAN_LIMIT:
+                book_ids = self._top_ids(low, high, limit)
+            else:
+                book_ids = self._top_cache.get(prefix)
+                if book_ids is None or len(book_ids) < min(limit, self.CACHE_DEPTH):
+                    # Newly wide range, or deletions thinned the list: rescan once
+                    book_ids = self._top_ids(low, high, max(limit, self.CACHE_DEPTH))
+                    self._top_cache[prefix] = book_ids
+            books = [self._books[book_id] for book_id in book_ids[:limit]]
+        return [{'id': book[0], 'title': book[1], 'author': book[2]} for book in books]
+
+    def _top_ids(self, low, high, count):
+        ids = {book_id for _, book_id in self._entries[low:high]}
+        return heapq.nlargest(count, ids, key=self._rank)
+
+    def _rank(self, book_id):
+        return self._books[book_id][0]
+
+    def _precompute(self, prefix, low, high):
+        """Cache top suggestions for every prefix whose range exceeds SCAN_LIMIT.
+
+        Child prefixes are solved first and their lists merged, so each entry
+        is scanned once instead of once per prefix that contains it.
+        """
+        if high - low <= self.SCAN_LIMIT:
+            return self._top_ids(low, high, self.CACHE_DEPTH)
+        depth = len(prefix)
+        candidates = set()
+        position = low
+        # Keys equal to the prefix itself sort before its extensions
+        while position < high and len(self._entries[position][0]) == depth:
+            candidates.add(self._entries[position][1])
+            position += 1
+        while position < high:
+            child = self._entries[position][0][:depth + 1]
+            end = bisect_left(self._entries, (_prefix_upper_bound(child),), position, high)
+            candidates.update(self._precompute(child, position, end))
+            position = end
+        top = heapq.nlargest(self.CACHE_DEPTH, candidates, key=self._rank)
+        if prefix:
+            self._top_cache[prefix] = top
+        return top
+
+    def _promote(self, book_id, keys):
+        """Merge a new book into the cached lists of every prefix it matches."""
+        rank = self._rank(book_id)
+        for key in keys:
+            for end in range(1, len(key) + 1):
+                top = self._top_cache.get(key[:end])
+                if top is None or book_id in top:
+                    continue
+                if len(top) < self.CACHE_DEPTH or rank > self._rank(top[-1]):
+                    position = len(top)
+                    while position and self._rank(top[position - 1]) < rank:
+                        position -= 1
+                    top.insert(position, book_id)
+                    del top[self.CACHE_DEPTH:]
+
+    def _demote(self, book_id, keys):
+        """Drop a removed book from the cached lists of every prefix it matched."""
+        for key in keys:
+            for end in range(1, len(key) + 1):
+                top = self._top_cache.get(key[:end])
+                if top is not None and book_id in top:
+                    top.remove(book_id)
+
+    @staticmethod
+    def _keys_for(title, author):
+        return sorted(set(_word_suffixes(title)) | set(_word_suffixes(author)))
@@ -0,0 +1,214 @@
+"""
+Resumable chunked uploads for large PDFs, following the tus 1.0 core flow.
+
+  POST    /resumable_uploads           create: Upload-Length plus Upload-Metadata
+                                       (filename, and optionally the file's sha256)
+  HEAD    /resumable_uploads/<id>      how many bytes the server already has
+  PATCH   /resumable_uploads/<id>      append a chunk at Upload-Offset, optionally
+                                       with Upload-Checksum: sha256 <base64>
+  DELETE  /resumable_uploads/<id>      abandon the upload
+  POST    /resumable_uploads/<id>/complete   verify the whole file, create the book
+
+Each chunk is a short request, so a slow or flaky client never holds a worker
+for the whole transfer, and after a dropped connection the client asks for
+the offset and continues from there.
+
+Chunks are appended to a staging file in UPLOAD_STAGING_FOLDER. The staging
+file is the source of truth for the offset; the upload_sessions table holds
+what the client declared, so any worker on the host can take the next
+chunk. Concurrent PATCHes to one upload are refused with a file lock.
+Sessions idle for RESUMABLE_EXPIRY_SECONDS are discarded.
+"""
+import os
+import time
+import uuid
+import base64
+import fcntl
+import hashlib
+import binascii
+
+RESUMABLE_MAX_SIZE = int(os.getenv('RESUMABLE_MAX_SIZE', str(512 * 1024 * 1024)))
+RESUMABLE_EXPIRY_SECONDS = 24 * 60 * 60
+UPLOAD_STAGING_FOLDER = os.getenv('UPLOAD_STAGING_FOLDER', os.path.join('uploads', '.staging'))
+TUS_VERSION = '1.0.0'
+TUS_EXTENSIONS = 'creation,checksum,expiration,termination'
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    """A request the protocol rejects; status is the HTTP status to answer with."""
+
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+        super().__init__(message)
+
+
+def parse_metadata(header):
+    """Decode a tus Upload-Metadata header: 'key base64value,key2 base64value2'."""
+    metadata = {}
+    for pair in (header or '').split(','):
+        parts = pair.strip().split(' ')
+        if not parts[0]:
+            continue
+        try:
+            metadata[parts[0]] = base64.b64decode(parts[1], validate=True).decode('utf-8') if len(parts) > 1 else ''
+        except (binascii.Error, UnicodeDecodeError):
+            raise UploadError(400, f'Invalid Upload-Metadata value for {parts[0]!r}')
+    return metadata
+
+
+def parse_checksum(header):
+    """Decode 'sha256 <base64 digest>' into raw digest bytes, or None if absent."""
+    if not header:
+        return None
+    algorithm, _, value = header.partition(' ')
+    if algorithm.lower() != 'sha256':
+        raise UploadError(400, 'Only sha256 checksums are supported')
+    try:
+        return base64.b64decode(value, validate=True)
+    except binascii.Error:
+        raise UploadError(400, 'Invalid Upload-Checksum value')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(COPY_BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResumableUploads:
+    """Upload sessions in the upload_sessions table, bytes in staging files."""
+
+    def __init__(self, connect, staging_folder=UPLOAD_STAGING_FOLDER, max_size=RESUMABLE_MAX_SIZE,
+                 expiry_seconds=RESUMABLE_EXPIRY_SECONDS):
+        self.connect = connect
+        self.staging_folder = staging_folder
+        self.max_size = max_size
+        self.expiry_seconds = expiry_seconds
+
+    def staging_path(self, upload_id):
+        return os.path.join(self.staging_folder, f'{upload_id}.part')
+
+    def create(self, user_key, filename, length, sha256=None):
+        """Open a session for a file of length bytes and return its id."""
+        if length <= 0:
+            raise UploadError(400, 'Upload-Length must be positive')
+        if length > self.max_size:
+            raise UploadError(413, f'Uploads are limited to {self.max_size} bytes')
+        if sha256 is not None and len(sha256) != 64:
+            raise UploadError(400, 'sha256 metadata must be a hex digest')
+        self.purge_expired()
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self.staging_folder, exist_ok=True)
+        open(self.staging_path(upload_id), 'wb').close()
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute(
+                'INSERT INTO upload_sessions (id, user_key, filename, upload_length, sha256, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (upload_id, user_key, filename, length, sha256 and sha256.lower(), now, now)
+            )
+        return upload_id
+
+    def get(self, upload_id, user_key):
+        """The session row with its current offset, or raise 404 for unknown or foreign ids."""
+        with self.connect() as conn:
+            session = conn.execute('SELECT * FROM upload_sessions WHERE id = ?', (upload_id,)).fetchone()
+        path = self.staging_path(upload_id)
+        if session is None or session['user_key'] != user_key or not os.path.exists(path):
+            raise UploadError(404, 'Upload not found')
+        return session, os.path.getsize(path)
+
+    def expires_at(self, session):
+        return session['updated_at'] + self.expiry_seconds
+
+    def append(self, upload_id, user_key, offset, stream, checksum=None):
+        """Write the request body at offset and return the new offset.
+
+        Without a chunk checksum, whatever arrived before a dropped connection
+        is kept and the client resumes after it. With one, a chunk is kept
+        only if it arrived whole and matches.
+        """
+        session, current = self.get(upload_id, user_key)
+        with open(self.staging_path(upload_id), 'r+b') as handle:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadError(423, 'Another request is writing to this upload')
+            # Re-read under the lock: a request that just finished may have moved it
+            current = os.fstat(handle.fileno()).st_size
+            if offset != current:
+                raise UploadError(409, f'Upload-Offset {offset} does not match the current offset {current}')
+            remaining = session['upload_length'] - current
+            digest = hashlib.sha256()
+            handle.seek(current)
+            written = 0
+            try:
+                while True:
+                    block = stream.read(COPY_BUFFER_SIZE)
+                    if not block:
+                        break
+                    if written + len(block) > remaining:
+                        raise UploadError(413, 'Chunk extends past Upload-Length')
+                    handle.write(block)
+                    digest.update(block)
+                    written += len(block)
+                if checksum is not None and digest.digest() != checksum:
+                    raise UploadError(460, 'Checksum mismatch')
+            except UploadError:
+                handle.truncate(current)
+                raise
+            except Exception:
+                # Client went away mid-chunk: keep what arrived unless it must be verified
+                handle.flush()
+                if checksum is not None:
+                    handle.truncate(current)
+                raise
+            finally:
+                handle.flush()
+        with self.connect() as conn:
+            conn.execute('UPDATE upload_sessions SET updated_at = ? WHERE id = ?', (time.time(), upload_id))
+        return current + written
+
+    def finish(self, upload_id, user_key):
+        """Verify a fully received upload and claim it; returns (session, staging path).
+
+        Only one caller can claim a session. It owns the staging file from then
+        on: it moves it into storage, or calls discard() if that fails.
+        """
+        session, current = self.get(upload_id, user_key)
+        if current != session['upload_length']:
+            raise UploadError(409, f"Upload is incomplete: {current} of {session['upload_length']} bytes")
+        path = self.staging_path(upload_id)
+        with open(path, 'rb') as handle:
+            if handle.read(5) != b'%PDF-':
+                raise UploadError(415, 'The uploaded file is not a PDF')
+        if session['sha256'] and file_sha256(path) != session['sha256']:
+            raise UploadError(460, 'Checksum mismatch')
+        with self.connect() as conn:
+            claimed = conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,)).rowcount == 1
+        if not claimed:
+            raise UploadError(404, 'Upload not found')
+        return session, path
+
+    def discard(self, upload_id):
+        """Forget a session and remove its staging file if it is still there."""
+        with self.connect() as conn:
+            conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+        try:
+            os.remove(self.staging_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+    def purge_expired(self):
+        """Discard sessions that have not received a chunk for expiry_seconds."""
+        with self.connect() as conn:
+            expired = [row[0] for row in conn.execute(
+                'SELECT id FROM upload_sessions WHERE updated_at < ?', (time.time() - self.expiry_seconds,)
+            )]
+        for upload_id in expired:
+            self.discard(upload_id)
+        return len(expired)